@@ -0,0 +1,28 @@
+"""pairwises label prefix index
+
+Revision ID: 3e8d1f6c0b27
+Revises: 9f3c2b7a1d54
+Create Date: 2026-10-18 13:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3e8d1f6c0b27'
+down_revision = '9f3c2b7a1d54'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Case-insensitive prefix search of pairwises by label, legacy records store label in metadata only
+    op.create_index(
+        'ix_pairwises_their_label_prefix', 'pairwises',
+        [sa.text("lower(COALESCE(their_label, CAST((metadata -> 'their') ->> 'label' AS VARCHAR))) text_pattern_ops")]
+    )
+
+
+def downgrade():
+    op.drop_index('ix_pairwises_their_label_prefix', table_name='pairwises')
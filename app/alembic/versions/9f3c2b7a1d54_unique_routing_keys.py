@@ -0,0 +1,30 @@
+"""unique routing keys
+
+Revision ID: 9f3c2b7a1d54
+Revises: 5360a48d35c3
+Create Date: 2026-10-18 12:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9f3c2b7a1d54'
+down_revision = '5360a48d35c3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Keep the latest registration of duplicated keys
+    op.execute(
+        'DELETE FROM routing_keys a USING routing_keys b WHERE a.key = b.key AND a.id < b.id'
+    )
+    op.drop_index('ix_routing_keys_key', table_name='routing_keys')
+    op.create_index('ix_routing_keys_key', 'routing_keys', ['key'], unique=True)
+
+
+def downgrade():
+    op.drop_index('ix_routing_keys_key', table_name='routing_keys')
+    op.create_index('ix_routing_keys_key', 'routing_keys', ['key'], unique=False)
@@ -1,11 +1,181 @@
 import base64
 import asyncio
+import logging
 import threading
+from collections import OrderedDict
+from typing import Dict, Set, Tuple, Optional, Iterable
 
 import aioredis
 from uhashring import HashRing
 
-from app.settings import REDIS as REDIS_SERVERS
+from app.core.redis import get_hash_ring, RedisPools, RedisConnectionError
+
+
+class BusOverflowError(RuntimeError):
+    """Listener was closed because it didn't read messages in time, messages published since are lost"""
+
+
+class BusSubscriber:
+    """Subscription of single listener: bounded queue of received messages.
+
+    Slow listener don't block other listeners of the same topics: when its queue is full
+    subscription is closed, queued messages are still returned and then BusOverflowError is raised,
+    so listener knows messages were lost and may resubscribe
+    """
+
+    def __init__(self, topics: Iterable[str], maxsize: int):
+        self.topics = tuple(topics)
+        self.dropped = 0
+        self.overflowed = False
+        self.__queue = asyncio.Queue(maxsize=maxsize)
+
+    @property
+    def size(self) -> int:
+        return self.__queue.qsize()
+
+    def put_nowait(self, msg: bytes):
+        if not self.overflowed and self.__queue.full():
+            self.overflowed = True
+            logging.warning(f'Bus subscriber {self.topics} is slow, subscription is closed')
+        if self.overflowed:
+            self.dropped += 1
+        else:
+            self.__queue.put_nowait(msg)
+
+    async def get(self) -> bytes:
+        """
+        :raises BusOverflowError: queued messages are read and subscription was closed on overflow
+        """
+        if self.overflowed and self.__queue.empty():
+            raise BusOverflowError(f'Bus subscriber {self.topics} overflowed')
+        return await self.__queue.get()
+
+
+class BusSubscriptions:
+    """Process-wide multiplexer of bus subscriptions.
+
+    Holds one subscriber connection per redis server, topics are refcounted: SUBSCRIBE is sent for the
+    first listener of topic and UNSUBSCRIBE for the last one. Messages are fanned out to listeners queues.
+    """
+
+    QUEUE_SIZE = 100
+    RECONNECT_DELAY = 1
+
+    def __init__(self, loop: asyncio.AbstractEventLoop = None):
+        self.__loop = loop or asyncio.get_event_loop()
+        self.__subscribers: Dict[str, Set[BusSubscriber]] = {}
+        self.__readers: Dict[str, asyncio.Task] = {}
+        self.__ready: Dict[str, asyncio.Future] = {}
+        self.__conns: Dict[str, Tuple[aioredis.ConnectionsPool, aioredis.RedisConnection]] = {}
+        self.__conns_lock = asyncio.Lock()
+        self.dropped = 0
+
+    @property
+    def counters(self) -> dict:
+        subscribers = set()
+        for items in self.__subscribers.values():
+            subscribers.update(items)
+        return {
+            'topics': len(self.__subscribers),
+            'subscribers': len(subscribers),
+            'connections': len([conn for _, conn in self.__conns.values() if not conn.closed]),
+            'dropped': self.dropped + sum(sub.dropped for sub in subscribers)
+        }
+
+    async def subscribe(self, *topics: str, maxsize: int = None) -> BusSubscriber:
+        """Subscribe listener to topics, returns when all topics are subscribed on redis servers"""
+        subscriber = BusSubscriber(topics, maxsize or self.QUEUE_SIZE)
+        waiters = []
+        for topic in topics:
+            self.__subscribers.setdefault(topic, set()).add(subscriber)
+            if topic not in self.__readers:
+                self.__ready[topic] = self.__loop.create_future()
+                self.__readers[topic] = self.__loop.create_task(self.__reader(topic))
+            waiters.append(asyncio.shield(self.__ready[topic]))
+        try:
+            await asyncio.gather(*waiters)
+        except Exception:
+            self.unsubscribe(subscriber)
+            raise
+        return subscriber
+
+    def unsubscribe(self, subscriber: BusSubscriber):
+        for topic in subscriber.topics:
+            subscribers = self.__subscribers.get(topic, set())
+            subscribers.discard(subscriber)
+            if subscribers:
+                continue
+            self.__subscribers.pop(topic, None)
+            self.__ready.pop(topic, None)
+            tsk = self.__readers.pop(topic, None)
+            if tsk and not tsk.done():
+                tsk.cancel()
+            self.dropped += subscriber.dropped
+            _, conn = self.__conns.get(Bus.get_topic_url(topic), (None, None))
+            if conn is not None and not conn.closed:
+                # Command is sent immediately, so it is processed after SUBSCRIBE of cancelled reader
+                # and before SUBSCRIBE of next listener of the same topic
+                try:
+                    fut = conn.execute_pubsub(b'UNSUBSCRIBE', topic)
+                except aioredis.errors.RedisError:
+                    continue
+                fut.add_done_callback(self.__mute_result)
+
+    async def close(self):
+        for tsk in self.__readers.values():
+            tsk.cancel()
+        self.__readers.clear()
+        self.__ready.clear()
+        self.__subscribers.clear()
+        for pool, conn in self.__conns.values():
+            await RedisPools.release(pool, conn)
+        self.__conns.clear()
+
+    async def __reader(self, topic: str):
+        url = Bus.get_topic_url(topic)
+        while self.__readers.get(topic) is asyncio.current_task():
+            try:
+                conn = await self.__get_connection(url)
+                channel, = await aioredis.Redis(conn).subscribe(topic)
+                ready = self.__ready.get(topic)
+                if ready and not ready.done():
+                    ready.set_result(True)
+                while await channel.wait_message():
+                    try:
+                        packet = await channel.get_json()
+                    except ValueError:
+                        logging.warning(f'Unexpected packet format in topic {topic}')
+                        continue
+                    msg = Bus.decode_packet(packet)
+                    if msg is not None:
+                        for subscriber in list(self.__subscribers.get(topic, [])):
+                            subscriber.put_nowait(msg)
+                if not conn.closed:
+                    # Unsubscribed
+                    return
+                logging.warning(f'Bus subscriber connection to {url} was lost, resubscribe to {topic}')
+            except (aioredis.errors.RedisError, OSError, RedisConnectionError) as e:
+                ready = self.__ready.get(topic)
+                if ready and not ready.done():
+                    ready.set_exception(RedisConnectionError(f'Error subscribe to {topic} on {url}: {repr(e)}'))
+                    return
+                logging.exception(f'Bus subscriber error for {topic} on {url}')
+            await asyncio.sleep(self.RECONNECT_DELAY)
+
+    async def __get_connection(self, url: str) -> aioredis.RedisConnection:
+        async with self.__conns_lock:
+            pool, conn = self.__conns.get(url, (None, None))
+            if conn is None or conn.closed:
+                if conn is not None:
+                    await RedisPools.release(pool, conn)
+                pool, conn = await RedisPools.acquire(url)
+                self.__conns[url] = (pool, conn)
+            return conn
+
+    @staticmethod
+    def __mute_result(fut: asyncio.Future):
+        if not fut.cancelled():
+            fut.exception()
 
 
 class Bus:
@@ -13,8 +183,16 @@ class Bus:
     __thread_local = threading.local()
     __ctx_sub_key = 'aiobus.subscribers'
     MAX_SIZE = 1000
+    TOPICS_CACHE_SIZE = 1024
+
+    # topic -> redis server LRU, reset when ring is rebuilt
+    __topics_ring: HashRing = None
+    __topics_cache = OrderedDict()
 
     async def publish(self, topic: str, msg: bytes) -> int:
+        """
+        :return: number of workers subscribed to topic, listeners of one worker share subscription
+        """
         typ, payload = 'application/base64', base64.b64encode(msg).decode('ascii')
         packet = {
             'type': typ,
@@ -26,32 +204,34 @@ class Bus:
         return count
 
     async def listen(self, *topics: str, on: asyncio.Event = None):
-        subscriptions = {}
-        for topic in topics:
-            url = self.get_topic_url(topic)
-            channels = subscriptions.get(url, [])
-            channels.append(topic)
-            subscriptions[url] = channels
-        instances = []
-        redis_conns = []
-        for url, channels in subscriptions.items():
-            redis = await aioredis.create_redis(url)
-            redis_conns.append(redis)
-            readers = await redis.subscribe(*channels)
-            instances.extend(readers)
-        queue = asyncio.Queue(maxsize=1)
-        tasks = [asyncio.create_task(self.async_reader(sub, queue)) for sub in instances]
+        """Listen topics until cancelled
+
+        :raises BusOverflowError: listener didn't read messages in time, subscribe again to continue
+        """
+        subscriptions = self.get_subscriptions()
+        subscriber = await subscriptions.subscribe(*topics)
         if on:
             on.set()
         try:
             while True:
-                msg = await queue.get()
+                msg = await subscriber.get()
                 yield msg
         finally:
-            for tsk in tasks:
-                tsk.cancel()
-            for redis in redis_conns:
-                redis.close()
+            subscriptions.unsubscribe(subscriber)
+
+    def get_subscriptions(self) -> BusSubscriptions:
+        """Subscriptions multiplexer of current loop"""
+        cur_loop_id = id(asyncio.get_event_loop())
+        try:
+            multiplexers = self.__thread_local.subscriptions
+        except AttributeError:
+            multiplexers = {}
+            self.__thread_local.subscriptions = multiplexers
+        inst = multiplexers.get(cur_loop_id)
+        if inst is None:
+            inst = BusSubscriptions()
+            multiplexers[cur_loop_id] = inst
+        return inst
 
     async def get_conn_pool(self, url: str) -> aioredis.ConnectionsPool:
         cur_loop_id = id(asyncio.get_event_loop())
@@ -68,17 +248,32 @@ class Bus:
             self.__thread_local.pools[key] = pool
         return pool
 
-    @staticmethod
-    def get_topic_url(topic: str) -> str:
-        ring = HashRing(nodes=REDIS_SERVERS, hash_fn='ketama')
-        redis_server = ring.get_node(topic)
-        url = f'redis://{redis_server}'
+    @classmethod
+    def get_topic_url(cls, topic: str) -> str:
+        ring = get_hash_ring()
+        if ring is not cls.__topics_ring:
+            cls.__topics_ring = ring
+            cls.__topics_cache.clear()
+        url = cls.__topics_cache.get(topic)
+        if url is None:
+            url = f'redis://{ring.get_node(topic)}'
+            cls.__topics_cache[topic] = url
+            if len(cls.__topics_cache) > cls.TOPICS_CACHE_SIZE:
+                cls.__topics_cache.popitem(last=False)
+        else:
+            cls.__topics_cache.move_to_end(topic)
         return url
 
+    @staticmethod
+    def decode_packet(packet: dict) -> Optional[bytes]:
+        if packet and packet.get('type') == 'application/base64':
+            return base64.b64decode(packet['payload'].encode('ascii'))
+        return None
+
     @staticmethod
     async def async_reader(sub: aioredis.Channel, queue: asyncio.Queue):
         while sub.is_active:
             packet = await sub.get_json()
-            if packet['type'] == 'application/base64':
-                value = base64.b64decode(packet['payload'].encode('ascii'))
+            value = Bus.decode_packet(packet)
+            if value is not None:
                 await queue.put(value)
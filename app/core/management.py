@@ -1,4 +1,5 @@
 import os
+import sys
 import asyncio
 import shutil
 import uuid
@@ -16,11 +17,13 @@ from app.settings import MEMCACHED
 from app.dependencies import get_db
 from app.db.database import database
 from app.db.models import pairwises
-from app.core.redis import AsyncRedisChannel
+from app.core.redis import AsyncRedisChannel, StreamsSweeper, StreamsRebalancer
 from app.db.crud import reset_global_settings as _reset_global_settings, reset_accounts as _reset_accounts, \
     create_user as _create_user, restore_path as _restore_path, dump_path as _dump_path, load_backup as _load_backup
 from app.core.global_config import GlobalConfig
 from app.core.singletons import GlobalMemcachedClient
+from app.core.repo import Repo
+from app.routers.utils import import_static_connections as _import_static_connections
 
 
 ACME_DESCRIPTION = 'acme.registration'
@@ -365,6 +368,51 @@ async def listen_broadcast():
     await asyncio.wait(listeners, return_when=asyncio.ALL_COMPLETED)
 
 
+async def sweep_streams(once: bool = False):
+    sweeper = StreamsSweeper()
+    if once:
+        await sweeper.sweep_once()
+        print(f'Streams sweeper: {sweeper.counters}')
+    else:
+        await sweeper.run(interval=settings.STREAMS_SWEEP_INTERVAL)
+
+
+async def rebalance_streams(dry_run: bool = False):
+    print('============ REBALANCE STREAMS ============')
+    rebalancer = StreamsRebalancer(db=database, memcached=GlobalMemcachedClient.get())
+    await rebalancer.rebalance(dry_run=dry_run, on_progress=lambda counters: print(f'Progress: {counters}'))
+    if dry_run:
+        print(f'Dry run, endpoints to migrate: {rebalancer.migrated}')
+    print(f'Streams rebalancer: {rebalancer.counters}')
+    print('===========================================')
+
+
+async def import_static_connections(path: str):
+    print('============ IMPORT STATIC CONNECTIONS ============')
+    repo = Repo(db=database, memcached=GlobalMemcachedClient.get())
+    counters = await _import_static_connections(
+        repo, _read_chunks(path), on_progress=lambda progress: print(f'Progress: {progress}')
+    )
+    for invalid in counters.pop('invalid'):
+        print(f'Invalid record at line {invalid["line"]}: {invalid["error"]}')
+    print(f'Import static connections: {counters}')
+    print('===================================================')
+
+
+async def _read_chunks(path: str, chunk_size: int = 64*1024):
+    """Read file by chunks, "-" is stdin"""
+    f = sys.stdin.buffer if path == '-' else open(path, 'rb')
+    try:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        if f is not sys.stdin.buffer:
+            f.close()
+
+
 async def create_debug_pairwise_collection():
     db = Database(settings.SQLALCHEMY_DATABASE_URL)
     await db.connect()
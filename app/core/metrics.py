@@ -0,0 +1,328 @@
+import os
+import json
+import time
+import asyncio
+import logging
+import weakref
+from contextlib import contextmanager
+from typing import Dict, Optional, Any, List
+
+from app.core.tracing import Histogram
+
+
+class ActiveSessions:
+    """Gauges of sessions served by worker"""
+
+    __counts: Dict[str, int] = {}
+    # Pickup protocol state machines of live sessions, queued messages are counted
+    pickups = weakref.WeakSet()
+
+    @classmethod
+    @contextmanager
+    def session(cls, kind: str):
+        cls.__counts[kind] = cls.__counts.get(kind, 0) + 1
+        try:
+            yield
+        finally:
+            cls.__counts[kind] -= 1
+
+    @classmethod
+    def counts(cls) -> Dict[str, int]:
+        return dict(cls.__counts)
+
+    @classmethod
+    def pickup_queue_depth(cls) -> int:
+        return sum(pickup.message_count for pickup in list(cls.pickups))
+
+
+class MetricsWriter:
+    """Builder of Prometheus text exposition format, samples are grouped by metric families"""
+
+    PREFIX = 'mediator_'
+
+    def __init__(self):
+        self.__families: Dict[str, dict] = {}
+
+    @property
+    def families(self) -> Dict[str, dict]:
+        """Metric families: name -> {"type", "help", "samples": [(sample name, labels, value)]}, JSON compatible"""
+        return self.__families
+
+    def add(self, name: str, typ: str, help_: str, value: Any, labels: Dict[str, Any] = None):
+        if value is None:
+            return
+        name = self.PREFIX + name
+        self.__family(name, typ, help_).append((name, labels or {}, value))
+
+    def gauge(self, name: str, help_: str, value: Any, labels: Dict[str, Any] = None):
+        self.add(name, 'gauge', help_, value, labels)
+
+    def counter(self, name: str, help_: str, value: Any, labels: Dict[str, Any] = None):
+        self.add(name, 'counter', help_, value, labels)
+
+    def histogram(self, name: str, help_: str, histogram: Histogram, labels: Dict[str, Any] = None):
+        name = self.PREFIX + name
+        samples = self.__family(name, 'histogram', help_)
+        labels = labels or {}
+        for bound, count in histogram.cumulative:
+            le = '+Inf' if bound == float('inf') else self.__value(bound)
+            samples.append((f'{name}_bucket', {**labels, 'le': le}, count))
+        samples.append((f'{name}_sum', labels, histogram.sum))
+        samples.append((f'{name}_count', labels, histogram.count))
+
+    def merge(self, families: Dict[str, dict], labels: Dict[str, Any]):
+        """Add samples of other writer families with extra labels"""
+        for name, family in families.items():
+            samples = self.__family(name, family['type'], family['help'])
+            for sample_name, sample_labels, value in family['samples']:
+                samples.append((sample_name, {**labels, **sample_labels}, value))
+
+    def render(self) -> str:
+        lines = []
+        for name, family in self.__families.items():
+            lines.append(f'# HELP {name} {family["help"]}')
+            lines.append(f'# TYPE {name} {family["type"]}')
+            for sample_name, labels, value in family['samples']:
+                lines.append(f'{sample_name}{self.__labels(labels)} {self.__value(value)}')
+        return ''.join(line + '\n' for line in lines)
+
+    def __family(self, name: str, typ: str, help_: str) -> list:
+        family = self.__families.get(name)
+        if family is None:
+            family = {'type': typ, 'help': help_, 'samples': []}
+            self.__families[name] = family
+        return family['samples']
+
+    @staticmethod
+    def __labels(labels: Optional[Dict[str, Any]]) -> str:
+        if not labels:
+            return ''
+        items = []
+        for key, value in labels.items():
+            value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+            items.append(f'{key}="{value}"')
+        return '{' + ','.join(items) + '}'
+
+    @staticmethod
+    def __value(value: Any) -> str:
+        if isinstance(value, bool):
+            return '1' if value else '0'
+        return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class WorkersMetrics:
+    """Metrics snapshots of workers of this instance shared via directory.
+
+    Workers listen the same port, so scraper can't reach them individually: every worker periodically dumps
+    own metrics to file named by its pid and any worker renders snapshots of all of them labeled by worker.
+    Snapshots not updated for EXPIRE_SEC are of stopped workers, they are removed.
+    """
+
+    INTERVAL = 5
+    EXPIRE_SEC = 30
+
+    def __init__(self, path: str = None, loop: asyncio.AbstractEventLoop = None):
+        """
+        :param path: directory of snapshots, METRICS_DIR setting by default, empty - metrics of current worker only
+        """
+        if path is None:
+            from app.settings import METRICS_DIR
+            path = METRICS_DIR
+        self.__path = path
+        self.__loop = loop or asyncio.get_event_loop()
+        self.__task: Optional[asyncio.Task] = None
+
+    @property
+    def worker(self) -> str:
+        return str(os.getpid())
+
+    def start(self):
+        if self.__path and (self.__task is None or self.__task.done()):
+            self.__task = self.__loop.create_task(self.__run())
+
+    async def stop(self):
+        if self.__task and not self.__task.done():
+            self.__task.cancel()
+        self.__task = None
+        if self.__path:
+            try:
+                os.remove(self.__file(self.worker))
+            except OSError:
+                pass
+
+    def dump(self, families: Dict[str, dict]):
+        os.makedirs(self.__path, exist_ok=True)
+        path = self.__file(self.worker)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(families, f)
+        os.replace(path + '.tmp', path)
+
+    def load(self) -> Dict[str, Dict[str, dict]]:
+        """Snapshots of live workers: worker -> metric families"""
+        snapshots = {}
+        if not self.__path or not os.path.isdir(self.__path):
+            return snapshots
+        expired_at = time.time() - self.EXPIRE_SEC
+        for file_name in os.listdir(self.__path):
+            worker, ext = os.path.splitext(file_name)
+            if ext != '.json':
+                continue
+            path = os.path.join(self.__path, file_name)
+            try:
+                if os.path.getmtime(path) < expired_at:
+                    os.remove(path)
+                    continue
+                with open(path) as f:
+                    snapshots[worker] = json.load(f)
+            except (OSError, ValueError):
+                # Snapshot was removed or replaced meanwhile
+                continue
+        return snapshots
+
+    def collect(self) -> str:
+        """Metrics of all workers in Prometheus text format, samples are labeled with worker pid"""
+        snapshots = self.load()
+        snapshots[self.worker] = collect_worker_metrics().families
+        writer = MetricsWriter()
+        for worker, families in sorted(snapshots.items()):
+            writer.merge(families, {'worker': worker})
+        return writer.render()
+
+    def __file(self, worker: str) -> str:
+        return os.path.join(self.__path, f'{worker}.json')
+
+    async def __run(self):
+        while True:
+            try:
+                self.dump(collect_worker_metrics().families)
+            except Exception:
+                logging.exception('Error while dump worker metrics')
+            await asyncio.sleep(self.INTERVAL)
+
+
+def collect_worker_metrics() -> MetricsWriter:
+    """Metrics of current worker"""
+    writer = MetricsWriter()
+    for collector in [
+        _collect_delivery, _collect_sessions, _collect_redis, _collect_bus, _collect_pools,
+        _collect_caches, _collect_request_bodies, _collect_logs
+    ]:
+        try:
+            collector(writer)
+        except Exception:
+            logging.exception(f'Error while collect metrics with {collector.__name__}')
+    return writer
+
+
+def collect_metrics() -> str:
+    """Metrics of all workers of instance in Prometheus text format"""
+    from app.core.singletons import GlobalWorkersMetrics
+    return GlobalWorkersMetrics.get().collect()
+
+
+def _collect_delivery(writer: MetricsWriter):
+    from app.core.singletons import GlobalTracer, GlobalInFlightTracker, GlobalAckDispatcher, \
+        GlobalPendingEntriesReclaimer
+    tracer = GlobalTracer.get()
+    for span_name, histograms in tracer.histograms.items():
+        for stage, histogram in histograms.items():
+            writer.histogram(
+                'span_stage_duration_seconds', 'Duration of span stages, total is duration of whole span',
+                histogram, {'span': span_name, 'stage': stage}
+            )
+    for span_name, outcomes in tracer.outcomes.items():
+        for outcome, count in outcomes.items():
+            writer.counter(
+                'span_outcomes_total', 'Finished spans by outcome', count, {'span': span_name, 'outcome': outcome}
+            )
+    for name, value in tracer.counters.items():
+        writer.counter('tracer_spans_total', 'Spans by tracer state', value, {'state': name})
+    writer.gauge('in_flight_messages', 'Messages waiting for device ACK in durable mode', GlobalInFlightTracker.get().size)
+    writer.gauge('ack_waiters', 'Pushes waiting for device ACK', GlobalAckDispatcher.get().pending_count)
+    for name, value in GlobalPendingEntriesReclaimer.get().counters.items():
+        writer.counter('pending_entries_total', 'Pending stream entries handled by reclaimer', value, {'event': name})
+
+
+def _collect_sessions(writer: MetricsWriter):
+    for kind, count in ActiveSessions.counts().items():
+        writer.gauge('active_sessions', 'Active sessions', count, {'kind': kind})
+    writer.gauge('pickup_queue_messages', 'Messages queued for pickup protocol', ActiveSessions.pickup_queue_depth())
+
+
+def _collect_redis(writer: MetricsWriter):
+    from app.core.redis import RedisPools
+    from app.core.singletons import GlobalRedisHealthMonitor
+    metrics = RedisPools.metrics()
+    for url, kinds in metrics['pools'].items():
+        for kind, pool in kinds.items():
+            labels = {'server': url, 'kind': kind}
+            writer.gauge(
+                'redis_pool_connections', 'Redis pool connections', pool['size'] - pool['free'],
+                {**labels, 'state': 'used'}
+            )
+            writer.gauge('redis_pool_connections', 'Redis pool connections', pool['free'], {**labels, 'state': 'free'})
+            writer.gauge('redis_pool_max_connections', 'Redis pool max size', pool['max_size'], labels)
+    for name, value in metrics['counters'].items():
+        writer.counter('redis_pool_events_total', 'Redis blocking pool events', value, {'event': name})
+    for server, status in GlobalRedisHealthMonitor.get().statuses.items():
+        if status.up is not None:
+            writer.gauge('redis_node_up', 'Redis server is reachable', status.up, {'server': server})
+        writer.gauge('redis_node_latency_seconds', 'EWMA of Redis PING latency', status.latency, {'server': server})
+
+
+def _collect_bus(writer: MetricsWriter):
+    from app.core.bus import Bus
+    counters = Bus().get_subscriptions().counters
+    for name in ['topics', 'subscribers', 'connections']:
+        writer.gauge(f'bus_{name}', f'Bus subscriptions: {name}', counters[name])
+    writer.counter('bus_dropped_messages_total', 'Messages dropped for slow bus subscribers', counters['dropped'])
+
+
+def _collect_pools(writer: MetricsWriter):
+    from app.db.database import database
+    from app.core.singletons import GlobalMemcachedClient
+    # Clients don't expose pools stats publicly
+    memcached_pool = getattr(GlobalMemcachedClient.get(), '_pool', None)
+    connections = getattr(memcached_pool, '_pool', None)
+    if connections is not None:
+        used = len([conn for conn in list(connections) if conn.in_use])
+        writer.gauge('memcached_pool_connections', 'Memcached pool connections', used, {'state': 'used'})
+        writer.gauge(
+            'memcached_pool_connections', 'Memcached pool connections', len(connections) - used, {'state': 'free'}
+        )
+        writer.gauge('memcached_pool_max_connections', 'Memcached pool max size', memcached_pool._pool_maxsize)
+    db_pool = getattr(getattr(database, '_backend', None), '_pool', None)
+    if db_pool is not None and hasattr(db_pool, 'get_size'):
+        size, idle = db_pool.get_size(), db_pool.get_idle_size()
+        writer.gauge('db_pool_connections', 'Database pool connections', size - idle, {'state': 'used'})
+        writer.gauge('db_pool_connections', 'Database pool connections', idle, {'state': 'free'})
+        writer.gauge('db_pool_max_connections', 'Database pool max size', db_pool.get_max_size())
+
+
+def _collect_caches(writer: MetricsWriter):
+    from app.core.singletons import GlobalRepoLocalCache, GlobalPairwiseCache
+    for cache_name, cache in [('repo', GlobalRepoLocalCache.get()), ('pairwise', GlobalPairwiseCache.get())]:
+        for namespace, counters in cache.counters.items():
+            for name, value in counters.items():
+                writer.counter(
+                    'cache_events_total', 'Local cache events', value,
+                    {'cache': cache_name, 'namespace': namespace, 'event': name}
+                )
+
+
+def _collect_request_bodies(writer: MetricsWriter):
+    from app.utils import RequestBodyReader
+    metrics = RequestBodyReader.metrics()
+    for name in ['requests', 'rejected', 'chunks', 'bytes', 'copies', 'copied_bytes']:
+        writer.counter(f'request_bodies_{name}_total', f'Request bodies reader: {name}', metrics[name])
+    writer.gauge('request_bodies_buffered_bytes', 'Bytes of request bodies being read', metrics['buffered_bytes'])
+
+
+def _collect_logs(writer: MetricsWriter):
+    from app.elk import AsyncLogHandler
+    for handler in logging.getLogger().handlers:
+        if isinstance(handler, AsyncLogHandler):
+            metrics = handler.metrics
+            writer.gauge('log_queue_records', 'Log records waiting to be written', metrics['queued'])
+            for name in ['written', 'batches', 'dropped', 'errors']:
+                writer.counter(f'log_{name}_total', f'Log shipping: {name}', metrics[name])
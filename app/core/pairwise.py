@@ -1,5 +1,6 @@
+import json
 from contextlib import asynccontextmanager
-from typing import List, Optional, Dict
+from typing import List, Optional
 
 from sirius_sdk import Pairwise
 from databases import Database
@@ -10,12 +11,24 @@ from .did import MediatorDID
 
 
 class MediatorPairwiseList(AbstractPairwiseList):
+    """Pairwise storage with per worker LRU cache of pairwises metadata.
 
-    def __init__(self, db: Database):
+    Cache entries: their did -> encoded metadata, their verkey -> their did. Updated pairwise is invalidated
+    in all workers by did, stale verkey entries are detected by verkey of metadata they refer to.
+    """
+
+    INVALIDATION_TOPIC = 'pairwise.cache.invalidate'
+    CACHE_NAMESPACE = 'pairwises'
+    CACHE_PREFIX_DID = 'p2p:did:'
+    CACHE_PREFIX_VERKEY = 'p2p:verkey:'
+
+    def __init__(self, db: Database, cache=None):
+        """
+        :param cache: RepoLocalCache instance, worker-wide pairwise cache is used by default
+        """
         self._db: Database = db
         self._did = MediatorDID(db)
-        self._cached_metadata: Dict[str, dict] = {}
-        self._cached: Dict[str, Pairwise] = {}
+        self.__cache = cache
 
     async def create(self, pairwise: Pairwise):
         async with self.get_db_connection_lazy() as db:
@@ -32,16 +45,14 @@ class MediatorPairwiseList(AbstractPairwiseList):
                 'their_label': pairwise.their.label
             }
             await db.execute(query=sql, values=values)
-            self._cached_metadata[pairwise.their.did] = metadata
+            self._set_cached(pairwise.their.did, pairwise.their.verkey, metadata)
 
     async def update(self, pairwise: Pairwise):
         metadata = pairwise.metadata or {}
         metadata.update(self._build_metadata(pairwise))
-        metadata_cached = self._cached_metadata.get(pairwise.their.did, None)
+        metadata_cached = self._get_cached(pairwise.their.did)
         if metadata_cached == metadata:
             return
-        if pairwise.their.verkey in self._cached:
-            del self._cached[pairwise.their.did]
         async with self.get_db_connection_lazy() as db:
             sql = pairwises.update().where(pairwises.c.their_did == pairwise.their.did)
             values = {
@@ -52,12 +63,17 @@ class MediatorPairwiseList(AbstractPairwiseList):
                 'their_label': pairwise.their.label
             }
             await db.execute(query=sql, values=values)
-            self._cached_metadata[pairwise.their.did] = metadata
+        await self.invalidate(pairwise.their.did)
+        self._set_cached(pairwise.their.did, pairwise.their.verkey, metadata)
 
     async def is_exists(self, their_did: str) -> bool:
+        if self._get_cached(their_did) is not None:
+            return True
         async with self.get_db_connection_lazy() as db:
             sql = pairwises.select().where(pairwises.c.their_did == their_did)
             row = await db.fetch_one(query=sql)
+            if row:
+                self._set_cached(row['their_did'], row['their_verkey'], row['metadata'])
             return row is not None
 
     async def ensure_exists(self, pairwise: Pairwise):
@@ -67,29 +83,71 @@ class MediatorPairwiseList(AbstractPairwiseList):
             await self.create(pairwise)
 
     async def load_for_did(self, their_did: str) -> Optional[Pairwise]:
+        metadata = self._get_cached(their_did)
+        if metadata is not None:
+            return self._restore_pairwise(metadata)
         async with self.get_db_connection_lazy() as db:
             sql = pairwises.select().where(pairwises.c.their_did == their_did)
             row = await db.fetch_one(query=sql)
             if row:
                 metadata = row['metadata']
+                self._set_cached(row['their_did'], row['their_verkey'], metadata)
                 pairwise = self._restore_pairwise(metadata)
                 return pairwise
             else:
                 return None
 
     async def load_for_verkey(self, their_verkey: str) -> Optional[Pairwise]:
-        if their_verkey in self._cached:
-            return self._cached[their_verkey]
+        metadata = self._get_cached_for_verkey(their_verkey)
+        if metadata is not None:
+            return self._restore_pairwise(metadata)
         async with self.get_db_connection_lazy() as db:
             sql = pairwises.select().where(pairwises.c.their_verkey == their_verkey)
             row = await db.fetch_one(query=sql)
             if row:
                 metadata = row['metadata']
+                self._set_cached(row['their_did'], row['their_verkey'], metadata)
                 pairwise = self._restore_pairwise(metadata)
                 return pairwise
             else:
                 return None
 
+    async def invalidate(self, their_did: str):
+        """Drop cached pairwise in all workers, call it after pairwise was changed bypassing this storage"""
+        await self._cache.invalidate(self.CACHE_PREFIX_DID + their_did)
+
+    @property
+    def _cache(self):
+        if self.__cache is None:
+            from app.core.singletons import GlobalPairwiseCache
+            # Singleton of current loop: storage itself is created before loop is running
+            return GlobalPairwiseCache.get()
+        return self.__cache
+
+    def _get_cached(self, their_did: str) -> Optional[dict]:
+        value = self._cache.get(self.CACHE_PREFIX_DID + their_did)
+        if value is None:
+            self._cache.count(self.CACHE_NAMESPACE, 'misses')
+            return None
+        self._cache.count(self.CACHE_NAMESPACE, 'l1_hits')
+        return json.loads(value)
+
+    def _get_cached_for_verkey(self, their_verkey: str) -> Optional[dict]:
+        their_did = self._cache.get(self.CACHE_PREFIX_VERKEY + their_verkey)
+        if their_did is None:
+            self._cache.count(self.CACHE_NAMESPACE, 'misses')
+            return None
+        metadata = self._get_cached(their_did.decode())
+        if metadata is not None and metadata.get('their', {}).get('verkey', None) == their_verkey:
+            return metadata
+        return None
+
+    def _set_cached(self, their_did: str, their_verkey: str, metadata: Optional[dict]):
+        # Entries are stored encoded, so callers get own copy of metadata
+        self._cache.set(self.CACHE_PREFIX_DID + their_did, json.dumps(metadata or {}).encode())
+        if their_verkey:
+            self._cache.set(self.CACHE_PREFIX_VERKEY + their_verkey, their_did.encode())
+
     async def _start_loading(self):
         self.__is_loading = True
 
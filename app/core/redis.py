@@ -4,9 +4,12 @@ import json
 import random
 import asyncio
 import datetime
+import heapq
+import threading
 import hashlib
 import logging
-from typing import Any, Optional, Dict
+from typing import Any, Optional, Dict, Union, Callable, Awaitable, List, Tuple
+from dataclasses import dataclass
 from contextlib import asynccontextmanager
 
 import aioredis
@@ -14,8 +17,15 @@ import aiomemcached
 from databases import Database
 from expiringdict import ExpiringDict
 
-from app.settings import REDIS as REDIS_SERVERS, MEMCACHED as MEMCACHED_SERVER
-from app.db.crud import load_endpoint
+from uhashring import HashRing
+
+from app.settings import REDIS as REDIS_SERVERS, MEMCACHED as MEMCACHED_SERVER, \
+    STREAM_MAX_LEN, STREAM_MAX_AGE, REDIS_POOL_MAX_SIZE, REDIS_BLOCKING_POOL_MAX_SIZE, \
+    REDIS_WEIGHTS, REDIS_VNODES
+from app.db.crud import load_endpoint, load_endpoints
+from app.core.repo import Repo
+from app.core.singletons import GlobalRedisHealthMonitor
+from app.core.tracing import Span
 
 
 class ReadWriteTimeoutError(Exception):
@@ -34,19 +44,363 @@ PUSH_MSG_TYPE = 'https://didcomm.org/redis/1.0/push'
 ACK_MSG_TYPE = 'https://didcomm.org/redis/1.0/ack'
 
 
+@dataclass
+class StreamRetention:
+    """Retention policy for endpoint streams
+
+    max_len: approximate max count of entries (XADD MAXLEN ~), None - unlimited
+    max_age: (sec) max age of entries (XTRIM MINID ~), None - unlimited
+    """
+    max_len: Optional[int] = None
+    max_age: Optional[int] = None
+
+    @classmethod
+    def default(cls) -> 'StreamRetention':
+        return cls(max_len=STREAM_MAX_LEN or None, max_age=STREAM_MAX_AGE or None)
+
+    def min_id(self) -> Optional[str]:
+        """Entry ids are created from add timestamp, so entries older than max_age have less ids"""
+        if self.max_age is None:
+            return None
+        stamp = datetime.datetime.utcnow().timestamp() - self.max_age
+        return f'{math.floor(stamp * 1000)}-0'
+
+
+def parse_stream_entry_id(value: Union[str, bytes]) -> (int, int):
+    """Parse redis stream entry id, for example: '1526569495631-0'
+
+    :return: milliseconds, sequence number
+    """
+    if isinstance(value, bytes):
+        value = value.decode()
+    ms, _, seq = value.partition('-')
+    return int(ms), int(seq or 0)
+
+
+class RedisPools:
+    """Per event loop pools of redis connections keyed by server url (like Bus.get_conn_pool)
+
+      - commands pool: non-blocking commands are multiplexed over shared connections
+      - blocking pool: connection is exclusively acquired for blocking XREADGROUP or SUBSCRIBE
+    """
+
+    KIND_COMMANDS = 'commands'
+    KIND_BLOCKING = 'blocking'
+    TIMEOUT = 5
+
+    __thread_local = threading.local()
+    __max_sizes = {
+        KIND_COMMANDS: REDIS_POOL_MAX_SIZE,
+        KIND_BLOCKING: REDIS_BLOCKING_POOL_MAX_SIZE
+    }
+
+    @classmethod
+    async def get_pool(cls, url: str, kind: str = KIND_COMMANDS) -> aioredis.ConnectionsPool:
+        pools = cls.__get_loop_pools()
+        key = (kind, url)
+        pool = pools.get(key)
+        if pool is None or pool.closed:
+            pool = await aioredis.create_pool(
+                url, maxsize=cls.__max_sizes[kind], create_connection_timeout=cls.TIMEOUT
+            )
+            if key in pools and not pools[key].closed:
+                # Concurrent coroutine created pool while this one was connecting
+                pool.close()
+                pool = pools[key]
+            else:
+                pools[key] = pool
+        return pool
+
+    @classmethod
+    async def redis(cls, url: str) -> aioredis.Redis:
+        return aioredis.Redis(await cls.get_pool(url, cls.KIND_COMMANDS))
+
+    @classmethod
+    async def acquire(cls, url: str) -> (aioredis.ConnectionsPool, aioredis.RedisConnection):
+        """Acquire connection from blocking pool, caller must release it"""
+        pool = await cls.get_pool(url, cls.KIND_BLOCKING)
+        if pool.freesize == 0 and pool.size >= pool.maxsize:
+            logging.warning(f'Blocking connections pool for {url} is exhausted, waiting for free connection')
+            cls.__get_loop_counters()['exhausted'] += 1
+        conn = await pool.acquire()
+        cls.__get_loop_counters()['acquired'] += 1
+        return pool, conn
+
+    @classmethod
+    async def release(cls, pool: aioredis.ConnectionsPool, conn: aioredis.RedisConnection):
+        if conn.in_pubsub and not conn.closed:
+            # Return connection to pool instead of closing it
+            try:
+                channels = list(conn.pubsub_channels.values())
+                if channels:
+                    await asyncio.wait_for(conn.execute_pubsub(b'UNSUBSCRIBE', *channels), timeout=cls.TIMEOUT)
+            except Exception:
+                conn.close()
+        if pool.closed:
+            conn.close()
+        else:
+            pool.release(conn)
+        cls.__get_loop_counters()['released'] += 1
+
+    @classmethod
+    @asynccontextmanager
+    async def blocking(cls, url: str) -> aioredis.Redis:
+        pool, conn = await cls.acquire(url)
+        try:
+            yield aioredis.Redis(conn)
+        finally:
+            await cls.release(pool, conn)
+
+    @classmethod
+    def metrics(cls) -> dict:
+        """Pools metrics for current event loop"""
+        pools = {}
+        for (kind, url), pool in cls.__get_loop_pools().items():
+            pools.setdefault(url, {})[kind] = {
+                'size': pool.size,
+                'free': pool.freesize,
+                'max_size': pool.maxsize,
+                'closed': pool.closed
+            }
+        return {
+            'pools': pools,
+            'counters': dict(cls.__get_loop_counters())
+        }
+
+    @classmethod
+    async def close_all(cls):
+        pools = cls.__get_loop_pools()
+        for pool in pools.values():
+            pool.close()
+            await pool.wait_closed()
+        pools.clear()
+
+    @classmethod
+    def __get_loop_pools(cls) -> Dict[Tuple[str, str], aioredis.ConnectionsPool]:
+        return cls.__get_loop_state()[0]
+
+    @classmethod
+    def __get_loop_counters(cls) -> Dict[str, int]:
+        return cls.__get_loop_state()[1]
+
+    @classmethod
+    def __get_loop_state(cls) -> (dict, dict):
+        cur_loop_id = id(asyncio.get_event_loop())
+        try:
+            states = cls.__thread_local.states
+        except AttributeError:
+            states = {}
+            cls.__thread_local.states = states
+        state = states.get(cur_loop_id)
+        if state is None:
+            state = ({}, {'acquired': 0, 'released': 0, 'exhausted': 0})
+            states[cur_loop_id] = state
+        return state
+
+
+@dataclass
+class RedisNodeStatus:
+    """Cached health status of redis server
+
+    up: None - not checked yet
+    latency: (sec) EWMA of PING round trip
+    """
+    server: str
+    up: Optional[bool] = None
+    latency: Optional[float] = None
+    last_error: Optional[str] = None
+    checked_at: Optional[float] = None
+
+
+class RedisHealthMonitor:
+    """Background monitor of redis servers reachability.
+
+    Statuses are refreshed every CHECK_INTERVAL and immediately on reported errors,
+    so servers choice is answered from memory without connecting to servers.
+    """
+
+    CHECK_INTERVAL = 5
+    PING_TIMEOUT = 3
+    EWMA_ALPHA = 0.3
+    # Servers with latency up to best * LATENCY_TOLERANCE + LATENCY_SLACK are preferred equally
+    LATENCY_TOLERANCE = 1.5
+    LATENCY_SLACK = 0.001
+    MIN_RECHECK_INTERVAL = 1
+
+    def __init__(self, servers: List[str] = None, loop: asyncio.AbstractEventLoop = None):
+        """
+        :param servers: redis servers addresses, for example ['redis1', 'redis2:6379']
+        """
+        self.__loop = loop or asyncio.get_event_loop()
+        self.__statuses: Dict[str, RedisNodeStatus] = {
+            server: RedisNodeStatus(server=server) for server in (servers or REDIS_SERVERS)
+        }
+        self.__healthy: List[str] = []
+        self.__preferred: List[str] = []
+        self.__refreshed_at: Optional[float] = None
+        self.__refreshing: Optional[asyncio.Future] = None
+        self.__wakeup = asyncio.Event()
+        self.__task: Optional[asyncio.Task] = None
+
+    @property
+    def statuses(self) -> Dict[str, RedisNodeStatus]:
+        return dict(self.__statuses)
+
+    def start(self):
+        if self.__task is None or self.__task.done():
+            self.__task = self.__loop.create_task(self.__run())
+
+    async def stop(self):
+        if self.__task and not self.__task.done():
+            self.__task.cancel()
+        self.__task = None
+
+    def is_up(self, server: str) -> bool:
+        status = self.__statuses.get(server)
+        return status is not None and status.up is True
+
+    async def wait_checked(self):
+        """Ensure statuses were checked, recheck if all servers are down for a while"""
+        self.start()
+        stamp = self.__loop.time()
+        if self.__refreshed_at is None or \
+                (not self.__healthy and stamp - self.__refreshed_at >= self.MIN_RECHECK_INTERVAL):
+            await self.refresh()
+
+    async def choice(self, unwanted: str = None) -> Optional[str]:
+        """Choice healthy server preferring lowest-latency ones
+
+        :param unwanted: server that is returned only if there are no other healthy servers
+        :return: server or None if no one is reachable
+        """
+        await self.wait_checked()
+        if not self.__healthy:
+            return None
+        server = random.choice(self.__preferred)
+        if server == unwanted:
+            for other in self.__healthy:
+                if other != unwanted:
+                    return other
+        return server
+
+    def report_error(self, server: str, error: Union[str, Exception] = None):
+        """Mark server as unreachable until next successful check"""
+        server = extract_server_address(server)
+        status = self.__statuses.get(server)
+        if status is None:
+            return
+        status.up = False
+        status.last_error = repr(error) if isinstance(error, Exception) else error
+        self.__update_choice()
+        self.__wakeup.set()
+
+    async def refresh(self):
+        """Check all servers, concurrent callers share the same check"""
+        if self.__refreshing is None or self.__refreshing.done():
+            self.__refreshing = asyncio.ensure_future(self.__check_all(), loop=self.__loop)
+        await asyncio.shield(self.__refreshing)
+
+    async def __run(self):
+        while True:
+            try:
+                await self.refresh()
+            except Exception:
+                logging.exception('Error while check redis servers')
+            self.__wakeup.clear()
+            try:
+                await asyncio.wait_for(self.__wakeup.wait(), timeout=self.CHECK_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    async def __check_all(self):
+        await asyncio.gather(*[self.__check(status) for status in self.__statuses.values()])
+        self.__refreshed_at = self.__loop.time()
+        self.__update_choice()
+
+    async def __check(self, status: RedisNodeStatus):
+        started = self.__loop.time()
+        try:
+            redis = await asyncio.wait_for(RedisPools.redis(f'redis://{status.server}'), timeout=self.PING_TIMEOUT)
+            ok = await asyncio.wait_for(redis.ping(), timeout=self.PING_TIMEOUT)
+            if ok != b'PONG':
+                raise RedisConnectionError(f'Unexpected PING response: {ok}')
+        except Exception as e:
+            if status.up is not False:
+                logging.warning(f'Redis server {status.server} is unreachable: {repr(e)}')
+            status.up = False
+            status.last_error = repr(e)
+        else:
+            sample = self.__loop.time() - started
+            if status.latency is None or not status.up:
+                status.latency = sample
+            else:
+                status.latency = self.EWMA_ALPHA * sample + (1 - self.EWMA_ALPHA) * status.latency
+            status.up = True
+        status.checked_at = datetime.datetime.utcnow().timestamp()
+
+    def __update_choice(self):
+        healthy = sorted(
+            [status for status in self.__statuses.values() if status.up], key=lambda status: status.latency
+        )
+        self.__healthy = [status.server for status in healthy]
+        if healthy:
+            threshold = healthy[0].latency * self.LATENCY_TOLERANCE + self.LATENCY_SLACK
+            self.__preferred = [status.server for status in healthy if status.latency <= threshold]
+        else:
+            self.__preferred = []
+
+
+def build_hash_ring(servers: List[str] = None) -> HashRing:
+    """Ketama consistent hash ring over redis servers with virtual nodes and weights"""
+    nodes = {
+        server: {'vnodes': REDIS_VNODES, 'weight': REDIS_WEIGHTS.get(server, 1)}
+        for server in (servers or REDIS_SERVERS)
+    }
+    return HashRing(nodes=nodes, hash_fn='ketama')
+
+
+_hash_ring: Optional[HashRing] = None
+_hash_ring_key: Optional[tuple] = None
+
+
+def get_hash_ring() -> HashRing:
+    """Ring over configured redis servers, it is rebuilt only when servers list or weights were changed"""
+    global _hash_ring, _hash_ring_key
+    key = (tuple(REDIS_SERVERS), tuple(REDIS_WEIGHTS.items()), REDIS_VNODES)
+    if _hash_ring is None or key != _hash_ring_key:
+        _hash_ring = build_hash_ring(list(REDIS_SERVERS))
+        _hash_ring_key = key
+    return _hash_ring
+
+
+def extract_server_address(address: str) -> str:
+    """'redis://redis1/xxx' -> 'redis1'"""
+    return address.replace('redis://', '').split('/')[0]
+
+
 async def choice_server_address(unwanted: str = None) -> str:
     if unwanted:
-        unwanted = unwanted.replace('redis://', '')
-    items = REDIS_SERVERS[:]
-    random.shuffle(items)
-    if unwanted and unwanted in items:
-        excluded = [i for i in items if i != unwanted]
-        items = excluded + [unwanted]  # shift to tail unwanted address
-    for item in items:
-        addr = f'redis://{item}'
-        ok = await AsyncRedisChannel.check_address(addr)
-        if ok:
-            return addr
+        unwanted = extract_server_address(unwanted)
+    server = await GlobalRedisHealthMonitor.get().choice(unwanted)
+    if server:
+        return f'redis://{server}'
+    s = ','.join(REDIS_SERVERS)
+    raise NoOneReachableRedisServer(f'NoOne of redis servers [{s}] is reachable')
+
+
+async def choice_endpoint_server_address(endpoint_uid: str, unwanted: str = None, ring: HashRing = None) -> str:
+    """Consistent-hash placement of endpoint stream: owner of endpoint_uid on the ring,
+    next healthy server on the ring if owner is unreachable or unwanted
+    """
+    monitor = GlobalRedisHealthMonitor.get()
+    await monitor.wait_checked()
+    if unwanted:
+        unwanted = extract_server_address(unwanted)
+    for server in (ring or get_hash_ring()).iterate_nodes(endpoint_uid):
+        if server != unwanted and monitor.is_up(server):
+            return f'redis://{server}'
+    if unwanted and monitor.is_up(unwanted):
+        return f'redis://{unwanted}'
     s = ','.join(REDIS_SERVERS)
     raise NoOneReachableRedisServer(f'NoOne of redis servers [{s}] is reachable')
 
@@ -64,13 +418,13 @@ class AsyncRedisChannel:
         self.__name = address.split('/')[-1]
         self.__group_id = group_id
         self.__address = address.replace(f'/{self.__name}', '')
-        self.__aio_redis = None
+        self.__sub_conn: Optional[Tuple[aioredis.ConnectionsPool, aioredis.RedisConnection]] = None
         self.__queue = asyncio.Queue()
         self.__channel = None
         self.__loop = loop or asyncio.get_event_loop()
 
     def __del__(self):
-        if self.__aio_redis and self.__loop.is_running():
+        if self.__sub_conn and self.__loop.is_running():
             asyncio.ensure_future(self.__terminate(), loop=self.__loop)
 
     @property
@@ -83,31 +437,35 @@ class AsyncRedisChannel:
 
     @asynccontextmanager
     async def connection(self):
-        if self.__aio_redis and self.__aio_redis.closed:
-            create_connection = True
-        elif self.__aio_redis is None:
-            create_connection = True
-        else:
-            create_connection = False
-        if create_connection:
-            self.__channel = None
-            try:
-                self.__aio_redis = await aioredis.create_redis(self.__address, timeout=self.TIMEOUT)
-            except Exception:
-                raise RedisConnectionError(f'Error connection for {self.__address}')
-        yield self.__aio_redis
+        """Shared connections pool for publishing"""
+        try:
+            redis = await RedisPools.redis(self.__address)
+        except Exception:
+            raise RedisConnectionError(f'Error connection for {self.__address}')
+        try:
+            yield redis
+        except OSError:
+            raise RedisConnectionError(f'Error connection for {self.__address}')
 
     @asynccontextmanager
     async def channel(self):
+        """Subscription holds connection acquired from blocking pool until terminated"""
         try:
-            async with self.connection() as conn:
-                if self.__channel is None:
-                    try:
-                        res = await conn.subscribe(self.__name)
-                    except Exception:
-                        raise RedisConnectionError(f'Error subscribe to {self.__name}')
-                    self.__channel = res[0]
-                yield self.__channel
+            if self.__sub_conn and self.__sub_conn[1].closed:
+                await self.__terminate()
+            if self.__sub_conn is None:
+                try:
+                    self.__sub_conn = await RedisPools.acquire(self.__address)
+                except Exception:
+                    raise RedisConnectionError(f'Error connection for {self.__address}')
+            if self.__channel is None:
+                _, conn = self.__sub_conn
+                try:
+                    res = await aioredis.Redis(conn).subscribe(self.__name)
+                except Exception:
+                    raise RedisConnectionError(f'Error subscribe to {self.__name}')
+                self.__channel = res[0]
+            yield self.__channel
         except RedisConnectionError:
             await self.__terminate()
             raise
@@ -134,13 +492,33 @@ class AsyncRedisChannel:
         Return: True if almost one recipient received packet
         """
         async with self.connection() as conn:
-            packet = dict(kind='data', body=data)
+            packet = self.pack(data)
             try:
                 counter = await conn.publish_json(self.__name, packet)
             except aioredis.errors.RedisError:
                 raise RedisConnectionError()
             return counter > 0
 
+    async def write_many(self, items: List[Any]) -> bool:
+        """Send bulk of data to recipients in single pipelined round trip
+        Return: True if almost one recipient received all packets
+        """
+        if not items:
+            return True
+        async with self.connection() as conn:
+            pipe = conn.pipeline()
+            futures = [pipe.publish_json(self.__name, self.pack(data)) for data in items]
+            try:
+                await pipe.execute()
+                counters = [fut.result() for fut in futures]
+            except aioredis.errors.RedisError:
+                raise RedisConnectionError()
+            return all(counter > 0 for counter in counters)
+
+    @staticmethod
+    def pack(data) -> dict:
+        return dict(kind='data', body=data)
+
     async def close(self):
         async with self.connection() as conn:
             packet = dict(kind='close', body=None)
@@ -155,9 +533,8 @@ class AsyncRedisChannel:
         Example: address = redis://redis
         """
         try:
-            conn = await aioredis.create_redis(address, timeout=3)
-            ok = await conn.ping()
-            conn.close()
+            redis = await asyncio.wait_for(RedisPools.redis(address), timeout=3)
+            ok = await asyncio.wait_for(redis.ping(), timeout=3)
             return ok == b'PONG'
         except Exception as e:
             return False
@@ -171,15 +548,18 @@ class AsyncRedisChannel:
         self.__queue.put_nowait(msg)
 
     async def __terminate(self):
-        if self.__aio_redis:
-            self.__aio_redis.close()
+        if self.__sub_conn:
+            pool, conn = self.__sub_conn
             self.__channel = None
-            self.__aio_redis = None
+            self.__sub_conn = None
+            await RedisPools.release(pool, conn)
 
 
 class AsyncRedisGroup:
 
     TIMEOUT = 5
+    # Servers without XTRIM MINID support (Redis < 6.2): streams are trimmed by age with sweeper only
+    __minid_unsupported = set()
 
     def __init__(self, address: str, loop: asyncio.AbstractEventLoop = None, group_id: str = None, read_count: int = 1):
         """
@@ -190,16 +570,13 @@ class AsyncRedisGroup:
         self.__name = address.split('/')[-1]
         self.__group_id = group_id or '*'
         self.__address = address.replace(f'/{self.__name}', '')
-        self.__aio_redis = None
+        self.__consumer_created = False
         self.__mkstream = False
         self.__self_id = str(id(self))
         self.__loop = loop or asyncio.get_event_loop()
         self.__read_count = read_count or 1
         self.__queue = asyncio.Queue()
-
-    def __del__(self):
-        if self.__aio_redis and self.__loop.is_running():
-            asyncio.ensure_future(self.__terminate(), loop=self.__loop)
+        self.__created_groups = set()
 
     @property
     def address(self) -> str:
@@ -213,92 +590,270 @@ class AsyncRedisGroup:
     def self_id(self) -> str:
         return self.__self_id
 
+    @property
+    def server(self) -> str:
+        return self.__address
+
     @asynccontextmanager
-    async def connection(self):
-        if self.__aio_redis and self.__aio_redis.closed:
-            create_connection = True
-        elif self.__aio_redis is None:
-            create_connection = True
+    async def connection(self, blocking: bool = False):
+        """Connection for group operations
+
+        :param blocking: if True, connection is exclusively acquired from blocking pool (for XREADGROUP),
+          else non-blocking commands are sent via shared pool
+        """
+        if blocking:
+            try:
+                pool, conn = await RedisPools.acquire(self.__address)
+            except Exception as e:
+                raise RedisConnectionError(f'Error connection for {self.__address}')
+            try:
+                yield aioredis.Redis(conn)
+            except OSError:
+                raise RedisConnectionError(f'Error connection for {self.__address}')
+            finally:
+                await RedisPools.release(pool, conn)
         else:
-            create_connection = False
-        if create_connection:
             try:
-                self.__aio_redis = await aioredis.create_redis(self.__address, timeout=self.TIMEOUT)
+                redis = await RedisPools.redis(self.__address)
             except Exception as e:
                 raise RedisConnectionError(f'Error connection for {self.__address}')
-        yield self.__aio_redis
+            try:
+                yield redis
+            except OSError:
+                raise RedisConnectionError(f'Error connection for {self.__address}')
 
     async def read(self, timeout) -> (bool, Any):
+        ok, _, data = await self.read_entry(timeout)
+        return ok, data
+
+    async def read_entry(self, timeout) -> (bool, Optional[str], Any):
+        """Read data with stream entry id, entry id may be used to ack entry later
+
+        :return: success, entry-id, data
+        """
         logging.debug(f'.... AsyncRedisGroup.read(timeout: "{timeout}")')
         try:
             if not self.__queue.empty():
-                data = self.__queue.get_nowait()
-                return True, data
+                msg_id, data = self.__queue.get_nowait()
+                return True, msg_id, data
             else:
                 logging.debug(f'.... #1')
-                async with self.connection() as redis:
-                    try:
-                        logging.debug(f'.... #2')
-                        if timeout is None:
-                            await asyncio.wait_for(self.__async_reader_infinite(redis), timeout=None)
-                        else:
-                            await asyncio.wait_for(self.__async_reader(redis, timeout), timeout=timeout)
-                        if self.__queue.empty():
-                            raise ReadWriteTimeoutError
-                        else:
-                            data = self.__queue.get_nowait()
-                        logging.debug(f'.... #3')
-                        return True, data
-                    except asyncio.TimeoutError:
+                try:
+                    logging.debug(f'.... #2')
+                    if timeout is None:
+                        await asyncio.wait_for(self.__async_reader_infinite(), timeout=None)
+                    else:
+                        # XREADGROUP BLOCK is limited by timeout on server side, don't cancel
+                        # in-flight command to keep pooled connection reusable
+                        await asyncio.wait_for(self.__async_reader(timeout), timeout=timeout + self.TIMEOUT)
+                    if self.__queue.empty():
                         raise ReadWriteTimeoutError
-            return False, None
+                    else:
+                        msg_id, data = self.__queue.get_nowait()
+                    logging.debug(f'.... #3')
+                    return True, msg_id, data
+                except asyncio.TimeoutError:
+                    raise ReadWriteTimeoutError
+            return False, None, None
         except Exception as e:
             logging.exception(f'.... Exception in AsyncRedisGroup.read address: {self.__address}')
             raise
 
-    async def write(self, data) -> bool:
+    async def read_batch(self, count: int, timeout: Optional[float]) -> List[Tuple[str, Any]]:
+        """Read up to count entries with single XREADGROUP call
+
+        :param count: max entries count
+        :param timeout: max time to wait for entries, None - wait until almost one entry received
+        :return: list of (entry-id, data), empty list if timeout occurred
+        """
+        if self.__queue.empty():
+            if timeout is None:
+                await self.__async_reader_infinite(count)
+            else:
+                try:
+                    await asyncio.wait_for(self.__async_reader(timeout, count), timeout=timeout + self.TIMEOUT)
+                except asyncio.TimeoutError:
+                    pass
+        entries = []
+        while not self.__queue.empty() and len(entries) < count:
+            entries.append(self.__queue.get_nowait())
+        return entries
+
+    async def write(self, data, retention: StreamRetention = None) -> bool:
         """Send data to recipients
         Return: True if almost one recipient received packet
         """
+        await self.add(data, retention)
+        return True
+
+    async def add(self, data, retention: StreamRetention = None) -> str:
+        """Append data to stream
+
+        :param retention: if set, stream is trimmed in the same pipelined round trip
+        Return: stream entry id
+        """
         async with self.connection() as redis:
             try:
                 payload = {b'payload': json.dumps(data).encode()}
                 try:
                     logging.debug(f'.... start to redis.xadd stream: {self.__name}')
-                    msg_id = await redis.xadd(stream=self.__name, fields=payload)
+                    # Commands issued without awaiting in between are sent concurrently via shared pool
+                    fut_add = redis.xadd(
+                        stream=self.__name, fields=payload, max_len=retention.max_len if retention else None
+                    )
+                    min_id = None
+                    if retention and self.__address not in AsyncRedisGroup.__minid_unsupported:
+                        min_id = retention.min_id()
+                    fut_trim = redis.execute(b'XTRIM', self.__name, b'MINID', b'~', min_id) if min_id else None
+                    msg_id = await fut_add
+                    if fut_trim is not None:
+                        try:
+                            await fut_trim
+                        except aioredis.errors.ReplyError as e:
+                            # XTRIM MINID is supported since Redis 6.2
+                            AsyncRedisGroup.__minid_unsupported.add(self.__address)
+                            logging.warning(
+                                f'Streams of {self.__address} are not trimmed by age on write: {e}'
+                            )
                     logging.debug(f'.... stop to redis.xadd msg_id: {msg_id}')
                 except Exception as e:
                     logging.exception(f'Exception in write operation for {self.__address}')
                     raise
             except aioredis.errors.RedisError:
                 raise RedisConnectionError()
+            return msg_id.decode() if isinstance(msg_id, bytes) else msg_id
+
+    async def ensure_group(self, group_id: str) -> bool:
+        """Create consumers group receiving entries added from now on if it doesn't exist
+
+        Groups created with this instance are not checked again
+        Return: True if group exists
+        """
+        if group_id in self.__created_groups:
             return True
+        async with self.connection() as redis:
+            try:
+                await redis.xgroup_create(stream=self.__name, group_name=group_id, latest_id='$', mkstream=True)
+            except aioredis.errors.BusyGroupError:
+                pass
+            except aioredis.errors.RedisError:
+                raise RedisConnectionError()
+        self.__created_groups.add(group_id)
+        return True
+
+    async def ack(self, *msg_ids: str, publish: Dict[str, List[Any]] = None) -> int:
+        """Acknowledge stream entries for consumers group
+
+        :param publish: channel name -> packets to publish on the same redis server
+          in the same pipelined round trip (see AsyncRedisChannel.pack)
+        Return: number of acknowledged entries
+        """
+        if not msg_ids and not publish:
+            return 0
+        async with self.connection() as redis:
+            pipe = redis.pipeline()
+            fut_ack = pipe.xack(self.__name, self.__group_id, *msg_ids) if msg_ids else None
+            for channel_name, items in (publish or {}).items():
+                for data in items:
+                    pipe.publish_json(channel_name, AsyncRedisChannel.pack(data))
+            try:
+                await pipe.execute()
+                num = fut_ack.result() if fut_ack else 0
+            except aioredis.errors.RedisError:
+                raise RedisConnectionError()
+            return num
+
+    async def is_acked(self, msg_id: str) -> bool:
+        """Check stream entry was delivered and acknowledged by almost one consumers group
+        """
+        entry_id = parse_stream_entry_id(msg_id)
+        async with self.connection() as redis:
+            try:
+                groups = await redis.xinfo_groups(stream=self.__name)
+                for group in groups:
+                    last_delivered_id = parse_stream_entry_id(group[b'last-delivered-id'])
+                    if last_delivered_id < entry_id:
+                        # Not delivered to this group yet
+                        continue
+                    pending = await redis.xpending(
+                        self.__name, group[b'name'], start=msg_id, stop=msg_id, count=1
+                    )
+                    if not pending:
+                        return True
+            except aioredis.errors.ReplyError:
+                # Stream does not exists
+                return False
+            except aioredis.errors.RedisError:
+                raise RedisConnectionError()
+            return False
 
     async def close(self, later: bool = False):
-        if self.__aio_redis is not None:
+        if self.__consumer_created:
+            self.__consumer_created = False
+            if later:
+                if self.__loop and self.__loop.is_running():
+                    asyncio.ensure_future(self.__release(), loop=self.__loop)
+            else:
+                await self.__release()
+
+    async def reclaim(
+            self, min_idle_time: float, dead_consumer_idle: float, expire_grace: float, count: int = 100
+    ) -> (int, int, int):
+        """Claim entries stuck in pending lists of other consumers of the group to this consumer.
+
+        Claimed entries are redelivered via read operations of this consumer, expired entries are acknowledged
+        without delivery. Dead consumers (idle and without pending entries) are removed from group.
+
+        :param min_idle_time: (sec) min idle time of pending entry to be claimed
+        :param dead_consumer_idle: (sec) min idle time of consumer to consider it dead
+        :param expire_grace: (sec) entry of durable mode is expired if its expire_at is older than grace period,
+          entry with reverse channel is expired at expire_at: sender don't wait for ACK and fell back to FCM
+        :param count: max number of entries to claim per call
+        :return: reclaimed, expired, deleted consumers
+        """
+        min_idle_ms = math.floor(min_idle_time * 1000)
+        reclaimed, expired, deleted = 0, 0, 0
+        async with self.connection() as redis:
             try:
-                try:
-                    redis = self.__aio_redis
-                    if self.group_id:
-                        try:
-                            coro = redis.xgroup_delconsumer(
-                                stream=self.__name,
-                                group_name=self.group_id,
-                                consumer_name=self.__self_id
-                            )
-                            if later:
-                                if self.__loop and self.__loop.is_running():
-                                    asyncio.ensure_future(coro, loop=self.__loop)
-                            else:
-                                num = await coro
-                                logging.debug(f'xgroup_delconsumer returned: {num}')
-                        except Exception as e:
-                            logging.exception('Error in xgroup_delconsumer')
-                    self.__aio_redis.close()
-                finally:
-                    self.__aio_redis = None
-            except aioredis.errors.RedisError as e:
-                logging.exception(f'Exception on close: {self.address}')
+                pending = await redis.xpending(self.__name, self.__group_id, '-', '+', count)
+            except aioredis.errors.ReplyError:
+                # Stream or group does not exists
+                return reclaimed, expired, deleted
+            except aioredis.errors.RedisError:
+                raise RedisConnectionError()
+            self_id = self.__self_id.encode()
+            ids = [msg_id for msg_id, consumer, idle, _ in pending if consumer != self_id and idle >= min_idle_ms]
+            try:
+                if ids:
+                    # XCLAIM creates consumer in group
+                    self.__consumer_created = True
+                    claimed = await redis.xclaim(self.__name, self.__group_id, self.__self_id, min_idle_ms, *ids)
+                    stamp = datetime.datetime.utcnow().timestamp()
+                    expired_ids = []
+                    for msg_id, fields in claimed:
+                        msg_id = msg_id.decode() if isinstance(msg_id, bytes) else msg_id
+                        payload = fields.get(b'payload') if fields else None
+                        msg = json.loads(payload.decode()) if payload else None
+                        grace = expire_grace if msg and msg.get('reverse_channel') is None else 0
+                        if msg is None or msg.get('expire_at', stamp) + grace < stamp:
+                            expired_ids.append(msg_id)
+                        else:
+                            await self.__queue.put((msg_id, msg))
+                            reclaimed += 1
+                    if expired_ids:
+                        await redis.xack(self.__name, self.__group_id, *expired_ids)
+                        expired += len(expired_ids)
+                dead_idle_ms = math.floor(dead_consumer_idle * 1000)
+                consumers = await redis.xinfo_consumers(stream=self.__name, group_name=self.__group_id)
+                for consumer in consumers:
+                    if consumer[b'name'] != self_id and consumer[b'idle'] >= dead_idle_ms and consumer[b'pending'] == 0:
+                        await redis.xgroup_delconsumer(
+                            stream=self.__name, group_name=self.__group_id, consumer_name=consumer[b'name']
+                        )
+                        deleted += 1
+            except aioredis.errors.RedisError:
+                raise RedisConnectionError()
+        return reclaimed, expired, deleted
 
     @staticmethod
     async def check_address(address: str) -> bool:
@@ -306,9 +861,8 @@ class AsyncRedisGroup:
         Example: address = redis://redis
         """
         try:
-            conn = await aioredis.create_redis(address, timeout=3)
-            ok = await conn.ping()
-            conn.close()
+            redis = await asyncio.wait_for(RedisPools.redis(address), timeout=3)
+            ok = await asyncio.wait_for(redis.ping(), timeout=3)
             return ok == b'PONG'
         except Exception as e:
             return False
@@ -318,10 +872,15 @@ class AsyncRedisGroup:
             info = await redis.xinfo_consumers(stream=self.__name, group_name=self.__group_id)
             return info
 
-    async def __async_reader(self, redis: aioredis.Redis, read_timeout: float = None):
+    async def __async_reader(self, read_timeout: float = None, count: int = None):
+        async with self.connection(blocking=True) as redis:
+            await self.__async_reader_internal(redis, read_timeout, count)
+
+    async def __async_reader_internal(self, redis: aioredis.Redis, read_timeout: float = None, count: int = None):
         latest_ids = ['>']
         if self.__group_id and not self.__mkstream:
             self.__mkstream = await self.__ensure_group_exists(redis)
+        self.__consumer_created = True
         try:
             logging.debug(f'.... start to redis.xread_group group_name: {self.__group_id} consumer_name: {self.__self_id} streams: {[self.__name]}')
             read_timeout_milliseconds = math.floor(read_timeout * 1000) if read_timeout is not None else 0
@@ -330,7 +889,7 @@ class AsyncRedisGroup:
                 consumer_name=self.__self_id,
                 streams=[self.__name],
                 latest_ids=latest_ids,
-                count=self.__read_count,
+                count=count or self.__read_count,
                 timeout=read_timeout_milliseconds
             )
             logging.debug(f'.... stop to redis.xread_group  len(messages) = {len(messages)} group_name: {self.__group_id} consumer_name: {self.__self_id} streams: {[self.__name]}')
@@ -338,7 +897,8 @@ class AsyncRedisGroup:
                 payload = fields.get(b'payload')
                 if payload:
                     msg = json.loads(payload.decode())
-                    await self.__queue.put(msg)
+                    msg_id = msg_id.decode() if isinstance(msg_id, bytes) else msg_id
+                    await self.__queue.put((msg_id, msg))
             if len(messages) > 0:
                 return
         except Exception as e:
@@ -350,20 +910,48 @@ class AsyncRedisGroup:
             else:
                 raise
 
-    async def __async_reader_infinite(self, redis: aioredis.Redis):
+    async def __async_reader_infinite(self, count: int = None):
         read_timeout_sec = 1
         while self.__queue.empty():
-            await self.__async_reader(redis, read_timeout_sec)
+            # Blocking connection is returned to pool between reads, so waiting
+            # readers share pool when it is exhausted
+            await self.__async_reader(read_timeout_sec, count)
 
-    async def __terminate(self):
-        if self.__aio_redis:
-            self.__aio_redis.close()
-            self.__aio_redis = None
+    async def __release(self):
+        try:
+            async with self.connection() as redis:
+                await self.__release_consumer(redis)
+        except RedisConnectionError:
+            logging.exception(f'Exception on close: {self.address}')
+
+    async def __release_consumer(self, redis: aioredis.Redis):
+        try:
+            if self.group_id:
+                try:
+                    pending = await redis.xpending(self.__name, self.group_id, '-', '+', 1, self.__self_id)
+                    if pending:
+                        # Not acknowledged entries will be redelivered by PendingEntriesReclaimer
+                        logging.debug(f'consumer {self.__self_id} has pending entries, leave it in group')
+                    else:
+                        num = await redis.xgroup_delconsumer(
+                            stream=self.__name,
+                            group_name=self.group_id,
+                            consumer_name=self.__self_id
+                        )
+                        logging.debug(f'xgroup_delconsumer returned: {num}')
+                except Exception as e:
+                    logging.exception('Error in xgroup_delconsumer')
+        except aioredis.errors.RedisError as e:
+            logging.exception(f'Exception on close: {self.address}')
 
     async def __ensure_group_exists(self, redis: aioredis.Redis) -> bool:
         if redis:
             try:
-                success = await redis.xgroup_create(stream=self.__name, group_name=self.__group_id, mkstream=True)
+                # New group receives new entries only, entries added before first consumer connected
+                # are kept for default group created on push side (see ensure_group)
+                success = await redis.xgroup_create(
+                    stream=self.__name, group_name=self.__group_id, latest_id='$', mkstream=True
+                )
                 if not success:
                     return False
             except Exception as e:
@@ -377,29 +965,628 @@ class AsyncRedisGroup:
             return False
 
 
+class StreamsSweeper:
+    """Periodically trims endpoint streams according to retention policy and deletes
+    abandoned streams (without consumers and entries for retention max_age).
+
+    Consumer groups are deleted with stream, they are recreated by readers on next read and
+    default group is recreated on push side in durable mode, so entries added after deletion are not lost.
+    Redis < 6.2 is supported: streams are found with SCAN and TYPE, entries are trimmed by age with XDEL.
+    """
+
+    SCAN_COUNT = 1000
+
+    def __init__(self, servers: List[str] = None, retention: StreamRetention = None):
+        """
+        :param servers: redis servers addresses, for example ['redis1', 'redis2:6379']
+        """
+        self.__servers = servers or REDIS_SERVERS
+        self.__retention = retention or StreamRetention.default()
+        self.scanned = 0
+        self.trimmed = 0
+        self.deleted = 0
+        # Servers without SCAN TYPE (Redis < 6.0) and XTRIM MINID (Redis < 6.2) support
+        self.__scan_type_unsupported = set()
+        self.__minid_unsupported = set()
+
+    @property
+    def counters(self) -> dict:
+        return {
+            'scanned': self.scanned,
+            'trimmed': self.trimmed,
+            'deleted': self.deleted
+        }
+
+    async def sweep_once(self):
+        for server in self.__servers:
+            try:
+                redis = await RedisPools.redis(f'redis://{server}')
+            except Exception:
+                logging.exception(f'Error connection for {server}')
+                continue
+            try:
+                await self.__sweep_server(server, redis)
+            except (aioredis.errors.RedisError, OSError):
+                logging.exception(f'Error while sweep streams on {server}')
+
+    async def run(self, interval: float):
+        while True:
+            await self.sweep_once()
+            logging.info(f'Streams sweeper: {self.counters}')
+            await asyncio.sleep(interval)
+
+    async def __sweep_server(self, server: str, redis: aioredis.Redis):
+        cursor = b'0'
+        while True:
+            cursor, keys = await self.__scan_streams(server, redis, cursor)
+            for key in keys:
+                self.scanned += 1
+                await self.__sweep_stream(server, redis, key)
+            if cursor in (b'0', 0, '0'):
+                break
+
+    async def __scan_streams(self, server: str, redis: aioredis.Redis, cursor: bytes) -> (bytes, List[bytes]):
+        if server not in self.__scan_type_unsupported:
+            try:
+                return await redis.execute(b'SCAN', cursor, b'COUNT', self.SCAN_COUNT, b'TYPE', b'stream')
+            except aioredis.errors.ReplyError:
+                # SCAN TYPE is supported since Redis 6.0
+                self.__scan_type_unsupported.add(server)
+        cursor, keys = await redis.execute(b'SCAN', cursor, b'COUNT', self.SCAN_COUNT)
+        types = await asyncio.gather(*[redis.type(key) for key in keys])
+        return cursor, [key for key, typ in zip(keys, types) if typ == b'stream']
+
+    async def __sweep_stream(self, server: str, redis: aioredis.Redis, name: bytes):
+        # Writers trim streams approximately, sweeper trims exactly cause it runs rarely
+        if self.__retention.max_len is not None:
+            self.trimmed += await redis.xtrim(name, self.__retention.max_len, exact_len=True)
+        min_id = self.__retention.min_id()
+        if min_id is None:
+            return
+        self.trimmed += await self.__trim_by_age(server, redis, name, min_id)
+        groups = await redis.xinfo_groups(name)
+        if any(group[b'consumers'] > 0 or group[b'pending'] > 0 for group in groups):
+            return
+        info = await redis.xinfo_stream(name)
+        last_id = info.get(b'last-generated-id') or b'0-0'
+        if info[b'length'] == 0 and parse_stream_entry_id(last_id) < parse_stream_entry_id(min_id):
+            # Nobody listen and nobody write to stream for retention period
+            self.deleted += await redis.delete(name)
+
+    async def __trim_by_age(self, server: str, redis: aioredis.Redis, name: bytes, min_id: str) -> int:
+        if server not in self.__minid_unsupported:
+            try:
+                return await redis.execute(b'XTRIM', name, b'MINID', min_id)
+            except aioredis.errors.ReplyError:
+                # XTRIM MINID is supported since Redis 6.2
+                self.__minid_unsupported.add(server)
+        trimmed = 0
+        last_id = parse_stream_entry_id(min_id)
+        while True:
+            entries = await redis.xrange(name, start='-', stop=min_id, count=self.SCAN_COUNT)
+            ids = [entry_id for entry_id, _ in entries if parse_stream_entry_id(entry_id) < last_id]
+            if not ids:
+                return trimmed
+            trimmed += await redis.xdel(name, *ids)
+
+
+class StreamsRebalancer:
+    """Moves endpoints streams to their owners on consistent hash ring after redis servers were added or removed.
+
+    Migration of endpoint is online: consumer groups are created on target server, not processed entries are
+    copied, endpoint redis_pub_sub is updated, entries appended to old stream meanwhile are copied again and old
+    stream is deleted.
+
+    Listeners are not notified explicitly: reads of deleted stream fail with NOGROUP error. Websocket endpoint
+    listeners reload endpoint then and follow its new address, long polling requests are finished and clients
+    reconnect to new address. Entries read by old listeners after they were copied are delivered twice.
+    """
+
+    BATCH_SIZE = 500
+
+    def __init__(self, db: Database, memcached: aiomemcached.Client = None, ring: HashRing = None):
+        self.__repo = Repo(db, memcached)
+        self.__ring = ring or get_hash_ring()
+        self.scanned = 0
+        self.migrated = 0
+        self.copied = 0
+        self.skipped = 0
+        self.errors = 0
+
+    @property
+    def counters(self) -> dict:
+        return {
+            'scanned': self.scanned,
+            'migrated': self.migrated,
+            'copied': self.copied,
+            'skipped': self.skipped,
+            'errors': self.errors
+        }
+
+    async def rebalance(self, dry_run: bool = False, on_progress: Callable[[dict], Any] = None):
+        """Check all endpoints placement and migrate misplaced ones
+
+        :param dry_run: count misplaced endpoints without migration
+        :param on_progress: called with counters after every batch of endpoints
+        """
+        monitor = GlobalRedisHealthMonitor.get()
+        await monitor.wait_checked()
+        after_uid = None
+        while True:
+            endpoints = await load_endpoints(self.__repo.db, after_uid=after_uid, limit=self.BATCH_SIZE)
+            if not endpoints:
+                break
+            for endpoint in endpoints:
+                self.scanned += 1
+                address = endpoint['redis_pub_sub']
+                if not address:
+                    continue
+                current = extract_server_address(address)
+                target = self.__ring.get_node(endpoint['uid'])
+                if current == target:
+                    continue
+                if not monitor.is_up(target):
+                    logging.warning(f'Owner {target} of endpoint {endpoint["uid"]} is unreachable, skip it')
+                    self.skipped += 1
+                    continue
+                if dry_run:
+                    self.migrated += 1
+                    continue
+                try:
+                    await self.migrate(endpoint['uid'], address, target, copy_entries=monitor.is_up(current))
+                except (aioredis.errors.RedisError, OSError, RedisConnectionError):
+                    logging.exception(f'Error while migrate endpoint {endpoint["uid"]} to {target}')
+                    self.errors += 1
+            after_uid = endpoints[-1]['uid']
+            if on_progress:
+                on_progress(self.counters)
+
+    async def migrate(self, endpoint_uid: str, address: str, target: str, copy_entries: bool = True):
+        """Move endpoint stream to target server
+
+        :param address: current stream address, for example 'redis://redis1/xxx'
+        :param target: target server, for example 'redis2'
+        :param copy_entries: False if current server is unreachable and entries can't be copied
+        """
+        name = address.split('/')[-1]
+        new_address = f'redis://{target}/{name}'
+        dst = await RedisPools.redis(f'redis://{target}')
+        src = await RedisPools.redis(f'redis://{extract_server_address(address)}') if copy_entries else None
+        last_id = None
+        if src is not None:
+            start_id = await self.__prepare_target(src, dst, name)
+            if start_id is not None:
+                last_id = await self.__copy(src, dst, name, start_id)
+        await self.__repo.ensure_endpoint_exists(uid=endpoint_uid, redis_pub_sub=new_address)
+        # Address cached by RedisPush
+        await self.__repo.memcached.delete(endpoint_uid.encode())
+        if src is not None:
+            # Entries appended by writers that used old address while it was updated
+            await self.__copy(src, dst, name, last_id or '0-0', exclusive=last_id is not None)
+            await src.delete(name)
+        self.migrated += 1
+        logging.info(f'Endpoint {endpoint_uid} migrated: {address} -> {new_address}')
+
+    async def __prepare_target(self, src: aioredis.Redis, dst: aioredis.Redis, name: str) -> Optional[str]:
+        """Create consumer groups on target stream
+
+        :return: id of first entry to be copied: first not processed entry by almost one group
+        """
+        if not await src.exists(name):
+            return None
+        groups = await src.xinfo_groups(name)
+        if not groups:
+            return '0-0'
+        start_ids = []
+        for group in groups:
+            try:
+                await dst.xgroup_create(name, group[b'name'].decode(), latest_id='0', mkstream=True)
+            except aioredis.errors.BusyGroupError:
+                pass
+            count, min_pending_id, _, _ = await src.xpending(name, group[b'name'])
+            if count:
+                start_ids.append(parse_stream_entry_id(min_pending_id))
+            else:
+                ms, seq = parse_stream_entry_id(group[b'last-delivered-id'])
+                start_ids.append((ms, seq + 1))
+        ms, seq = min(start_ids)
+        return f'{ms}-{seq}'
+
+    async def __copy(self, src: aioredis.Redis, dst: aioredis.Redis, name: str, start_id: str, exclusive: bool = False) -> Optional[str]:
+        """Copy entries starting from start_id in batches
+
+        :return: id of last copied entry
+        """
+        last_id = None
+        while True:
+            entries = await src.xrange(name, start=start_id, stop='+', count=self.BATCH_SIZE)
+            if exclusive:
+                entries = [(msg_id, fields) for msg_id, fields in entries if msg_id.decode() != start_id]
+            if not entries:
+                return last_id
+            pipe = dst.pipeline()
+            for msg_id, fields in entries:
+                pipe.xadd(name, fields)
+            await pipe.execute()
+            self.copied += len(entries)
+            last_id = entries[-1][0].decode()
+            start_id, exclusive = last_id, True
+
+
+class InFlightTracker:
+    """Track messages enqueued to endpoint streams in durable delivery mode.
+
+    HTTP handler don't wait for device ACK, tracker checks stream entry was acknowledged
+    by consumers (XACK) when message expires and call fallback (FCM for example) if not.
+    Not acknowledged entries stay in stream for redelivery on next device connection.
+    """
+
+    CHECK_INTERVAL = 1
+    MAX_IN_FLIGHT = 100000
+
+    def __init__(self, loop: asyncio.AbstractEventLoop = None):
+        self.__loop = loop or asyncio.get_event_loop()
+        self.__heap: List[Tuple[float, int, str, str, Optional[Callable[[], Awaitable]]]] = []
+        self.__counter = 0
+        self.__channels: Dict[str, AsyncRedisGroup] = {}
+        self.__task: Optional[asyncio.Task] = None
+
+    @property
+    def size(self) -> int:
+        return len(self.__heap)
+
+    def track(
+            self, address: str, msg_id: str, expire_at: datetime.datetime,
+            on_expired: Callable[[], Awaitable] = None
+    ):
+        """Register stream entry
+
+        :param address: stream address, for example 'redis://redis1/xxx'
+        :param msg_id: stream entry id
+        :param expire_at: utc time when entry should be acknowledged
+        :param on_expired: coroutine function called if entry was not acknowledged in time
+        """
+        if len(self.__heap) >= self.MAX_IN_FLIGHT:
+            logging.warning(f'In-flight tracker is overflowed, entry {msg_id} [{address}] is not tracked')
+            return
+        self.__counter += 1
+        heapq.heappush(self.__heap, (expire_at.timestamp(), self.__counter, address, msg_id, on_expired))
+        if self.__task is None or self.__task.done():
+            self.__task = self.__loop.create_task(self.__run())
+
+    async def stop(self):
+        if self.__task and not self.__task.done():
+            self.__task.cancel()
+        self.__task = None
+        for ch in self.__channels.values():
+            await ch.close()
+        self.__channels.clear()
+
+    async def __run(self):
+        while self.__heap:
+            await asyncio.sleep(self.CHECK_INTERVAL)
+            stamp = datetime.datetime.utcnow().timestamp()
+            while self.__heap and self.__heap[0][0] <= stamp:
+                _, _, address, msg_id, on_expired = heapq.heappop(self.__heap)
+                try:
+                    acked = await self.__get_channel(address).is_acked(msg_id)
+                except RedisConnectionError:
+                    logging.exception(f'Error while check entry {msg_id} [{address}] is acknowledged')
+                    self.__channels.pop(address, None)
+                    acked = False
+                if not acked and on_expired:
+                    asyncio.ensure_future(self.__call_safe(on_expired, msg_id))
+
+    def __get_channel(self, address: str) -> AsyncRedisGroup:
+        ch = self.__channels.get(address)
+        if ch is None:
+            ch = AsyncRedisGroup(address, loop=self.__loop)
+            self.__channels[address] = ch
+        return ch
+
+    @staticmethod
+    async def __call_safe(on_expired: Callable[[], Awaitable], msg_id: str):
+        try:
+            await on_expired()
+        except Exception:
+            logging.exception(f'Error in expiration callback for entry {msg_id}')
+
+
+class PendingEntriesReclaimer:
+    """Background worker that redelivers stream entries stuck in pending lists of dead consumers.
+
+    Consumers register on listen and unregister on close. Every CHECK_INTERVAL one live consumer
+    per stream/group claims orphaned entries to itself (see AsyncRedisGroup.reclaim)
+    """
+
+    CHECK_INTERVAL = 30
+    MIN_IDLE_TIME = 60
+    DEAD_CONSUMER_IDLE = 300
+    EXPIRE_GRACE = STREAM_MAX_AGE or 60*60*24*7
+
+    def __init__(self, loop: asyncio.AbstractEventLoop = None):
+        self.__loop = loop or asyncio.get_event_loop()
+        self.__consumers: Dict[Tuple[str, str], List[AsyncRedisGroup]] = {}
+        self.__task: Optional[asyncio.Task] = None
+        self.reclaimed = 0
+        self.expired = 0
+        self.deleted_consumers = 0
+
+    @property
+    def counters(self) -> dict:
+        return {
+            'reclaimed': self.reclaimed,
+            'expired': self.expired,
+            'deleted_consumers': self.deleted_consumers
+        }
+
+    def register(self, consumer: AsyncRedisGroup):
+        key = (consumer.address, consumer.group_id)
+        self.__consumers.setdefault(key, []).append(consumer)
+        if self.__task is None or self.__task.done():
+            self.__task = self.__loop.create_task(self.__run())
+
+    def unregister(self, consumer: AsyncRedisGroup):
+        key = (consumer.address, consumer.group_id)
+        consumers = self.__consumers.get(key, [])
+        if consumer in consumers:
+            consumers.remove(consumer)
+        if not consumers:
+            self.__consumers.pop(key, None)
+
+    async def reclaim_once(self):
+        for key, consumers in list(self.__consumers.items()):
+            if not consumers:
+                continue
+            # Any live consumer of the group is suitable to redeliver entries
+            consumer = consumers[0]
+            try:
+                reclaimed, expired, deleted = await consumer.reclaim(
+                    min_idle_time=self.MIN_IDLE_TIME,
+                    dead_consumer_idle=self.DEAD_CONSUMER_IDLE,
+                    expire_grace=self.EXPIRE_GRACE
+                )
+            except RedisConnectionError:
+                logging.exception(f'Error while reclaim pending entries for {key}')
+                continue
+            self.reclaimed += reclaimed
+            self.expired += expired
+            self.deleted_consumers += deleted
+            if reclaimed or expired or deleted:
+                logging.info(
+                    f'Pending entries reclaimer for {key}: reclaimed={reclaimed} expired={expired} '
+                    f'deleted_consumers={deleted}'
+                )
+
+    async def stop(self):
+        if self.__task and not self.__task.done():
+            self.__task.cancel()
+        self.__task = None
+
+    async def __run(self):
+        while self.__consumers:
+            await asyncio.sleep(self.CHECK_INTERVAL)
+            await self.reclaim_once()
+
+
+class AckDispatcher:
+    """Process-wide dispatcher of device ACKs.
+
+    Holds one subscription per redis server to worker-unique reverse channel and routes
+    ACKs to waiting pushes by @id, so concurrent pushes to the same endpoint don't steal
+    each other answers and connections count don't depend on endpoints count.
+    """
+
+    CHANNEL_PREFIX = 'acks'
+
+    def __init__(self, loop: asyncio.AbstractEventLoop = None):
+        self.__loop = loop or asyncio.get_event_loop()
+        self.__name = f'{self.CHANNEL_PREFIX}-{uuid.uuid4().hex}'
+        self.__channels: Dict[str, AsyncRedisChannel] = {}
+        self.__readers: Dict[str, asyncio.Task] = {}
+        self.__subscribing: Dict[str, asyncio.Future] = {}
+        self.__futures: Dict[str, Tuple[str, asyncio.Future]] = {}
+        self.__subscriptions = 0
+
+    @property
+    def pending_count(self) -> int:
+        return len(self.__futures)
+
+    @property
+    def subscriptions(self) -> int:
+        """Number of reverse channel subscriptions made, one per server unless connection was lost"""
+        return self.__subscriptions
+
+    def reverse_address(self, forward_address: str) -> str:
+        """Reverse channel address on the same redis server as forward channel"""
+        server = self.__extract_server(forward_address)
+        return f'{server}/{self.__name}'
+
+    @asynccontextmanager
+    async def expect(self, forward_address: str, id_: str):
+        """Register waiter for ACK with @id, yields future that will be resolved with ACK packet
+        """
+        server = self.__extract_server(forward_address)
+        fut = self.__loop.create_future()
+        self.__futures[id_] = (server, fut)
+        try:
+            await self.__ensure_subscribed(server)
+            yield fut
+        finally:
+            self.__futures.pop(id_, None)
+
+    @staticmethod
+    async def wait(fut: asyncio.Future, timeout: float) -> dict:
+        try:
+            return await asyncio.wait_for(fut, timeout=timeout)
+        except asyncio.TimeoutError:
+            raise ReadWriteTimeoutError
+
+    async def close(self):
+        for tsk in self.__readers.values():
+            if not tsk.done():
+                tsk.cancel()
+        self.__readers.clear()
+        self.__channels.clear()
+
+    async def __ensure_subscribed(self, server: str):
+        tsk = self.__readers.get(server)
+        if tsk and not tsk.done():
+            return
+        # Concurrent callers share single subscribing, cancelled caller don't cancel it for others
+        subscribing = self.__subscribing.get(server)
+        if subscribing is None:
+            subscribing = asyncio.ensure_future(self.__subscribe(server), loop=self.__loop)
+            self.__subscribing[server] = subscribing
+            subscribing.add_done_callback(lambda _: self.__subscribing.pop(server, None))
+        await asyncio.shield(subscribing)
+
+    async def __subscribe(self, server: str):
+        ch = AsyncRedisChannel(f'{server}/{self.__name}', loop=self.__loop)
+        # Bootstrap subscription before any ACK may be sent
+        async with ch.channel():
+            pass
+        self.__subscriptions += 1
+        self.__channels[server] = ch
+        self.__readers[server] = self.__loop.create_task(self.__reader(server, ch))
+
+    async def __reader(self, server: str, ch: AsyncRedisChannel):
+        try:
+            while True:
+                ok, packet = await ch.read(timeout=None)
+                if not ok:
+                    break
+                if isinstance(packet, dict) and packet.get('@type') == ACK_MSG_TYPE:
+                    _, fut = self.__futures.get(packet.get('@id'), (None, None))
+                    if fut is not None and not fut.done():
+                        fut.set_result(packet)
+        except RedisConnectionError as e:
+            logging.exception(f'ACK dispatcher lost connection to {server}')
+            for srv, fut in list(self.__futures.values()):
+                if srv == server and not fut.done():
+                    fut.set_exception(RedisConnectionError(str(e)))
+        finally:
+            self.__channels.pop(server, None)
+            if self.__readers.get(server) is asyncio.current_task():
+                del self.__readers[server]
+
+    @staticmethod
+    def __extract_server(address: str) -> str:
+        name = address.split('/')[-1]
+        return address[:-len(name)-1]
+
+
 class RedisPush:
 
     EXPIRE_SEC = 60
     MAX_CHANNELS = 1000
     REVERSE_FORWARD_CH_EQUAL = True
 
-    def __init__(self, db: Database, memcached: aiomemcached.Client = None, channels_cache: ExpiringDict = None):
+    def __init__(
+            self, db: Database, memcached: aiomemcached.Client = None, channels_cache: ExpiringDict = None,
+            tracker: InFlightTracker = None, dispatcher: AckDispatcher = None, retention: StreamRetention = None,
+            default_group: Callable[[str], str] = None
+    ):
+        """
+        :param tracker: if set, push operates in durable mode: message is considered as delivered
+          when it is enqueued to endpoint stream, device ACK is processed by tracker asynchronously
+        :param dispatcher: if set, device ACKs are received via shared dispatcher
+          instead of dedicated reverse channel per endpoint
+        :param retention: default retention policy of endpoint streams
+        :param default_group: (durable mode only) endpoint id -> consumers group created before enqueue,
+          so messages pushed before device connected are delivered to this group, RedisPull.DEFAULT_GROUP_ID by default
+        """
         self.__db = db
         self.__endpoints_cache = memcached or aiomemcached.Client(host=MEMCACHED_SERVER, pool_maxsize=self.MAX_CHANNELS)
         self.__channels_cache = channels_cache or ExpiringDict(max_len=self.MAX_CHANNELS, max_age_seconds=self.EXPIRE_SEC)
-
-    async def push(self, endpoint_id: str, message: dict, ttl: int) -> bool:
+        self.__tracker = tracker
+        self.__dispatcher = dispatcher
+        self.__retention = retention or StreamRetention.default()
+        self.__default_group = default_group or (lambda endpoint_id: RedisPull.DEFAULT_GROUP_ID)
+
+    async def push(
+            self, endpoint_id: str, message: dict, ttl: int, on_expired: Callable[[], Awaitable] = None,
+            retention: StreamRetention = None, span: Span = None
+    ) -> bool:
+        """Push message to endpoint
+
+        :param on_expired: (durable mode only) coroutine function called by tracker
+          if message was not acknowledged by device in ttl
+        :param retention: retention policy of endpoint stream, default policy is used if not set
+        :param span: delivery span to record stages: message was enqueued and device ACK was received
+        """
         expire_at = datetime.datetime.utcnow() + datetime.timedelta(seconds=ttl)
+        retention = retention or self.__retention
         for cnt in range(2):
             try:
-                success = await self.__push_internal(endpoint_id, message, expire_at)
+                if self.__tracker:
+                    success = await self.__enqueue_internal(
+                        endpoint_id, message, expire_at, retention, on_expired, span
+                    )
+                elif self.__dispatcher:
+                    success = await self.__push_dispatched(endpoint_id, message, expire_at, retention, span)
+                else:
+                    success = await self.__push_internal(endpoint_id, message, expire_at, retention, span)
                 return success
             except RedisConnectionError:
                 raise
             except ReadWriteTimeoutError:
                 return False
 
-    async def __push_internal(self, endpoint_id: str, message, expire_at: datetime) -> bool:
+    async def __enqueue_internal(
+            self, endpoint_id: str, message, expire_at: datetime, retention: StreamRetention,
+            on_expired: Callable[[], Awaitable] = None, span: Span = None
+    ) -> bool:
+        for ignore_cache in [False, True]:
+            forward_channel, _ = await self.__get_channel(endpoint_id, ignore_cache)
+            if forward_channel:
+                request = {
+                    '@id': uuid.uuid4().hex,
+                    '@type': PUSH_MSG_TYPE,
+                    'reverse_channel': None,
+                    'expire_at': expire_at.timestamp(),
+                    'message': message
+                }
+                async with self.__clean_on_disconnect(endpoint_id, forward_channel):
+                    await forward_channel.ensure_group(self.__default_group(endpoint_id))
+                    msg_id = await forward_channel.add(request, retention)
+                if span:
+                    span.event('Enqueued')
+                self.__tracker.track(forward_channel.address, msg_id, expire_at, on_expired)
+                return True
+        return False
+
+    async def __push_dispatched(
+            self, endpoint_id: str, message, expire_at: datetime, retention: StreamRetention, span: Span = None
+    ) -> bool:
+        for ignore_cache in [False, True]:
+            forward_channel, _ = await self.__get_channel(endpoint_id, ignore_cache)
+            if forward_channel:
+                request = {
+                    '@id': uuid.uuid4().hex,
+                    '@type': PUSH_MSG_TYPE,
+                    'reverse_channel': self.__dispatcher.reverse_address(forward_channel.address),
+                    'expire_at': expire_at.timestamp(),
+                    'message': message
+                }
+                async with self.__clean_on_disconnect(endpoint_id, forward_channel):
+                    async with self.__dispatcher.expect(forward_channel.address, request['@id']) as fut:
+                        success = await forward_channel.write(request, retention)
+                        if not success:
+                            return False
+                        if span:
+                            span.event('Enqueued')
+                        # Wait for answer
+                        delta = expire_at - datetime.datetime.utcnow()
+                        response = await self.__dispatcher.wait(fut, max(delta.total_seconds(), 0))
+                        if span:
+                            span.event('Acked')
+                        return response['status'] is True
+        return False
+
+    async def __push_internal(
+            self, endpoint_id: str, message, expire_at: datetime, retention: StreamRetention, span: Span = None
+    ) -> bool:
         for ignore_cache in [False, True]:
             forward_channel, reverse_channel = await self.__get_channel(endpoint_id, ignore_cache)
             if forward_channel and reverse_channel:
@@ -410,14 +1597,16 @@ class RedisPush:
                     '@id': uuid.uuid4().hex,
                     '@type': PUSH_MSG_TYPE,
                     'reverse_channel': reverse_channel.address,
-                    'expire_at': expire_at.utcnow().timestamp(),
+                    'expire_at': expire_at.timestamp(),
                     'message': message
                 }
                 async with self.__clean_on_disconnect(endpoint_id, forward_channel):
                     # Bootstrap reverse-channel
                     async with reverse_channel.channel():
-                        success = await forward_channel.write(request)
+                        success = await forward_channel.write(request, retention)
                 if success:
+                    if span:
+                        span.event('Enqueued')
                     # Wait for answer
                     while datetime.datetime.utcnow() <= expire_at:
                         delta = expire_at - datetime.datetime.utcnow()
@@ -425,6 +1614,8 @@ class RedisPush:
                             ok, response = await reverse_channel.read(delta.total_seconds())
                         if ok:
                             if response.get('@type') == ACK_MSG_TYPE and response['@id'] == request['@id']:
+                                if span:
+                                    span.event('Acked')
                                 return response['status'] is True
                             else:
                                 logging.warning(f"Expected @id={request['@id']}, Received @id={response['@id']}")
@@ -475,7 +1666,8 @@ class RedisPush:
     async def __clean_on_disconnect(self, endpoint_id: str, channel: AsyncRedisChannel):
         try:
             yield
-        except RedisConnectionError:
+        except RedisConnectionError as e:
+            GlobalRedisHealthMonitor.get().report_error(channel.address, e)
             await self.__endpoints_cache.delete(endpoint_id.encode())
             if channel.address in self.__channels_cache:
                 del self.__channels_cache[channel.address]
@@ -494,12 +1686,15 @@ class RedisPull:
 
         def __init__(
                 self, id_: str, message: dict, expire_at: float,
-                reverse_channel_addr: str, reverse_channels_cache: ExpiringDict
+                reverse_channel_addr: Optional[str], reverse_channels_cache: ExpiringDict,
+                entry_id: str = None, group: AsyncRedisGroup = None
         ):
             self.__id = id_
             self.__message = message
             self.__reverse_channel_addr = reverse_channel_addr
             self.__reverse_channels_cache = reverse_channels_cache
+            self.__entry_id = entry_id
+            self.__group = group
             self.expire_at = expire_at
 
         def __str__(self):
@@ -510,60 +1705,148 @@ class RedisPull:
             return self.__message
 
         @property
-        def reverse_channel_addr(self) -> str:
+        def reverse_channel_addr(self) -> Optional[str]:
             return self.__reverse_channel_addr
 
+        @property
+        def entry_id(self) -> Optional[str]:
+            return self.__entry_id
+
+        @property
+        def ack_packet(self) -> dict:
+            return {
+                '@id': self.__id,
+                '@type': ACK_MSG_TYPE,
+                'status': True
+            }
+
         async def ack(self) -> bool:
+            if self.__group and self.__entry_id:
+                try:
+                    await self.__group.ack(self.__entry_id)
+                except RedisConnectionError:
+                    logging.exception(f'Error while ack stream entry {self.__entry_id}')
+                    if not self.__reverse_channel_addr:
+                        return False
+            if not self.__reverse_channel_addr:
+                # Durable delivery mode: sender don't wait for answer
+                return self.__group is not None
             channel = self.__reverse_channels_cache.get(self.__reverse_channel_addr)
             if not channel:
                 channel = AsyncRedisChannel(self.__reverse_channel_addr)
                 self.__reverse_channels_cache[self.__reverse_channel_addr] = channel
             try:
-                success = await channel.write(data={
-                    '@id': self.__id,
-                    '@type': ACK_MSG_TYPE,
-                    'status': True
-                })
+                success = await channel.write(data=self.ack_packet)
                 return success
             except RedisConnectionError:
                 del self.__reverse_channels_cache[self.__reverse_channel_addr]
                 return False
 
-    def __init__(self):
+    def __init__(self, reclaimer: PendingEntriesReclaimer = None):
         self.__channels = ExpiringDict(max_len=5, max_age_seconds=RedisPush.EXPIRE_SEC)
+        self.__reclaimer = reclaimer
 
     class Listener:
 
-        def __init__(self, channel: AsyncRedisGroup, reverse_channels_cache: ExpiringDict):
+        def __init__(
+                self, channel: AsyncRedisGroup, reverse_channels_cache: ExpiringDict,
+                reclaimer: PendingEntriesReclaimer = None
+        ):
             self.__channel = channel
             self.__reverse_channels_cache = reverse_channels_cache
+            self.__reclaimer = reclaimer
+            if reclaimer:
+                reclaimer.register(channel)
 
         async def get_one(self):
             while True:
                 try:
-                    ok, payload = await self.__channel.read(timeout=None)
+                    ok, entry_id, payload = await self.__channel.read_entry(timeout=None)
                     if ok:
-                        if payload.get('@type') == PUSH_MSG_TYPE:
-                            request = RedisPull.Request(
-                                id_=payload['@id'],
-                                message=payload['message'],
-                                expire_at=payload['expire_at'],
-                                reverse_channel_addr=payload['reverse_channel'],
-                                reverse_channels_cache=self.__reverse_channels_cache
-                            )
+                        request = self.__build_request(entry_id, payload)
+                        if request:
                             return True, request
                     else:
                         return False, None
                 except RedisConnectionError:
                     return False, None
 
+        async def get_batch(self, max_count: int, max_wait: float = None) -> (bool, List['RedisPull.Request']):
+            """Read up to max_count requests with single XREADGROUP round trip
+
+            :param max_count: max requests count in batch
+            :param max_wait: max time to wait for requests, None - wait until almost one request received
+            :return: not_closed, requests
+            """
+            while True:
+                try:
+                    entries = await self.__channel.read_batch(count=max_count, timeout=max_wait)
+                except RedisConnectionError:
+                    return False, []
+                requests = []
+                for entry_id, payload in entries:
+                    request = self.__build_request(entry_id, payload)
+                    if request:
+                        requests.append(request)
+                if requests or max_wait is not None:
+                    return True, requests
+
+        async def ack_batch(self, requests: List['RedisPull.Request']) -> bool:
+            """Acknowledge requests: XACK of stream entries and ACK packets for reverse channels
+            hosted on the same redis server are sent in single pipelined round trip
+            """
+            entry_ids = [req.entry_id for req in requests if req.entry_id]
+            same_server = {}
+            other_servers = {}
+            for req in requests:
+                addr = req.reverse_channel_addr
+                if addr:
+                    name = addr.split('/')[-1]
+                    if addr[:-len(name)-1] == self.__channel.server:
+                        same_server.setdefault(name, []).append(req.ack_packet)
+                    else:
+                        other_servers.setdefault(addr, []).append(req.ack_packet)
+            success = True
+            try:
+                await self.__channel.ack(*entry_ids, publish=same_server)
+            except RedisConnectionError:
+                logging.exception(f'Error while ack stream entries for {self.__channel.address}')
+                success = False
+            for addr, packets in other_servers.items():
+                channel = self.__reverse_channels_cache.get(addr)
+                if not channel:
+                    channel = AsyncRedisChannel(addr)
+                    self.__reverse_channels_cache[addr] = channel
+                try:
+                    await channel.write_many(packets)
+                except RedisConnectionError:
+                    del self.__reverse_channels_cache[addr]
+                    success = False
+            return success
+
         async def close(self):
             if self.__channel:
+                if self.__reclaimer:
+                    self.__reclaimer.unregister(self.__channel)
                 await self.__channel.close()
 
         def __aiter__(self):
             return self
 
+        def __build_request(self, entry_id: str, payload: dict) -> Optional['RedisPull.Request']:
+            if payload.get('@type') == PUSH_MSG_TYPE:
+                return RedisPull.Request(
+                    id_=payload['@id'],
+                    message=payload['message'],
+                    expire_at=payload['expire_at'],
+                    reverse_channel_addr=payload.get('reverse_channel'),
+                    reverse_channels_cache=self.__reverse_channels_cache,
+                    entry_id=entry_id,
+                    group=self.__channel
+                )
+            else:
+                return None
+
         @asyncio.coroutine
         def __anext__(self):
             """Asyncio iterator interface for listener"""
@@ -574,5 +1857,5 @@ class RedisPull:
         if not group_id:
             group_id = self.DEFAULT_GROUP_ID
         channel = AsyncRedisGroup(address, group_id=group_id, read_count=read_count)
-        listener = self.Listener(channel, self.__channels)
+        listener = self.Listener(channel, self.__channels, self.__reclaimer)
         return listener
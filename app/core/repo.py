@@ -1,12 +1,192 @@
 import json
+import math
+import time
+import random
+import struct
+import asyncio
 import logging
-from typing import Union, Optional, Any
+from typing import Union, Optional, Any, Dict, Callable, Awaitable, Tuple, List
 
 import aiomemcached
 from databases import Database
+from expiringdict import ExpiringDict
 
 import app.db.crud
-from app.settings import MEMCACHED as MEMCACHED_SERVER
+from app.settings import MEMCACHED as MEMCACHED_SERVER, REPO_CACHE_CODEC
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class CacheCodec:
+    """Serializer of cached values, NAME is part of cache keys prefix so values encoded
+    with different codecs never meet each other
+    """
+
+    NAME = None
+
+    def encode(self, value: Union[dict, str, list]) -> bytes:
+        raise NotImplementedError
+
+    def decode(self, data: bytes) -> Union[dict, str, list]:
+        raise NotImplementedError
+
+
+class JsonCacheCodec(CacheCodec):
+    """Single-pass JSON, first byte is type tag: strings are stored as is"""
+
+    NAME = 'j'
+    TAG_STR = ord('s')
+    TAG_JSON = ord('j')
+
+    def encode(self, value: Union[dict, str, list]) -> bytes:
+        if type(value) is str:
+            return b's' + value.encode()
+        else:
+            return b'j' + json.dumps(value, separators=(',', ':')).encode()
+
+    def decode(self, data: bytes) -> Union[dict, str, list]:
+        tag = data[0]
+        if tag == self.TAG_STR:
+            return data[1:].decode()
+        elif tag == self.TAG_JSON:
+            return json.loads(data[1:])
+        else:
+            raise ValueError(f'Unexpected cache value tag: {tag}')
+
+
+class MsgpackCacheCodec(CacheCodec):
+    """Compact binary encoding, requires msgpack package"""
+
+    NAME = 'm'
+
+    def __init__(self):
+        if msgpack is None:
+            raise RuntimeError('msgpack package is not installed')
+
+    def encode(self, value: Union[dict, str, list]) -> bytes:
+        return msgpack.packb(value, use_bin_type=True)
+
+    def decode(self, data: bytes) -> Union[dict, str, list]:
+        return msgpack.unpackb(data, raw=False)
+
+
+CACHE_CODECS = {
+    'json': JsonCacheCodec,
+    'msgpack': MsgpackCacheCodec
+}
+
+
+def get_cache_codec(name: str = None) -> CacheCodec:
+    """Codec by name, REPO_CACHE_CODEC setting by default"""
+    name = name or REPO_CACHE_CODEC
+    if name not in CACHE_CODECS:
+        raise RuntimeError(f'Unknown cache codec "{name}", expected one of: {", ".join(CACHE_CODECS.keys())}')
+    return CACHE_CODECS[name]()
+
+
+class RepoLocalCache:
+    """Per worker in-process cache (LRU with TTL) in front of memcached.
+
+    Entries are stored encoded as in memcached, so cached values can't be mutated by callers.
+    Deleted keys are broadcast to other workers via bus topic.
+    """
+
+    MAX_LEN = 10000
+    TTL = 30
+    INVALIDATION_TOPIC = 'repo.cache.invalidate'
+    RECONNECT_DELAY = 5
+    COUNTERS = ('l1_hits', 'memcached_hits', 'misses', 'negative_hits', 'coalesced', 'early_refreshes')
+
+    def __init__(
+            self, max_len: int = None, ttl: int = None, loop: asyncio.AbstractEventLoop = None, topic: str = None
+    ):
+        """
+        :param topic: bus topic of invalidations, caches with the same topic are kept consistent across workers
+        """
+        self.__loop = loop or asyncio.get_event_loop()
+        self.__ttl = ttl or self.TTL
+        self.__topic = topic or self.INVALIDATION_TOPIC
+        self.__entries = ExpiringDict(max_len=max_len or self.MAX_LEN, max_age_seconds=self.__ttl)
+        self.__counters: Dict[str, Dict[str, int]] = {}
+        self.__listener: Optional[asyncio.Task] = None
+        self.__flights: Dict[str, asyncio.Task] = {}
+
+    @property
+    def counters(self) -> Dict[str, Dict[str, int]]:
+        """Counters per namespace: l1_hits, memcached_hits, misses, negative_hits, coalesced, early_refreshes"""
+        return {namespace: dict(items) for namespace, items in self.__counters.items()}
+
+    def get(self, key: str) -> Optional[bytes]:
+        self.start_listening()
+        return self.__entries.get(key)
+
+    def set(self, key: str, value: bytes, ttl: int = None):
+        """
+        :param ttl: entry lifetime if it is shorter than cache TTL
+        """
+        if ttl and ttl < self.__ttl:
+            # Entry is aged on insert to expire earlier
+            self.__entries.__setitem__(key, value, set_time=time.time() - (self.__ttl - ttl))
+        else:
+            self.__entries[key] = value
+
+    def delete(self, key: str):
+        self.__entries.pop(key, None)
+
+    def count(self, namespace: Optional[str], name: str):
+        items = self.__counters.setdefault(namespace or '', {counter: 0 for counter in self.COUNTERS})
+        items[name] += 1
+
+    def flight(self, key: str, loader: Callable[[], Awaitable], namespace: str = None) -> asyncio.Task:
+        """Single-flight: concurrent calls with the same key share one running loader task
+
+        Await it via asyncio.shield so cancelled caller don't cancel loading for others
+        """
+        tsk = self.__flights.get(key)
+        if tsk is None:
+            tsk = self.__loop.create_task(loader())
+            self.__flights[key] = tsk
+            tsk.add_done_callback(lambda _: self.__flights.pop(key, None))
+        else:
+            self.count(namespace, 'coalesced')
+        return tsk
+
+    async def invalidate(self, key: str):
+        """Delete key in this worker and broadcast deletion to other workers"""
+        self.delete(key)
+        from app.core.bus import Bus
+        try:
+            await Bus().publish(self.__topic, key.encode())
+        except Exception:
+            logging.exception(f'Error while broadcast cache invalidation for {key}')
+
+    def start_listening(self):
+        if self.__listener is None or self.__listener.done():
+            self.__listener = self.__loop.create_task(self.__listen())
+
+    async def stop(self):
+        if self.__listener and not self.__listener.done():
+            self.__listener.cancel()
+        self.__listener = None
+
+    async def __listen(self):
+        from app.core.bus import Bus, BusOverflowError
+        while True:
+            try:
+                async for key in Bus().listen(self.__topic):
+                    self.delete(key.decode())
+            except BusOverflowError:
+                logging.warning('Cache invalidations were not read in time, local cache is cleared')
+                self.__entries.clear()
+                continue
+            except Exception:
+                logging.exception('Error while listen for cache invalidations')
+                # Keys invalidated meanwhile are expired by TTL
+                self.__entries.clear()
+            await asyncio.sleep(self.RECONNECT_DELAY)
 
 
 class Repo:
@@ -21,11 +201,42 @@ class Repo:
     NAMESPACE_ENDPOINTS_VERKEYS = 'endpoints_verkeys'
     NAMESPACE_ROUTING_KEYS = 'routing_keys'
     NAMESPACE_GLOBAL_SETTINGS = 'global_settings'
+    # Negative cache: markers of unknown endpoints and routing keys
+    NAMESPACE_MISSING_ENDPOINTS = 'missing_endpoints'
+    NAMESPACE_MISSING_ROUTING_KEYS = 'missing_routing_keys'
     MEMCACHED_TIMEOUT = 60
+    NEGATIVE_CACHE_TIMEOUT = 5
+    # Increment on changes of cached values layout, keys are prefixed with version and codec name
+    CACHE_VERSION = 3
+    # Values of legacy workers are cached with unprefixed keys
+    LEGACY_CACHE_VERSION = 1
+    # Cached entry header: expiration timestamp and duration (sec) of loading from database
+    ENTRY_HEADER = struct.Struct('!If')
+    # Probabilistic early refresh (XFetch): the greater beta the earlier entries are refreshed before expiration
+    EARLY_REFRESH_BETA = 1.0
+    REFRESH_FLIGHT_PREFIX = 'refresh:'
 
-    def __init__(self, db: Database, memcached: aiomemcached.Client = None):
+    def __init__(
+            self, db: Database, memcached: aiomemcached.Client = None,
+            local_cache: RepoLocalCache = None, codec: CacheCodec = None
+    ):
+        """
+        :param local_cache: in-process cache in front of memcached, worker-wide cache is used by default
+        :param codec: serializer of cached values, REPO_CACHE_CODEC setting by default
+        """
         self.__db = db
+        self.__codec = codec or get_cache_codec()
+        self.__key_prefix = f'v{self.CACHE_VERSION}{self.__codec.NAME}:'
+        # Namespaces with entries shorter living than local cache TTL
+        self.__local_ttls = {
+            self.NAMESPACE_MISSING_ENDPOINTS: self.NEGATIVE_CACHE_TIMEOUT,
+            self.NAMESPACE_MISSING_ROUTING_KEYS: self.NEGATIVE_CACHE_TIMEOUT
+        }
         self.__memcached = memcached or aiomemcached.Client(host=MEMCACHED_SERVER, pool_minsize=1)
+        if local_cache is None:
+            from app.core.singletons import GlobalRepoLocalCache
+            local_cache = GlobalRepoLocalCache.get()
+        self.__local_cache = local_cache
 
     @property
     def db(self) -> Database:
@@ -35,6 +246,14 @@ class Repo:
     def memcached(self) -> aiomemcached.Client:
         return self.__memcached
 
+    @property
+    def local_cache(self) -> RepoLocalCache:
+        return self.__local_cache
+
+    @property
+    def codec(self) -> CacheCodec:
+        return self.__codec
+
     async def ensure_agent_exists(self, did: str, verkey: str, metadata: dict = None, fcm_device_id: str = None):
         await self._delete_cache(did, namespace=self.NAMESPACE_AGENTS)
         agent_verkey = await self._get_cache(did, namespace=self.NAMESPACE_AGENTS_VERKEYS)
@@ -44,29 +263,25 @@ class Repo:
         await app.db.crud.ensure_agent_exists(self.__db, did, verkey, metadata, fcm_device_id)
 
     async def load_agent(self, did: str) -> Optional[dict]:
-        cached = await self._get_cache(did, namespace=self.NAMESPACE_AGENTS)
-        if cached:
-            return cached
-        else:
+
+        async def fetch():
             agent = await app.db.crud.load_agent(self.__db, did)
-            if agent:
-                await self._set_cache(did, agent, namespace=self.NAMESPACE_AGENTS)
-                if agent['verkey']:
-                    await self._set_cache(did, agent['verkey'], namespace=self.NAMESPACE_AGENTS_VERKEYS)
+            if agent and agent['verkey']:
+                await self._set_cache(did, agent['verkey'], namespace=self.NAMESPACE_AGENTS_VERKEYS)
             return agent
 
+        return await self._load_cached(did, self.NAMESPACE_AGENTS, fetch)
+
     async def load_agent_via_verkey(self, verkey: str) -> Optional[dict]:
-        cached = await self._get_cache(verkey, namespace=self.NAMESPACE_AGENTS)
-        if cached:
-            return cached
-        else:
+
+        async def fetch():
             agent = await app.db.crud.load_agent_via_verkey(self.__db, verkey)
-            if agent:
-                await self._set_cache(verkey, agent, namespace=self.NAMESPACE_AGENTS)
-                if agent['verkey']:
-                    await self._set_cache(agent['did'], agent['verkey'], namespace=self.NAMESPACE_AGENTS_VERKEYS)
+            if agent and agent['verkey']:
+                await self._set_cache(agent['did'], agent['verkey'], namespace=self.NAMESPACE_AGENTS_VERKEYS)
             return agent
 
+        return await self._load_cached(verkey, self.NAMESPACE_AGENTS, fetch)
+
     async def ensure_endpoint_exists(
             self, uid: str, redis_pub_sub: str = None,
             agent_id: str = None, verkey: str = None, fcm_device_id: str = None
@@ -77,117 +292,270 @@ class Repo:
             await self._delete_cache(endpoint_verkey, namespace=self.NAMESPACE_AGENTS)
             await self._delete_cache(uid, namespace=self.NAMESPACE_AGENTS_VERKEYS)
         await app.db.crud.ensure_endpoint_exists(self.__db, uid, redis_pub_sub, agent_id, verkey, fcm_device_id)
+        # After write: concurrent lookup may put marker meanwhile
+        await self._delete_cache(uid, namespace=self.NAMESPACE_MISSING_ENDPOINTS)
 
     async def load_endpoint(self, uid: str) -> Optional[dict]:
-        cached = await self._get_cache(uid, namespace=self.NAMESPACE_ENDPOINTS)
-        if cached:
-            return cached
-        else:
+
+        async def fetch():
+            if await self._is_known_missing(uid, self.NAMESPACE_MISSING_ENDPOINTS, self.NAMESPACE_ENDPOINTS):
+                return None
             endpoint = await app.db.crud.load_endpoint(self.__db, uid)
             if endpoint:
-                await self._set_cache(uid, endpoint, namespace=self.NAMESPACE_ENDPOINTS)
                 if endpoint['verkey']:
                     await self._set_cache(uid, endpoint['verkey'], namespace=self.NAMESPACE_ENDPOINTS_VERKEYS)
+            else:
+                await self._set_missing(uid, self.NAMESPACE_MISSING_ENDPOINTS)
             return endpoint
 
+        return await self._load_cached(uid, self.NAMESPACE_ENDPOINTS, fetch)
+
     async def load_endpoint_via_verkey(self, verkey: str) -> Optional[dict]:
-        cached = await self._get_cache(verkey, namespace=self.NAMESPACE_ENDPOINTS)
-        if cached:
-            return cached
-        else:
+
+        async def fetch():
             endpoint = await app.db.crud.load_endpoint_via_verkey(self.__db, verkey)
-            if endpoint:
-                await self._set_cache(verkey, endpoint, namespace=self.NAMESPACE_ENDPOINTS)
-                if endpoint['verkey']:
-                    await self._set_cache(endpoint['uid'], endpoint['verkey'], namespace=self.NAMESPACE_ENDPOINTS_VERKEYS)
+            if endpoint and endpoint['verkey']:
+                await self._set_cache(endpoint['uid'], endpoint['verkey'], namespace=self.NAMESPACE_ENDPOINTS_VERKEYS)
             return endpoint
 
+        return await self._load_cached(verkey, self.NAMESPACE_ENDPOINTS, fetch)
+
     async def load_endpoint_via_routing_key(self, routing_key) -> Optional[dict]:
-        cached = await self._get_cache(routing_key, namespace=self.NAMESPACE_ENDPOINTS)
-        if cached:
-            return cached
-        else:
-            endpoint_uid = await app.db.crud.load_endpoint_via_routing_key(self.__db, routing_key)
-            if endpoint_uid:
-                endpoint = await self.load_endpoint(endpoint_uid)
-                if endpoint:
-                    await self._set_cache(routing_key, endpoint, namespace=self.NAMESPACE_ENDPOINTS)
-                return endpoint
-            else:
+
+        async def fetch():
+            if await self._is_known_missing(routing_key, self.NAMESPACE_MISSING_ROUTING_KEYS, self.NAMESPACE_ROUTING_KEYS):
                 return None
+            endpoint = await app.db.crud.load_endpoint_for_routing_key(self.__db, routing_key)
+            if endpoint is None:
+                await self._set_missing(routing_key, self.NAMESPACE_MISSING_ROUTING_KEYS)
+            return endpoint
+
+        return await self._load_cached(routing_key, self.NAMESPACE_ENDPOINTS, fetch)
+
+    async def load_endpoints_via_routing_keys(self, keys: List[str]) -> Dict[str, dict]:
+        """Resolve many routing keys at once: single memcached request and single database query for misses
+
+        :return: endpoints by routing keys, unknown keys are absent
+        """
+        resolved = {}
+        # key -> (endpoint cache key, missing marker cache key)
+        pending = {}
+        for routing_key in dict.fromkeys(keys):
+            _key = self._cache_key(routing_key, self.NAMESPACE_ENDPOINTS)
+            _missing_key = self._cache_key(routing_key, self.NAMESPACE_MISSING_ROUTING_KEYS)
+            value_b = self.__local_cache.get(_key)
+            if value_b:
+                self.__local_cache.count(self.NAMESPACE_ENDPOINTS, 'l1_hits')
+                resolved[routing_key], _, _ = self._decode_entry(value_b)
+            elif self.__local_cache.get(_missing_key):
+                self.__local_cache.count(self.NAMESPACE_ROUTING_KEYS, 'negative_hits')
+            else:
+                pending[routing_key] = (_key, _missing_key)
+        if not pending:
+            return resolved
+        try:
+            values, _ = await self.__memcached.get_many(
+                [item.encode() for cache_keys in pending.values() for item in cache_keys]
+            )
+        except Exception as e:
+            logging.exception('MemCached exception')
+            values = {}
+        misses = []
+        for routing_key, (_key, _missing_key) in pending.items():
+            value_b = values.get(_key.encode())
+            if value_b:
+                self.__local_cache.count(self.NAMESPACE_ENDPOINTS, 'memcached_hits')
+                self.__local_cache.set(_key, value_b)
+                resolved[routing_key], _, _ = self._decode_entry(value_b)
+            elif values.get(_missing_key.encode()):
+                self.__local_cache.count(self.NAMESPACE_ROUTING_KEYS, 'negative_hits')
+                self.__local_cache.set(_missing_key, values[_missing_key.encode()], ttl=self.NEGATIVE_CACHE_TIMEOUT)
+            else:
+                self.__local_cache.count(self.NAMESPACE_ENDPOINTS, 'misses')
+                misses.append(routing_key)
+        if misses:
+            stamp = time.monotonic()
+            endpoints = await app.db.crud.load_endpoints_via_routing_keys(self.__db, misses)
+            delta = time.monotonic() - stamp
+            for routing_key in misses:
+                endpoint = endpoints.get(routing_key)
+                if endpoint:
+                    await self._set_cache(routing_key, endpoint, namespace=self.NAMESPACE_ENDPOINTS, delta=delta)
+                    resolved[routing_key] = endpoint
+                else:
+                    await self._set_missing(routing_key, self.NAMESPACE_MISSING_ROUTING_KEYS)
+        return resolved
 
     async def add_routing_key(self, endpoint_uid: str, key: str) -> dict:
         await self._delete_cache(endpoint_uid, namespace=self.NAMESPACE_ROUTING_KEYS)
-        key = await app.db.crud.add_routing_key(self.__db, endpoint_uid, key)
-        return key
+        routing_key = await app.db.crud.add_routing_key(self.__db, endpoint_uid, key)
+        # Key may be moved from other endpoint
+        await self._delete_cache(key, namespace=self.NAMESPACE_ENDPOINTS)
+        await self._delete_cache(key, namespace=self.NAMESPACE_MISSING_ROUTING_KEYS)
+        return routing_key
 
     async def remove_routing_key(self, endpoint_uid: str, key: str):
         await self._delete_cache(endpoint_uid, namespace=self.NAMESPACE_ROUTING_KEYS)
         await app.db.crud.remove_routing_key(self.__db, endpoint_uid, key)
 
     async def list_routing_key(self, endpoint_uid: str) -> list:
-        cached = await self._get_cache(endpoint_uid, namespace=self.NAMESPACE_ROUTING_KEYS)
-        if cached:
-            return cached
-        else:
-            collection = await app.db.crud.list_routing_key(self.__db, endpoint_uid)
-            await self._set_cache(endpoint_uid, collection, namespace=self.NAMESPACE_ROUTING_KEYS)
-            return collection
+
+        async def fetch():
+            return await app.db.crud.list_routing_key(self.__db, endpoint_uid)
+
+        return await self._load_cached(endpoint_uid, self.NAMESPACE_ROUTING_KEYS, fetch) or []
 
     async def get_global_setting(self, name: str) -> Optional[Any]:
-        cached = await self._get_cache(name, namespace=self.NAMESPACE_GLOBAL_SETTINGS)
-        if cached:
-            return cached.get('value', None)
-        else:
+
+        async def fetch():
             value = await app.db.crud.get_global_setting(self.__db, name)
-            await self._set_cache(name, {'value': value}, namespace=self.NAMESPACE_GLOBAL_SETTINGS)
-            return value
+            return {'value': value}
+
+        cached = await self._load_cached(name, self.NAMESPACE_GLOBAL_SETTINGS, fetch)
+        return cached.get('value', None)
 
     async def set_global_setting(self, name: str, value: Any):
         await self._delete_cache(name, namespace=self.NAMESPACE_GLOBAL_SETTINGS)
         await app.db.crud.set_global_setting(self.__db, name, value)
 
-    async def _set_cache(self, key: str, value: Union[dict, str, list], exp_time: int = None, namespace: str = None):
-        if namespace:
-            _key = f'{namespace}:{key}'
+    async def warm_cache(self, agents: List[dict] = None, endpoints: List[dict] = None):
+        """Put records written to database in bulk to cache as they would be loaded"""
+        coros = []
+        for agent in agents or []:
+            coros.append(self._set_cache(agent['did'], agent, namespace=self.NAMESPACE_AGENTS))
+        for endpoint in endpoints or []:
+            coros.append(self._set_cache(endpoint['uid'], endpoint, namespace=self.NAMESPACE_ENDPOINTS))
+            if endpoint['verkey']:
+                coros.append(
+                    self._set_cache(endpoint['uid'], endpoint['verkey'], namespace=self.NAMESPACE_ENDPOINTS_VERKEYS)
+                )
+        await asyncio.gather(*coros)
+
+    async def _is_known_missing(self, key: str, namespace: str, counter_namespace: str) -> bool:
+        if await self._get_cache(key, namespace=namespace):
+            self.__local_cache.count(counter_namespace, 'negative_hits')
+            return True
         else:
-            _key = key
-        _value = json.dumps({
-            'type': 'obj' if type(value) is dict else 'str',
-            'value': json.dumps(value) if type(value) is dict else value
-        })
+            return False
+
+    async def _set_missing(self, key: str, namespace: str):
+        await self._set_cache(key, '1', exp_time=self.NEGATIVE_CACHE_TIMEOUT, namespace=namespace)
+
+    async def _load_cached(
+            self, key: str, namespace: str, fetch: Callable[[], Awaitable[Optional[Union[dict, str, list]]]]
+    ) -> Optional[Union[dict, str, list]]:
+        """Load value from cache, on miss concurrent callers share single fetch from database
+
+        Entries close to expiration are refreshed in background with probability growing to expiration time,
+        so popular keys don't expire in all workers at once
+        """
+        _key = self._cache_key(key, namespace)
+        entry = await self._get_cache_entry(key, namespace)
+        if entry:
+            value, expires_at, delta = entry
+            if time.time() - delta * self.EARLY_REFRESH_BETA * math.log(1.0 - random.random()) >= expires_at:
+                self.__local_cache.count(namespace, 'early_refreshes')
+                # Own flight key: miss coincided with refresh must not get result of refresh
+                self.__local_cache.flight(
+                    self.REFRESH_FLIGHT_PREFIX + _key, lambda: self.__refresh(key, namespace, fetch), namespace
+                )
+            return value
+        encoded = await asyncio.shield(
+            self.__local_cache.flight(_key, lambda: self.__fetch(key, namespace, fetch), namespace)
+        )
+        # Every caller gets own copy of shared result
+        return self.__codec.decode(encoded) if encoded else None
+
+    async def __fetch(self, key: str, namespace: str, fetch: Callable[[], Awaitable]) -> Optional[bytes]:
+        stamp = time.monotonic()
+        value = await fetch()
+        if value:
+            return await self._set_cache(key, value, namespace=namespace, delta=time.monotonic() - stamp)
+        else:
+            return None
+
+    async def __refresh(self, key: str, namespace: str, fetch: Callable[[], Awaitable]):
         try:
-            await self.__memcached.set(_key.encode(), _value.encode(), exptime=exp_time or self.MEMCACHED_TIMEOUT)
-        except Exception as e:
-            logging.exception('MemCached exception')
+            await self.__fetch(key, namespace, fetch)
+        except Exception:
+            logging.exception(f'Error while refresh cache of {namespace}:{key}')
 
-    async def _get_cache(self, key: str, namespace: str = None) -> Optional[Union[dict, str, list]]:
-        if namespace:
-            _key = f'{namespace}:{key}'
+    def _cache_key(self, key: str, namespace: str = None, version: int = None, codec: CacheCodec = None) -> str:
+        version = version or self.CACHE_VERSION
+        unprefixed = f'{namespace}:{key}' if namespace else key
+        if version == self.LEGACY_CACHE_VERSION:
+            return unprefixed
         else:
-            _key = key
+            return f'v{version}{(codec or self.__codec).NAME}:{unprefixed}'
+
+    async def _set_cache(
+            self, key: str, value: Union[dict, str, list],
+            exp_time: int = None, namespace: str = None, delta: float = 0.0
+    ) -> bytes:
+        """Cache value, returns it encoded
+
+        :param delta: duration (sec) of value computation, used for early refresh
+        """
+        _key = self._cache_key(key, namespace)
+        exp_time = exp_time or self.MEMCACHED_TIMEOUT
+        encoded = self.__codec.encode(value)
+        _value = self.ENTRY_HEADER.pack(int(time.time()) + exp_time, delta) + encoded
+        self.__local_cache.set(_key, _value, ttl=exp_time)
         try:
-            value_b, _ = await self.__memcached.get(_key.encode())
+            await self.__memcached.set(_key.encode(), _value, exptime=exp_time)
         except Exception as e:
             logging.exception('MemCached exception')
-            return None
-        value = value_b.decode() if value_b else None
-        if value:
-            descr = json.loads(value)
-            typ = descr['type']
-            value = descr['value']
-            if typ == 'obj':
-                value = json.loads(value)
+        return encoded
+
+    async def _get_cache(self, key: str, namespace: str = None) -> Optional[Union[dict, str, list]]:
+        entry = await self._get_cache_entry(key, namespace)
+        if entry:
+            value, _, _ = entry
             return value
         else:
             return None
 
-    async def _delete_cache(self, key: str, namespace: str = None):
-        if namespace:
-            _key = f'{namespace}:{key}'
+    async def _get_cache_entry(self, key: str, namespace: str = None) -> Optional[Tuple[Any, int, float]]:
+        """Cached value with its expiration timestamp and computation duration"""
+        _key = self._cache_key(key, namespace)
+        value_b = self.__local_cache.get(_key)
+        if value_b:
+            self.__local_cache.count(namespace, 'l1_hits')
+        else:
+            try:
+                value_b, _ = await self.__memcached.get(_key.encode())
+            except Exception as e:
+                logging.exception('MemCached exception')
+                self.__local_cache.count(namespace, 'misses')
+                return None
+            if value_b:
+                self.__local_cache.count(namespace, 'memcached_hits')
+                self.__local_cache.set(_key, value_b, ttl=self.__local_ttls.get(namespace))
+            else:
+                self.__local_cache.count(namespace, 'misses')
+        if value_b:
+            return self._decode_entry(value_b)
         else:
-            _key = key
+            return None
+
+    def _decode_entry(self, value_b: bytes) -> Tuple[Any, int, float]:
+        expires_at, delta = self.ENTRY_HEADER.unpack_from(value_b)
+        return self.__codec.decode(value_b[self.ENTRY_HEADER.size:]), expires_at, delta
+
+    async def _delete_cache(self, key: str, namespace: str = None):
+        _key = self._cache_key(key, namespace)
+        # Workers of rolling deploy may cache values in other formats: drop them as well,
+        # including unprefixed keys of legacy (v1) workers
+        keys = [_key, self._cache_key(key, namespace, version=self.LEGACY_CACHE_VERSION)]
+        for codec in CACHE_CODECS.values():
+            item = self._cache_key(key, namespace, self.CACHE_VERSION, codec)
+            if item not in keys:
+                keys.append(item)
+        await asyncio.gather(*[self.__delete_memcached(item) for item in keys])
+        await self.__local_cache.invalidate(_key)
+
+    async def __delete_memcached(self, key: str):
         try:
-            await self.__memcached.delete(_key.encode())
+            await self.__memcached.delete(key.encode())
         except Exception as e:
             logging.exception('MemCached exception')
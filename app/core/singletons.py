@@ -57,3 +57,128 @@ class GlobalRedisChannelsCache:
         if not cls.__instance:
             cls.__instance = GlobalRedisChannelsCache()
         return cls.__instance.cache
+
+
+class GlobalInFlightTracker:
+
+    __instances = {}
+
+    @classmethod
+    def get(cls):
+        # app.core.redis depends on this module indirectly (via app.db.crud), so import lazily
+        from app.core.redis import InFlightTracker
+        # Tracker runs background task in current loop
+        cur_loop_id = GlobalMemcachedClient._get_cur_loop_id()
+        inst = cls.__instances.get(cur_loop_id)
+        if not inst:
+            inst = InFlightTracker()
+            cls.__instances[cur_loop_id] = inst
+        return inst
+
+
+class GlobalAckDispatcher:
+
+    __instances = {}
+
+    @classmethod
+    def get(cls):
+        from app.core.redis import AckDispatcher
+        # Dispatcher subscriptions are bound to current loop
+        cur_loop_id = GlobalMemcachedClient._get_cur_loop_id()
+        inst = cls.__instances.get(cur_loop_id)
+        if not inst:
+            inst = AckDispatcher()
+            cls.__instances[cur_loop_id] = inst
+        return inst
+
+
+class GlobalPendingEntriesReclaimer:
+
+    __instances = {}
+
+    @classmethod
+    def get(cls):
+        from app.core.redis import PendingEntriesReclaimer
+        # Reclaimer runs background task in current loop
+        cur_loop_id = GlobalMemcachedClient._get_cur_loop_id()
+        inst = cls.__instances.get(cur_loop_id)
+        if not inst:
+            inst = PendingEntriesReclaimer()
+            cls.__instances[cur_loop_id] = inst
+        return inst
+
+
+class GlobalRedisHealthMonitor:
+
+    __instances = {}
+
+    @classmethod
+    def get(cls):
+        from app.core.redis import RedisHealthMonitor
+        # Monitor runs background task in current loop
+        cur_loop_id = GlobalMemcachedClient._get_cur_loop_id()
+        inst = cls.__instances.get(cur_loop_id)
+        if not inst:
+            inst = RedisHealthMonitor()
+            cls.__instances[cur_loop_id] = inst
+        return inst
+
+
+class GlobalRepoLocalCache:
+
+    __instances = {}
+
+    @classmethod
+    def get(cls):
+        from app.core.repo import RepoLocalCache
+        # Cache listens for invalidations in current loop
+        cur_loop_id = GlobalMemcachedClient._get_cur_loop_id()
+        inst = cls.__instances.get(cur_loop_id)
+        if not inst:
+            inst = RepoLocalCache()
+            cls.__instances[cur_loop_id] = inst
+        return inst
+
+
+class GlobalPairwiseCache:
+
+    __instances = {}
+
+    @classmethod
+    def get(cls):
+        from app.core.repo import RepoLocalCache
+        from app.core.pairwise import MediatorPairwiseList
+        cur_loop_id = GlobalMemcachedClient._get_cur_loop_id()
+        inst = cls.__instances.get(cur_loop_id)
+        if not inst:
+            inst = RepoLocalCache(topic=MediatorPairwiseList.INVALIDATION_TOPIC)
+            cls.__instances[cur_loop_id] = inst
+        return inst
+
+
+class GlobalTracer:
+
+    __instance = None
+
+    @classmethod
+    def get(cls):
+        from app.core.tracing import Tracer
+        if cls.__instance is None:
+            cls.__instance = Tracer()
+        return cls.__instance
+
+
+class GlobalWorkersMetrics:
+
+    __instances = {}
+
+    @classmethod
+    def get(cls):
+        from app.core.metrics import WorkersMetrics
+        # Snapshots are dumped by background task in current loop
+        cur_loop_id = GlobalMemcachedClient._get_cur_loop_id()
+        inst = cls.__instances.get(cur_loop_id)
+        if not inst:
+            inst = WorkersMetrics()
+            cls.__instances[cur_loop_id] = inst
+        return inst
@@ -0,0 +1,204 @@
+import time
+import random
+import asyncio
+import logging
+import bisect
+from typing import Optional, Callable, Awaitable, Dict, List, Tuple
+
+import sirius_sdk
+from fastapi import HTTPException
+
+from app.core.utils import info_p2p_event
+
+
+class Span:
+    """Stages of single operation, for example message delivery.
+
+    Stages are recorded as (name, elapsed sec, context) tuples, span is passed to event sink when finished
+    if it was sampled or failed. Pairwise is resolved lazily by sink only for emitted spans.
+    Outcome of successful span may be set to distinguish success paths, status is used by default.
+    """
+
+    def __init__(
+            self, tracer: 'Tracer', name: str, sampled: bool,
+            p2p_loader: Callable[[], Awaitable[Optional[sirius_sdk.Pairwise]]] = None, **context
+    ):
+        self.name = name
+        self.sampled = sampled
+        self.context = context
+        self.stages: List[Tuple[str, float, dict]] = []
+        self.status: Optional[str] = None
+        self.outcome: Optional[str] = None
+        self.duration: Optional[float] = None
+        self.p2p_loader = p2p_loader
+        self.__tracer = tracer
+        self.__started = time.perf_counter()
+
+    @property
+    def failed(self) -> bool:
+        return self.status != Tracer.STATUS_OK
+
+    def event(self, stage: str, **context):
+        self.stages.append((stage, time.perf_counter() - self.__started, context))
+
+    def finish(self, status: str = None, outcome: str = None):
+        """
+        :param outcome: outcome of failed span, status by default
+        """
+        if self.duration is not None:
+            return
+        self.duration = time.perf_counter() - self.__started
+        self.status = status or Tracer.STATUS_OK
+        if self.failed:
+            self.outcome = outcome or self.status
+        elif self.outcome is None:
+            self.outcome = self.status
+        self.__tracer.on_finished(self)
+
+    async def load_p2p(self) -> Optional[sirius_sdk.Pairwise]:
+        if self.p2p_loader is None:
+            return None
+        try:
+            return await self.p2p_loader()
+        except Exception:
+            return None
+
+    def __enter__(self) -> 'Span':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_val is None:
+            self.finish()
+        elif isinstance(exc_val, HTTPException):
+            self.finish(f'HTTP {exc_val.status_code}')
+        else:
+            self.finish(f'Exception: {repr(exc_val)}', outcome='Exception')
+        return False
+
+
+class EventSink:
+    """Receiver of finished spans"""
+
+    NAME = None
+
+    async def emit(self, span: Span):
+        raise NotImplementedError
+
+
+class NullEventSink(EventSink):
+
+    NAME = 'none'
+
+    async def emit(self, span: Span):
+        pass
+
+
+class LoggingEventSink(EventSink):
+    """Single structured INFO log record per span"""
+
+    NAME = 'log'
+
+    async def emit(self, span: Span):
+        p2p = await span.load_p2p()
+        stages = [
+            {'stage': stage, 'elapsed_ms': round(elapsed * 1000, 3), **context}
+            for stage, elapsed, context in span.stages
+        ]
+        info_p2p_event(
+            p2p or span.context.get('endpoint_uid', span.name), f'{span.name}: {span.status}',
+            duration_ms=round(span.duration * 1000, 3), stages=stages, **span.context
+        )
+
+
+EVENT_SINKS = {sink.NAME: sink for sink in [LoggingEventSink, NullEventSink]}
+
+
+class Histogram:
+    """Cumulative histogram of durations (sec)"""
+
+    BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, buckets: Tuple[float, ...] = None):
+        self.buckets = buckets or self.BUCKETS
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    @property
+    def cumulative(self) -> List[Tuple[float, int]]:
+        """(upper bound, count of values less or equal to it) pairs, last bound is +Inf"""
+        result = []
+        total = 0
+        for bound, count in zip(list(self.buckets) + [float('inf')], self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+class Tracer:
+    """Spans factory: samples spans, collects histograms of stages and passes spans to event sink.
+
+    Failed spans are emitted regardless of sampling.
+    """
+
+    STATUS_OK = 'OK'
+
+    def __init__(self, sink: EventSink = None, sample_rate: float = None):
+        if sink is None or sample_rate is None:
+            from app.settings import TRACE_SINK, TRACE_SAMPLE_RATE
+            sink = sink or EVENT_SINKS[TRACE_SINK]()
+            sample_rate = TRACE_SAMPLE_RATE if sample_rate is None else sample_rate
+        self.sink = sink
+        self.sample_rate = sample_rate
+        self.counters = {'spans': 0, 'sampled': 0, 'failed': 0, 'emitted': 0, 'emit_errors': 0}
+        self.__histograms: Dict[str, Dict[str, Histogram]] = {}
+        self.__outcomes: Dict[str, Dict[str, int]] = {}
+
+    @property
+    def histograms(self) -> Dict[str, Dict[str, Histogram]]:
+        """Histograms of stages durations (time since previous stage) per span name, "total" is span duration"""
+        return {name: dict(items) for name, items in self.__histograms.items()}
+
+    @property
+    def outcomes(self) -> Dict[str, Dict[str, int]]:
+        """Count of finished spans per span name and outcome"""
+        return {name: dict(items) for name, items in self.__outcomes.items()}
+
+    def start_span(
+            self, name: str, p2p_loader: Callable[[], Awaitable[Optional[sirius_sdk.Pairwise]]] = None, **context
+    ) -> Span:
+        """
+        :param p2p_loader: coroutine function to resolve pairwise of span, called only if span is emitted
+        """
+        sampled = self.sample_rate >= 1 or random.random() < self.sample_rate
+        return Span(self, name, sampled, p2p_loader, **context)
+
+    def on_finished(self, span: Span):
+        self.counters['spans'] += 1
+        histograms = self.__histograms.setdefault(span.name, {})
+        prev_elapsed = 0
+        for stage, elapsed, _ in span.stages:
+            histograms.setdefault(stage, Histogram()).observe(elapsed - prev_elapsed)
+            prev_elapsed = elapsed
+        histograms.setdefault('total', Histogram()).observe(span.duration)
+        outcomes = self.__outcomes.setdefault(span.name, {})
+        outcomes[span.outcome] = outcomes.get(span.outcome, 0) + 1
+        if span.failed:
+            self.counters['failed'] += 1
+        if span.sampled:
+            self.counters['sampled'] += 1
+        if span.sampled or span.failed:
+            asyncio.ensure_future(self.__emit(span))
+
+    async def __emit(self, span: Span):
+        try:
+            await self.sink.emit(span)
+            self.counters['emitted'] += 1
+        except Exception:
+            self.counters['emit_errors'] += 1
+            logging.exception(f'Error while emit span {span.name}')
@@ -1,9 +1,11 @@
 import os.path
+import json
 import uuid
-from typing import Optional, Any, Tuple, Union
+from typing import Optional, Any, Tuple, Union, List, Dict
 
 from databases import Database
-from sqlalchemy import and_, or_, func, select
+from sqlalchemy import and_, or_, func, select, literal_column
+from sqlalchemy.dialects.postgresql import insert
 
 from app.utils import hash_string
 from .models import agents, endpoints, routing_keys, users, global_settings, backups, pairwises
@@ -22,80 +24,138 @@ class DBRecordDoesNotExists(BaseDBError):
 
 
 GLOBAL_SETTING_PK = 1
+# Collections smaller than this are counted exactly even if approximate count is requested
+APPROXIMATE_COUNT_THRESHOLD = 10000
+
+
+# Upserts: single statement, records with the same verkey are removed in CTE
+SQL_REMOVE_AGENTS_WITH_VERKEY = """
+WITH removed AS (
+    DELETE FROM agents WHERE verkey = :verkey AND did != :did
+)
+"""
+SQL_UPSERT_AGENT = """
+INSERT INTO agents (id, did, verkey, metadata, fcm_device_id)
+VALUES (:id, :did, :verkey, CAST(:metadata AS JSON), :fcm_device_id)
+ON CONFLICT (did) DO UPDATE SET
+    verkey = EXCLUDED.verkey,
+    metadata = COALESCE(EXCLUDED.metadata, agents.metadata),
+    fcm_device_id = COALESCE(EXCLUDED.fcm_device_id, agents.fcm_device_id)
+WHERE agents.verkey IS DISTINCT FROM EXCLUDED.verkey
+    OR (EXCLUDED.metadata IS NOT NULL AND EXCLUDED.metadata::text IS DISTINCT FROM agents.metadata::text)
+    OR (EXCLUDED.fcm_device_id IS NOT NULL AND EXCLUDED.fcm_device_id IS DISTINCT FROM agents.fcm_device_id)
+"""
+SQL_REMOVE_ENDPOINTS_WITH_VERKEY = """
+WITH removed AS (
+    DELETE FROM endpoints WHERE verkey = :verkey AND uid != :uid
+)
+"""
+SQL_UPSERT_ENDPOINT = """
+INSERT INTO endpoints (uid, redis_pub_sub, agent_id, verkey, fcm_device_id)
+VALUES (:uid, :redis_pub_sub, :agent_id, :verkey, :fcm_device_id)
+ON CONFLICT (uid) DO UPDATE SET
+    redis_pub_sub = COALESCE(EXCLUDED.redis_pub_sub, endpoints.redis_pub_sub),
+    agent_id = COALESCE(EXCLUDED.agent_id, endpoints.agent_id),
+    verkey = COALESCE(EXCLUDED.verkey, endpoints.verkey),
+    fcm_device_id = COALESCE(EXCLUDED.fcm_device_id, endpoints.fcm_device_id)
+WHERE (endpoints.redis_pub_sub, endpoints.agent_id, endpoints.verkey, endpoints.fcm_device_id) IS DISTINCT FROM (
+    COALESCE(EXCLUDED.redis_pub_sub, endpoints.redis_pub_sub),
+    COALESCE(EXCLUDED.agent_id, endpoints.agent_id),
+    COALESCE(EXCLUDED.verkey, endpoints.verkey),
+    COALESCE(EXCLUDED.fcm_device_id, endpoints.fcm_device_id)
+)
+"""
 
 
 async def ensure_agent_exists(db: Database, did: str, verkey: str, metadata: dict = None, fcm_device_id: str = None):
-    async with db.transaction():
-        # remove records with same verkey
-        cond = and_(agents.c.verkey == verkey, agents.c.did != did)
-        sql = agents.select().where(cond)
-        rows = await db.fetch_all(query=sql)
-        if rows:
-            sql = agents.delete().where(cond)
-            await db.execute(query=sql)
-        # custom operations
-        agent = await load_agent(db, did)
-        if agent:
-            fields_to_update = {}
-            if agent['verkey'] != verkey:
-                fields_to_update['verkey'] = verkey
-            if metadata is not None and agent['metadata'] != metadata:
-                fields_to_update['metadata'] = metadata
-            if fcm_device_id is not None and agent['fcm_device_id'] != fcm_device_id:
-                fields_to_update['fcm_device_id'] = fcm_device_id
-            if fields_to_update:
-                sql = agents.update().where(agents.c.did == did)
-                await db.execute(query=sql, values=fields_to_update)
-        else:
-            sql = agents.insert()
-            values = {
-                "did": did,
-                "verkey": verkey,
-                "id": uuid.uuid4().hex
-            }
-            await db.execute(query=sql, values=values)
+    sql = SQL_REMOVE_AGENTS_WITH_VERKEY + SQL_UPSERT_AGENT
+    values = {
+        "id": uuid.uuid4().hex,
+        "did": did,
+        "verkey": verkey,
+        "metadata": json.dumps(metadata) if metadata is not None else None,
+        "fcm_device_id": fcm_device_id
+    }
+    await db.execute(query=sql, values=values)
 
 
 async def ensure_endpoint_exists(
         db: Database, uid: str, redis_pub_sub: str = None,
         agent_id: str = None, verkey: str = None, fcm_device_id: str = None
 ):
+    if verkey:
+        sql = SQL_REMOVE_ENDPOINTS_WITH_VERKEY + SQL_UPSERT_ENDPOINT
+    else:
+        sql = SQL_UPSERT_ENDPOINT
+    values = {
+        "uid": uid,
+        "redis_pub_sub": redis_pub_sub,
+        "agent_id": agent_id,
+        "verkey": verkey,
+        "fcm_device_id": fcm_device_id
+    }
+    await db.execute(query=sql, values=values)
+
+
+async def bulk_upsert_static_connections(
+        db: Database, agents_values: List[dict], endpoints_values: List[dict], pairwises_values: List[dict]
+) -> Tuple[List[dict], List[dict]]:
+    """Upsert agents, endpoints and pairwises with multi-row statements in single transaction
+
+    Records with verkeys of upserted ones are removed as ensure_..._exists does.
+    Records must be unique by did/uid/their_did and verkey.
+
+    :return: stored agents, stored endpoints
+    """
     async with db.transaction():
-        if verkey:
-            # remove records with same verkey
-            cond = and_(endpoints.c.verkey == verkey, endpoints.c.uid != uid)
-            sql = endpoints.select().where(cond)
+        stored_agents = []
+        if agents_values:
+            verkeys = [item['verkey'] for item in agents_values]
+            dids = [item['did'] for item in agents_values]
+            sql = agents.delete().where(and_(agents.c.verkey.in_(verkeys), agents.c.did.notin_(dids)))
+            await db.execute(query=sql)
+            sql = insert(agents).values([dict(id=uuid.uuid4().hex, **item) for item in agents_values])
+            sql = sql.on_conflict_do_update(
+                index_elements=[agents.c.did],
+                set_={
+                    'verkey': sql.excluded.verkey,
+                    'fcm_device_id': func.coalesce(sql.excluded.fcm_device_id, agents.c.fcm_device_id)
+                }
+            ).returning(*agents.c)
             rows = await db.fetch_all(query=sql)
-            if rows:
-                sql = endpoints.delete().where(cond)
-                await db.execute(query=sql)
-        # custom operations
-        endpoint = await load_endpoint(db, uid)
-        if endpoint:
-            fields_to_update = {}
-            if redis_pub_sub is not None and endpoint['redis_pub_sub'] != redis_pub_sub:
-                fields_to_update['redis_pub_sub'] = redis_pub_sub
-            if agent_id is not None and endpoint['agent_id'] != agent_id:
-                fields_to_update['agent_id'] = agent_id
-            if redis_pub_sub is not None and endpoint['redis_pub_sub'] != redis_pub_sub:
-                fields_to_update['redis_pub_sub'] = redis_pub_sub
-            if verkey is not None and endpoint['verkey'] != verkey:
-                fields_to_update['verkey'] = verkey
-            if fcm_device_id is not None and endpoint['fcm_device_id'] != fcm_device_id:
-                fields_to_update['fcm_device_id'] = fcm_device_id
-            if fields_to_update:
-                sql = endpoints.update().where(endpoints.c.uid == uid)
-                await db.execute(query=sql, values=fields_to_update)
-        else:
-            sql = endpoints.insert()
-            values = {
-                "uid": uid,
-                "redis_pub_sub": redis_pub_sub,
-                "agent_id": agent_id,
-                "verkey": verkey,
-                "fcm_device_id": fcm_device_id
-            }
-            await db.execute(query=sql, values=values)
+            stored_agents = [_restore_agent_from_row(row) for row in rows]
+        stored_endpoints = []
+        if endpoints_values:
+            verkeys = [item['verkey'] for item in endpoints_values]
+            uids = [item['uid'] for item in endpoints_values]
+            sql = endpoints.delete().where(and_(endpoints.c.verkey.in_(verkeys), endpoints.c.uid.notin_(uids)))
+            await db.execute(query=sql)
+            sql = insert(endpoints).values(endpoints_values)
+            sql = sql.on_conflict_do_update(
+                index_elements=[endpoints.c.uid],
+                set_={
+                    # queue of existing endpoint is not moved
+                    'redis_pub_sub': func.coalesce(endpoints.c.redis_pub_sub, sql.excluded.redis_pub_sub),
+                    'verkey': sql.excluded.verkey,
+                    'fcm_device_id': func.coalesce(sql.excluded.fcm_device_id, endpoints.c.fcm_device_id)
+                }
+            ).returning(*endpoints.c)
+            rows = await db.fetch_all(query=sql)
+            stored_endpoints = [_restore_endpoint_from_row(row) for row in rows]
+        if pairwises_values:
+            sql = insert(pairwises).values(pairwises_values)
+            sql = sql.on_conflict_do_update(
+                index_elements=[pairwises.c.their_did],
+                set_={
+                    'their_verkey': sql.excluded.their_verkey,
+                    'my_did': sql.excluded.my_did,
+                    'my_verkey': sql.excluded.my_verkey,
+                    'metadata': sql.excluded.metadata,
+                    'their_label': sql.excluded.their_label
+                }
+            )
+            await db.execute(query=sql)
+    return stored_agents, stored_endpoints
 
 
 async def load_agent(db: Database, did: str) -> Optional[dict]:
@@ -116,6 +176,18 @@ async def load_endpoint(db: Database, uid: str) -> Optional[dict]:
         return None
 
 
+async def load_endpoints(db: Database, after_uid: str = None, limit: int = None) -> list:
+    """Load endpoints ordered by uid, use uid of last endpoint as after_uid to load next page"""
+    sql = endpoints.select()
+    if after_uid is not None:
+        sql = sql.where(endpoints.c.uid > after_uid)
+    sql = sql.order_by(endpoints.c.uid.asc())
+    if limit is not None:
+        sql = sql.limit(limit)
+    rows = await db.fetch_all(query=sql)
+    return [_restore_endpoint_from_row(row) for row in rows]
+
+
 async def load_pairwises(db: Database, filters: dict = None, offset: int = None, limit: int = None) -> list:
     sql = pairwises.select()
     if filters:
@@ -137,8 +209,59 @@ async def load_pairwises(db: Database, filters: dict = None, offset: int = None,
         return []
 
 
-async def load_pairwises_count(db: Database, filters: dict = None) -> int:
+async def load_pairwises_page(db: Database, filters: dict = None, after: str = None, limit: int = None) -> list:
+    """Keyset pagination ordered by their_did: pass their_did of last item as after to load next page
+
+    Items are projected without metadata (did_docs), label of legacy records is extracted from metadata
+    """
+    sql = select([
+        pairwises.c.their_did, pairwises.c.their_verkey, pairwises.c.my_did, pairwises.c.my_verkey,
+        _pairwise_label_expr().label('their_label')
+    ])
+    cond_items = []
+    if filters:
+        cond = _build_pairwise_sql_cond(filters)
+        if cond is not None:
+            cond_items.append(cond)
+    if after is not None:
+        cond_items.append(pairwises.c.their_did > after)
+    if cond_items:
+        sql = sql.where(and_(*cond_items))
+    sql = sql.order_by(pairwises.c.their_did)
+    if limit is not None:
+        sql = sql.limit(limit)
+    rows = await db.fetch_all(query=sql)
+    return [
+        {
+            'their_did': row['their_did'],
+            'their_verkey': row['their_verkey'],
+            'my_did': row['my_did'],
+            'my_verkey': row['my_verkey'],
+            'their_label': row['their_label']
+        }
+        for row in rows
+    ]
+
+
+async def load_pairwise(db: Database, their_did: str) -> Optional[dict]:
+    sql = pairwises.select().where(pairwises.c.their_did == their_did)
+    row = await db.fetch_one(query=sql)
+    if row:
+        return _restore_pairwise_from_row(row)
+    else:
+        return None
+
+
+async def load_pairwises_count(db: Database, filters: dict = None, approximate: bool = False) -> int:
+    """
+    :param approximate: estimate count of all records with table statistics, exact count for filtered
+                        and small collections
+    """
     cond = _build_pairwise_sql_cond(filters) if filters else None
+    if approximate and cond is None:
+        estimate = await db.execute(query="SELECT reltuples::bigint FROM pg_class WHERE relname = 'pairwises'")
+        if estimate is not None and estimate >= APPROXIMATE_COUNT_THRESHOLD:
+            return estimate
     if cond is not None:
         sql = select([func.count(pairwises.c.their_did)]).where(cond)
     else:
@@ -175,13 +298,38 @@ async def load_endpoint_via_routing_key(db: Database, routing_key: str) -> Optio
         return None
 
 
+async def load_endpoint_for_routing_key(db: Database, routing_key: str) -> Optional[dict]:
+    """Load endpoint routing key belongs to with single joined query"""
+    sql = _select_endpoints_via_routing_keys().where(routing_keys.c.key == routing_key)
+    row = await db.fetch_one(query=sql)
+    if row:
+        return _restore_endpoint_from_row(row)
+    else:
+        return None
+
+
+async def load_endpoints_via_routing_keys(db: Database, keys: List[str]) -> Dict[str, dict]:
+    """Load endpoints of routing keys with single joined query, unknown keys are absent in result"""
+    if not keys:
+        return {}
+    sql = _select_endpoints_via_routing_keys().where(routing_keys.c.key.in_(keys))
+    rows = await db.fetch_all(query=sql)
+    resp = {}
+    for row in rows:
+        resp[row['key']] = _restore_endpoint_from_row(row)
+    return resp
+
+
 async def add_routing_key(db: Database, endpoint_uid: str, key: str) -> dict:
-    sql = routing_keys.insert()
+    """Add routing key to endpoint, key registered earlier is moved to the endpoint"""
     values = {
         "endpoint_uid": endpoint_uid,
         "key": key,
     }
-    pk = await db.execute(query=sql, values=values)
+    sql = insert(routing_keys).values(**values).on_conflict_do_update(
+        index_elements=[routing_keys.c.key], set_={'endpoint_uid': endpoint_uid}
+    ).returning(routing_keys.c.id)
+    pk = await db.execute(query=sql)
     resp = {
         'id': pk,
     }
@@ -374,16 +522,26 @@ async def reset_global_settings(db: Database):
         await db.execute(query=sql)
 
 
+def _pairwise_label_expr():
+    # Legacy records store label in metadata only. Json path is not parametrized
+    # to match expression of ix_pairwises_their_label_prefix index
+    return func.coalesce(
+        pairwises.c.their_label, literal_column("CAST((pairwises.metadata -> 'their') ->> 'label' AS VARCHAR)")
+    )
+
+
 def _build_pairwise_sql_cond(filters: dict):
     cond_items = []
     for key, value in filters.items():
-        value = value + '%'
+        # Filters are prefixes, LIKE wildcards of user input are matched literally
+        value = value.replace('/', '//').replace('%', '/%').replace('_', '/_') + '%'
         if key == 'their_did':
-            cond_items.append(pairwises.c.their_did.ilike(value))
+            cond_items.append(pairwises.c.their_did.ilike(value, escape='/'))
         elif key == 'my_did':
-            cond_items.append(pairwises.c.my_did.ilike(value))
+            cond_items.append(pairwises.c.my_did.ilike(value, escape='/'))
         elif key == 'their_label':
-            cond_items.append(pairwises.c.their_label.ilike(value))
+            # matches prefix index ix_pairwises_their_label_prefix
+            cond_items.append(func.lower(_pairwise_label_expr()).like(value.lower(), escape='/'))
     if cond_items:
         cond = or_(*cond_items)
     else:
@@ -391,6 +549,12 @@ def _build_pairwise_sql_cond(filters: dict):
     return cond
 
 
+def _select_endpoints_via_routing_keys():
+    return select([routing_keys.c.key, endpoints]).select_from(
+        routing_keys.join(endpoints, routing_keys.c.endpoint_uid == endpoints.c.uid)
+    )
+
+
 def _restore_agent_from_row(row) -> dict:
     return {
         'id': row['id'],
@@ -33,6 +33,12 @@ pairwises = sqlalchemy.Table(
     sqlalchemy.Column("my_verkey", sqlalchemy.String, index=True),
     sqlalchemy.Column("metadata", sqlalchemy.JSON),
     sqlalchemy.Column("their_label", sqlalchemy.String, nullable=True, index=True),
+    sqlalchemy.Index(
+        'ix_pairwises_their_label_prefix',
+        sqlalchemy.text(
+            "lower(COALESCE(their_label, CAST((metadata -> 'their') ->> 'label' AS VARCHAR))) text_pattern_ops"
+        )
+    ),
 )
 
 
@@ -51,7 +57,7 @@ routing_keys = sqlalchemy.Table(
     'routing_keys',
     metadata,
     sqlalchemy.Column("id", sqlalchemy.INTEGER, primary_key=True, autoincrement=True),
-    sqlalchemy.Column("key", sqlalchemy.String, index=True),
+    sqlalchemy.Column("key", sqlalchemy.String, index=True, unique=True),
     sqlalchemy.Column("endpoint_uid", sqlalchemy.String, index=True),
 )
 
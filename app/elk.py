@@ -1,13 +1,127 @@
+import copy
 import json
+import queue
+import atexit
+import logging
+import threading
+import logging.handlers
 from datetime import datetime
 
 from pythonjsonlogger import jsonlogger
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def fast_json_dumps(obj, default=None, cls=None, indent=None, ensure_ascii=True, **kwargs) -> str:
+    """json.dumps compatible serializer, orjson is used if installed"""
+    if orjson is not None and indent is None:
+        if default is None and cls is not None:
+            default = cls().default
+        try:
+            return orjson.dumps(obj, default=default, option=orjson.OPT_NON_STR_KEYS).decode()
+        except TypeError:
+            pass
+    return json.dumps(obj, default=default, cls=cls, indent=indent, ensure_ascii=ensure_ascii)
+
 
 class ElkJsonFormatter(jsonlogger.JsonFormatter):
 
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('json_serializer', fast_json_dumps)
+        super(ElkJsonFormatter, self).__init__(*args, **kwargs)
+
     def add_fields(self, log_record, record, message_dict):
         super(ElkJsonFormatter, self).add_fields(log_record, record, message_dict)
         log_record['@timestamp'] = datetime.utcnow().isoformat()
         log_record['level'] = record.levelname
         log_record['logger'] = record.name
+
+
+class AsyncLogHandler(logging.handlers.QueueHandler):
+    """Non-blocking handler: records are queued and shipped to target stream handler by background thread.
+
+    Thread formats records by target formatter and writes them in batches. Queue is bounded,
+    records are dropped when it is full, so callers never wait for slow log collector.
+    """
+
+    QUEUE_SIZE = 10000
+    BATCH_SIZE = 500
+    __STOP = object()
+
+    def __init__(self, target: logging.StreamHandler, queue_size: int = None, batch_size: int = None):
+        super().__init__(queue.Queue(maxsize=queue_size or self.QUEUE_SIZE))
+        self.target = target
+        self.batch_size = batch_size or self.BATCH_SIZE
+        self.counters = {'written': 0, 'batches': 0, 'dropped': 0, 'errors': 0}
+        self.__thread = threading.Thread(target=self.__ship, name='log-shipper', daemon=True)
+        self.__thread.start()
+        atexit.register(self.close)
+
+    @property
+    def metrics(self) -> dict:
+        return {'queued': self.queue.qsize(), **self.counters}
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Message is merged with args on caller thread as args may be changed later,
+        # formatting is left for shipping thread
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.counters['dropped'] += 1
+
+    def close(self):
+        if self.__thread.is_alive():
+            try:
+                self.queue.put(self.__STOP, timeout=1)
+            except queue.Full:
+                pass
+            self.__thread.join(timeout=5)
+        super().close()
+
+    def __ship(self):
+        stopped = False
+        while not stopped:
+            record = self.queue.get()
+            if record is self.__STOP:
+                break
+            batch = [record]
+            while len(batch) < self.batch_size:
+                try:
+                    record = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if record is self.__STOP:
+                    stopped = True
+                    break
+                batch.append(record)
+            self.__write(batch)
+
+    def __write(self, batch: list):
+        lines = []
+        for record in batch:
+            try:
+                lines.append(self.target.format(record))
+            except Exception:
+                self.counters['errors'] += 1
+        if not lines:
+            return
+        terminator = self.target.terminator
+        self.target.acquire()
+        try:
+            self.target.stream.write(terminator.join(lines) + terminator)
+            self.target.flush()
+            self.counters['written'] += len(lines)
+            self.counters['batches'] += 1
+        except Exception:
+            self.counters['errors'] += len(lines)
+        finally:
+            self.target.release()
@@ -16,14 +16,15 @@ from app.settings import templates, WEBROOT as SETTING_WEBROOT, URL_STATIC, \
     CERT_FILE as SETTING_CERT_FILE, CERT_KEY_FILE as SETTING_CERT_KEY_FILE, ACME_DIR as SETTING_ACME_DIR, \
     FIREBASE_API_KEY as SETTING_FIREBASE_API_KEY, FIREBASE_SENDER_ID as SETTING_FIREBASE_SENDER_ID
 from app.dependencies import get_db
-from app.utils import async_build_invitation, run_in_thread
+from app.utils import async_build_invitation, run_in_thread, RequestBodyReader
 from app.core.redis import choice_server_address, AsyncRedisChannel
 from app.core.emails import check_server as emails_check_server
 from app.core.repo import Repo
 from app.core.management import register_acme, issue_cert, reload as _mng_reload, load_cert_metadata as _mng_load_cert_metadata
 from app.core.global_config import GlobalConfig
 from app.core.singletons import GlobalMemcachedClient
-from app.routers.utils import create_static_connection as _create_static_connection, validate_verkey as _validate_verkey
+from app.routers.utils import create_static_connection as _create_static_connection, validate_verkey as _validate_verkey, \
+    import_static_connections as _import_static_connections
 
 from .helpers import check_redis, check_services
 from .auth import auth_user as _auth_user, login as _login, logout as _logout, SESSION_COOKIE_KEY
@@ -36,6 +37,9 @@ BASE_URL = '/admin'
 CFG_ACME_EMAIL = 'acme.email'
 CFG_ACME_EMAIL_SHARE = 'acme.email.share'
 PAGE_SIZE = 20
+PAIRWISE_PAGE_SIZE = 10
+IMPORT_MAX_BODY_SIZE = 1024*1024
+PAIRWISE_MAX_PAGE_SIZE = 100
 STATIC_CFG = {
     'styles': URL_STATIC + '/admin/css/styles.css',
     'vue': URL_STATIC + '/vue.min.js',
@@ -349,32 +353,43 @@ async def set_ssl_option(request: Request, db: Database = Depends(get_db)):
 
 @router.post("/load_pairwise_collection", status_code=200)
 async def load_pairwise_collection(request: Request, db: Database = Depends(get_db)):
+    """Page of pairwise collection without did_docs, pass "next" of response as "after" to load next page"""
     await check_is_logged(request)
     js = await request.json()
     search = js.get('search', '')
-    page = js.get('page', 1)
+    after = js.get('after') or None
+    limit = min(int(js.get('limit') or PAIRWISE_PAGE_SIZE), PAIRWISE_MAX_PAGE_SIZE)
+    approximate = js.get('approximate', True)
     #
     filters = {}
     if search:
         filters['their_label'] = search
     #
-    collection_ = await crud.load_pairwises(db, filters=filters)
-    collection = []
-    for p in collection_:
-        metadata = p['metadata'] or {}
-        if not p['their_label']:
-            p['their_label'] = metadata.get('their', {}).get('label', '')
-        their_did_doc = metadata.get('their', {}).get('did_doc', {})
-        if their_did_doc:
-            p['metadata'] = their_did_doc
-        collection.append(p)
-    total_count = await crud.load_pairwises_count(db, filters=filters)
+    collection = await crud.load_pairwises_page(db, filters=filters, after=after, limit=limit)
+    for p in collection:
+        p['their_label'] = p['their_label'] or ''
+    total_count = await crud.load_pairwises_count(db, filters=filters, approximate=approximate)
     return {
         'collection': collection,
-        'total': total_count
+        'total': total_count,
+        'next': collection[-1]['their_did'] if len(collection) == limit else None
     }
 
 
+@router.post("/load_pairwise_details", status_code=200)
+async def load_pairwise_details(request: Request, db: Database = Depends(get_db)):
+    await check_is_logged(request)
+    js = await request.json()
+    their_did = js.get('their_did')
+    if not their_did:
+        raise HTTPException(status_code=400, detail=f'DID not set')
+    p = await crud.load_pairwise(db, their_did)
+    if p is None:
+        raise HTTPException(status_code=404, detail=f'Pairwise with DID "{their_did}" not found')
+    metadata = p['metadata'] or {}
+    return metadata.get('their', {}).get('did_doc', {})
+
+
 @router.post("/create_static_connection", status_code=200)
 async def create_static_connection(request: Request, db: Database = Depends(get_db)):
     await check_is_logged(request)
@@ -401,3 +416,23 @@ async def create_static_connection(request: Request, db: Database = Depends(get_
     repo = Repo(db, memcached=GlobalMemcachedClient.get())
 
     await _create_static_connection(repo, label=label, their_did=did, their_verkey=verkey, fcm_device_id=fcm_device_id)
+
+
+@router.post("/import_static_connections", status_code=200)
+async def import_static_connections(request: Request, db: Database = Depends(get_db)):
+    """Bulk import, request body is NDJSON of records {"did", "verkey", "label", "fcm_device_id"}
+
+    Body is limited by IMPORT_MAX_BODY_SIZE to keep import in bounds of single HTTP request,
+    larger files are imported with manage command
+    """
+    await check_is_logged(request)
+    body = await RequestBodyReader.read(request, max_size=IMPORT_MAX_BODY_SIZE)
+
+    async def chunks():
+        yield body
+
+    repo = Repo(db, memcached=GlobalMemcachedClient.get())
+    counters = await _import_static_connections(
+        repo, chunks(), on_progress=lambda progress: logging.info(f'Import static connections: {progress}')
+    )
+    return counters
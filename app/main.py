@@ -10,6 +10,7 @@ from app.init import *
 from app.routers import maintenance, mediator
 from app.internal import admin
 from app.db.database import database
+from app.core.singletons import GlobalWorkersMetrics
 from app.settings import URL_STATIC
 
 
@@ -30,11 +31,13 @@ app.include_router(
 async def startup_event():
     logging.debug('***** StartUp *****')
     await database.connect()
+    GlobalWorkersMetrics.get().start()
 
 
 @app.on_event("shutdown")
 async def shutdown():
     logging.debug('***** ShutDown *****')
+    await GlobalWorkersMetrics.get().stop()
     await database.disconnect()
 
 
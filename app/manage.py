@@ -10,7 +10,13 @@ CMD_CHECK = 'check'
 CMD_GENERATE_SEED = 'generate_seed'
 CMD_RELOAD = 'reload'
 CDM_LISTEN_FOR_CHANGES = 'listen_for_changes'
-ALL_CMD = [CMD_CREATE_SUPERUSER, CMD_CHECK, CMD_RESET, CMD_GENERATE_SEED, CMD_RELOAD, CDM_LISTEN_FOR_CHANGES]
+CMD_SWEEP_STREAMS = 'sweep_streams'
+CMD_REBALANCE_STREAMS = 'rebalance_streams'
+CMD_IMPORT_STATIC_CONNECTIONS = 'import_static_connections'
+ALL_CMD = [
+    CMD_CREATE_SUPERUSER, CMD_CHECK, CMD_RESET, CMD_GENERATE_SEED, CMD_RELOAD, CDM_LISTEN_FOR_CHANGES,
+    CMD_SWEEP_STREAMS, CMD_REBALANCE_STREAMS, CMD_IMPORT_STATIC_CONNECTIONS
+]
 
 arg_parser = argparse.ArgumentParser()
 arg_parser.add_argument(
@@ -18,11 +24,16 @@ arg_parser.add_argument(
     help=f"reset all user and settings data. You should configure application again."
 )
 arg_parser.add_argument('--broadcast', type=str, required=False)
+arg_parser.add_argument('--once', type=str, required=False)
+arg_parser.add_argument('--dry_run', type=str, required=False)
+arg_parser.add_argument('--file', type=str, required=False)
 args = arg_parser.parse_args()
 
 
 command = args.command
 broadcast = args.broadcast in ['on', 'yes']
+once = args.once in ['on', 'yes']
+dry_run = args.dry_run in ['on', 'yes']
 
 
 if command == CMD_GENERATE_SEED:
@@ -69,3 +80,12 @@ else:
             asyncio.get_event_loop().run_until_complete(app.core.management.broadcast(event=CMD_RELOAD))
     elif command == CDM_LISTEN_FOR_CHANGES:
         asyncio.get_event_loop().run_until_complete(app.core.management.listen_broadcast())
+    elif command == CMD_SWEEP_STREAMS:
+        asyncio.get_event_loop().run_until_complete(app.core.management.sweep_streams(once=once))
+    elif command == CMD_REBALANCE_STREAMS:
+        asyncio.get_event_loop().run_until_complete(app.core.management.rebalance_streams(dry_run=dry_run))
+    elif command == CMD_IMPORT_STATIC_CONNECTIONS:
+        if not args.file:
+            print('Set NDJSON file path with --file argument, "-" to read stdin')
+        else:
+            asyncio.get_event_loop().run_until_complete(app.core.management.import_static_connections(args.file))
@@ -224,6 +224,9 @@ class PickUpStateMachine:
 
     async def put(self, message: Union[dict, str], msg_id: str = None):
         await self.__ready_to_put.wait()
+        self.__put_internal(message, msg_id)
+
+    def __put_internal(self, message: Union[dict, str], msg_id: str = None):
         if isinstance(message, dict):
             msg_id = message.get('@id', None)
         elif isinstance(message, str):
@@ -2,10 +2,15 @@ import datetime
 import logging
 
 from fastapi import APIRouter, Request, Depends, HTTPException
+from fastapi.responses import PlainTextResponse
 
 from databases import Database
 from app.dependencies import get_db
 from app.core.management import liveness_check as mng_liveness_check
+from app.core.redis import RedisPools
+from app.core.singletons import GlobalRedisHealthMonitor, GlobalRepoLocalCache
+from app.utils import RequestBodyReader
+from app.core.metrics import collect_metrics
 
 
 router = APIRouter(
@@ -29,3 +34,33 @@ async def liveness_check(request: Request):
         raise HTTPException(status_code=500, detail=f'Leveness check error: {str(e)}')
     else:
         return {'ok': True, 'utc': str(datetime.datetime.utcnow())}
+
+
+@router.get("/redis_pools")
+async def redis_pools(request: Request):
+    return {'utc': str(datetime.datetime.utcnow()), **RedisPools.metrics()}
+
+
+@router.get("/redis_nodes")
+async def redis_nodes(request: Request):
+    statuses = GlobalRedisHealthMonitor.get().statuses
+    return {
+        'utc': str(datetime.datetime.utcnow()),
+        'nodes': {server: status.__dict__ for server, status in statuses.items()}
+    }
+
+
+@router.get("/repo_cache")
+async def repo_cache(request: Request):
+    return {'utc': str(datetime.datetime.utcnow()), 'namespaces': GlobalRepoLocalCache.get().counters}
+
+
+@router.get("/request_bodies")
+async def request_bodies(request: Request):
+    return {'utc': str(datetime.datetime.utcnow()), **RequestBodyReader.metrics()}
+
+
+@router.get("/metrics", response_class=PlainTextResponse)
+async def metrics(request: Request):
+    """Metrics of all workers of instance in Prometheus text format"""
+    return PlainTextResponse(collect_metrics(), media_type='text/plain; version=0.0.4')
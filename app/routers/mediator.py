@@ -1,7 +1,8 @@
 import json
 import logging
+import functools
 
-from typing import List, Optional
+from typing import Any, List, Optional, Union
 
 from databases import Database
 from sirius_sdk.encryption import unpack_message
@@ -13,15 +14,19 @@ import sirius_sdk
 from core.utils import info_p2p_event
 from app.core.repo import Repo
 from app.core.global_config import GlobalConfig
-from app.core.singletons import GlobalMemcachedClient, GlobalRedisChannelsCache
-from app.core.redis import RedisPush, RedisConnectionError, choice_server_address
-from app.utils import extract_content_type, change_redis_server, extract_recipients
+from app.core.singletons import GlobalMemcachedClient, GlobalRedisChannelsCache, GlobalInFlightTracker, \
+    GlobalAckDispatcher, GlobalTracer
+from app.core.tracing import Span
+from app.core.metrics import ActiveSessions
+from app.core.redis import RedisPush, RedisConnectionError, choice_endpoint_server_address
+from app.utils import extract_content_type, change_redis_server, extract_recipients, RequestBodyReader, \
+    make_group_id_mangled
 from app.core.firebase import FirebaseMessages
 from app.core.forward import FORWARD
 from app.dependencies import get_db
 from app.settings import ENDPOINTS_PATH_PREFIX, WS_PATH_PREFIX, LONG_POLLING_PATH_PREFIX, ROUTER_PATH
 from .mediator_scenarios import onboard as scenario_onboard, \
-    endpoint_processor as scenario_endpoint, endpoint_long_polling, listen_events
+    endpoint_processor as scenario_endpoint, endpoint_long_polling, listen_events, DEFAULT_QUEUE_GROUP_ID
 
 
 router = APIRouter(
@@ -29,6 +34,8 @@ router = APIRouter(
     tags=["mediator"],
 )
 
+# Span of message delivery: endpoint lookup, push to websocket session, Firebase fallback
+DELIVERY_SPAN = 'Post to device'
 EXPECTED_CONTENT_TYPES = [
     'application/ssi-agent-wire', 'application/json',
     'application/didcomm-envelope-enc', 'application/didcomm-encrypted+json'
@@ -49,10 +56,11 @@ async def onboard(websocket: WebSocket, db: Database = Depends(get_db)):
     group_id = websocket.query_params.get('group_id')
     logging.debug(f'endpoint_uid: {endpoint_uid}')
 
-    if endpoint_uid is None:
-        await scenario_onboard(websocket, repo, cfg)
-    else:
-        await scenario_endpoint(websocket, endpoint_uid, repo, group_id=group_id)
+    with ActiveSessions.session('websocket'):
+        if endpoint_uid is None:
+            await scenario_onboard(websocket, repo, cfg)
+        else:
+            await scenario_endpoint(websocket, endpoint_uid, repo, group_id=group_id)
     logging.debug('\n**************************')
     logging.debug('*****************************')
 
@@ -73,73 +81,105 @@ async def long_polling(request: Request, db: Database = Depends(get_db)):
         return EventSourceResponse(event_generator)
 
 
-async def post_to_device(payload, endpoint_fields: dict, db: Database):
+async def fallback_to_firebase(message: dict, endpoint_uid: str, fcm_device_id: str, db: Database):
+    """Called by in-flight tracker in durable delivery mode when device did not ack message in time"""
+    firebase = FirebaseMessages(db=db)
+    if await firebase.enabled():
+        try:
+            success = await firebase.send(device_id=fcm_device_id, msg=message)
+        except Exception:
+            success = False
+            logging.exception('FCM Error!')
+        info_p2p_event(
+            endpoint_uid, f'Post to device: delayed send with Firebase success: {success}',
+            endpoint_uid=endpoint_uid, fcm_device_id=fcm_device_id
+        )
+
+
+async def post_to_device(
+        payload: Union[bytes, dict, str], endpoint_fields: dict, db: Database, span: Span = None
+):
+    """
+    :param payload: raw message bytes or already parsed message (forwarded msg may be any json value)
+    :param span: delivery span started by caller, new span is started if not set
+    """
+    message = json.loads(payload) if isinstance(payload, (bytes, bytearray)) else payload
+    if span is None:
+        # Span of caller is finished by caller, own span is opened here only
+        with GlobalTracer.get().start_span(DELIVERY_SPAN) as span:
+            await _post_to_device(message, endpoint_fields, db, span)
+    else:
+        await _post_to_device(message, endpoint_fields, db, span)
+
+
+async def _post_to_device(message: Any, endpoint_fields: dict, db: Database, span: Span):
+    span.p2p_loader = functools.partial(load_endpoint_p2p, endpoint_fields)
+    span.context['endpoint_uid'] = endpoint_fields['uid']
+    await deliver_to_device(message, endpoint_fields, db, span)
+
 
+async def load_endpoint_p2p(endpoint_fields: dict) -> Optional[sirius_sdk.Pairwise]:
+    verkey = endpoint_fields.get('verkey')
+    if verkey:
+        return await sirius_sdk.PairwiseList.load_for_verkey(verkey)
+    return None
+
+
+async def deliver_to_device(message: dict, endpoint_fields: dict, db: Database, span: Span):
     repo = Repo(db=db, memcached=GlobalMemcachedClient.get())
-    pushes = RedisPush(db, memcached=GlobalMemcachedClient.get(), channels_cache=GlobalRedisChannelsCache.get())
-    p2p: Optional[sirius_sdk.Pairwise] = None
+    durable = settings.DELIVERY_MODE == settings.DELIVERY_MODE_DURABLE
+    pushes = RedisPush(
+        db, memcached=GlobalMemcachedClient.get(), channels_cache=GlobalRedisChannelsCache.get(),
+        tracker=GlobalInFlightTracker.get() if durable else None, dispatcher=GlobalAckDispatcher.get(),
+        default_group=functools.partial(make_group_id_mangled, DEFAULT_QUEUE_GROUP_ID)
+    )
     endpoint_uid = endpoint_fields['uid']
-
-    try:
-        agent = await repo.load_endpoint(endpoint_fields['uid'])
-        if agent and 'verkey' in agent:
-            p2p = await sirius_sdk.PairwiseList.load_for_verkey(agent['verkey'])
-    except:
-        pass
-    ############
-    info_p2p_event(p2p, '#1 Post to device', endpoint_uid=endpoint_uid, metadata=endpoint_fields)
-    ############
-
-    message = json.loads(payload.decode())
     try:
         logging.debug('push message to websocket connection')
         ###############
-        info_p2p_event(p2p, '#2 Post to device: try to send via websocket', endpoint_uid=endpoint_uid)
+        span.event('Try to send via websocket')
         ###############
-        success = await pushes.push(endpoint_fields['uid'], message, ttl=settings.DEVICE_ACK_TIMEOUT)
+        fcm_device_id = endpoint_fields.get('fcm_device_id')
+        if durable and fcm_device_id:
+            on_expired = functools.partial(fallback_to_firebase, message, endpoint_uid, fcm_device_id, db)
+        else:
+            on_expired = None
+        success = await pushes.push(
+            endpoint_fields['uid'], message, ttl=settings.DEVICE_ACK_TIMEOUT, on_expired=on_expired, span=span
+        )
         ###############
-        info_p2p_event(p2p, '#3 Post to device: SUCCESS!', endpoint_uid=endpoint_uid)
+        span.event('Sent via websocket', success=success)
         ###############
         logging.debug(f'push operation returned success: {success}')
     except RedisConnectionError as e:
         success = False
-        info_p2p_event(p2p, '#4 Post to device: Error to send via websocket', endpoint_uid=endpoint_uid)
+        span.event('Error to send via websocket')
         logging.exception('Error while push message via redis')
         # Try select other redis server
         try:
-            redis_server = await choice_server_address()
             unreachable_redis_pub_sub = endpoint_fields['redis_pub_sub']
+            redis_server = await choice_endpoint_server_address(endpoint_uid, unwanted=unreachable_redis_pub_sub)
             new_redis_pub_sub = change_redis_server(unreachable_redis_pub_sub, redis_server)
             endpoint_fields['redis_pub_sub'] = new_redis_pub_sub
             await repo.ensure_endpoint_exists(**endpoint_fields)
             ###############
-            info_p2p_event(
-                p2p, '#5 Post to device: Refreshed redis address',
-                endpoint_uid=endpoint_uid, metadata=endpoint_fields
-            )
+            span.event('Refreshed redis address', metadata=endpoint_fields)
             ###############
         except Exception as e:
             logging.exception('Error while reselect redis server')
             ###############
-            info_p2p_event(
-                p2p, '#6 Post to device: Exception',
-                printable=repr(e)
-            )
+            span.event('Exception', printable=repr(e))
+            ###############
             pass  # mute any exception
     if success:
-        ###############
-        info_p2p_event(p2p, '#10 Post to device: HTTP OK', endpoint_uid=endpoint_uid)
-        ###############
+        span.outcome = 'websocket'
         return
     else:
         fcm_device_id = endpoint_fields.get('fcm_device_id')
         logging.debug(f'fcm_device_id: {fcm_device_id}')
         if fcm_device_id:
             ###############
-            info_p2p_event(
-                p2p, '#7 Post to device: Try to send with Firebase',
-                endpoint_uid=endpoint_uid, fcm_device_id=fcm_device_id
-            )
+            span.event('Try to send with Firebase', fcm_device_id=fcm_device_id)
             ###############
             firebase = FirebaseMessages(db=db)
             fcm_enabled = await firebase.enabled()
@@ -149,41 +189,24 @@ async def post_to_device(payload, endpoint_fields: dict, db: Database):
                 try:
                     success = await firebase.send(device_id=fcm_device_id, msg=message)
                     ###############
-                    info_p2p_event(
-                        p2p, '#8 Post to device: Send with Firebase SUCCESS!',
-                        endpoint_uid=endpoint_uid, fcm_device_id=fcm_device_id
-                    )
+                    span.event('Sent with Firebase', success=success)
                     ###############
                 except Exception:
                     success = False
                     logging.exception('FCM Error!')
                     ###############
-                    info_p2p_event(
-                        p2p, '#9 Post to device: Error while send with Firebase',
-                        endpoint_uid=endpoint_uid, fcm_device_id=fcm_device_id
-                    )
+                    span.event('Error while send with Firebase')
                     ###############
                 logging.debug(f'push operation returned success: {success}')
                 if success:
-                    ###############
-                    info_p2p_event(p2p, '#10 Post to device: HTTP OK', endpoint_uid=endpoint_uid)
-                    ###############
+                    span.outcome = 'firebase'
                     return
                 else:
-                    ###############
-                    info_p2p_event(p2p, f'#10 Post to device: HTTP 410 Status', endpoint_uid=endpoint_uid)
-                    ###############
                     raise HTTPException(status_code=410,
                                         detail='Recipient is registered but is not active with Firebase')
             else:
-                ###############
-                info_p2p_event(p2p, f'#10 Post to device: HTTP 421 Status', endpoint_uid=endpoint_uid)
-                ###############
                 raise HTTPException(status_code=421, detail='Firebase cloud messaging is not configured on server-side')
         else:
-            ###############
-            info_p2p_event(p2p, f'#11 Post to device: HTTP 410 Status', endpoint_uid=endpoint_uid)
-            ###############
             raise HTTPException(status_code=410, detail='Recipient is registered but is not active')
 
 
@@ -198,18 +221,19 @@ async def endpoint(request: Request, endpoint_uid: str, db: Database = Depends(g
     if content_type not in EXPECTED_CONTENT_TYPES:
         raise HTTPException(status_code=415, detail='Expected content types: %s' % str(EXPECTED_CONTENT_TYPES))
 
-    repo = Repo(db=db, memcached=GlobalMemcachedClient.get())
-    endpoint_fields = await repo.load_endpoint(endpoint_uid)
+    span = GlobalTracer.get().start_span(DELIVERY_SPAN, endpoint_uid=endpoint_uid)
+    with span:
+        repo = Repo(db=db, memcached=GlobalMemcachedClient.get())
+        endpoint_fields = await repo.load_endpoint(endpoint_uid)
+        span.event('Endpoint loaded')
 
-    logging.debug('endpoint_fields: ' + repr(endpoint_fields))
+        logging.debug('endpoint_fields: ' + repr(endpoint_fields))
 
-    payload = b''
-    async for chunk in request.stream():
-        payload += chunk
-    if endpoint_fields:
-        await post_to_device(payload, endpoint_fields, db)
-    else:
-        raise HTTPException(status_code=404, detail='Not Found')
+        payload = await RequestBodyReader.read(request)
+        if endpoint_fields:
+            await post_to_device(payload, endpoint_fields, db, span=span)
+        else:
+            raise HTTPException(status_code=404, detail='Not Found')
 
 
 @router.post(f'/{ROUTER_PATH}', status_code=202)
@@ -222,40 +246,47 @@ async def routing(request: Request, db: Database = Depends(get_db)):
     if content_type not in EXPECTED_CONTENT_TYPES:
         raise HTTPException(status_code=415, detail='Expected content types: %s' % str(EXPECTED_CONTENT_TYPES))
 
-    payload = b''
-    async for chunk in request.stream():
-        payload += chunk
-    mediator_vk, mediator_sk = settings.KEYPAIR
-    repo = Repo(db=db, memcached=GlobalMemcachedClient.get())
-    try:
-        recipients = extract_recipients(payload)
-        recip_verkeys = [recp['header']['kid'] for recp in recipients if 'header' in recp.keys()]
-        if mediator_vk in recip_verkeys:
-            msg, sender_vk, recip_vk = unpack_message(payload, my_verkey=mediator_vk, my_sigkey=mediator_sk)
-            fwd = json.loads(msg)
-            if fwd.get('@type') != FORWARD:
-                raise HTTPException(status_code=400, detail='Message partially decoded but forwarded message expected')
-            route_to_vk = fwd.get('to', None)
-            if not route_to_vk:
-                raise HTTPException(status_code=400, detail='Expected "to" attribute in Forwarded message')
-            msg = fwd.get('msg', None)
-            if not msg:
-                raise HTTPException(status_code=400, detail='Expected "msg" attribute in Forwarded message')
-            endpoint_fields = await repo.load_endpoint_via_routing_key(route_to_vk)
-            if endpoint_fields:
-                await post_to_device(json.dumps(msg).encode(), endpoint_fields, db)
-            else:
-                raise HTTPException(status_code=400, detail='Unknown destination key')
-        else:
-            # Re-route to first known verkey
-            for route_to_vk in recip_verkeys:
+    span = GlobalTracer.get().start_span(DELIVERY_SPAN)
+    with span:
+        payload = await RequestBodyReader.read(request)
+        mediator_vk, mediator_sk = settings.KEYPAIR
+        repo = Repo(db=db, memcached=GlobalMemcachedClient.get())
+        try:
+            # Envelope is parsed once: unpack_message and re-routing reuse parsed structure
+            jwe = json.loads(payload)
+            recipients = extract_recipients(jwe)
+            recip_verkeys = [recp['header']['kid'] for recp in recipients if 'header' in recp.keys()]
+            if mediator_vk in recip_verkeys:
+                msg, sender_vk, recip_vk = unpack_message(jwe, my_verkey=mediator_vk, my_sigkey=mediator_sk)
+                fwd = json.loads(msg)
+                if fwd.get('@type') != FORWARD:
+                    raise HTTPException(
+                        status_code=400, detail='Message partially decoded but forwarded message expected'
+                    )
+                route_to_vk = fwd.get('to', None)
+                if not route_to_vk:
+                    raise HTTPException(status_code=400, detail='Expected "to" attribute in Forwarded message')
+                msg = fwd.get('msg', None)
+                if not msg:
+                    raise HTTPException(status_code=400, detail='Expected "msg" attribute in Forwarded message')
                 endpoint_fields = await repo.load_endpoint_via_routing_key(route_to_vk)
+                span.event('Endpoint loaded')
                 if endpoint_fields:
-                    await post_to_device(payload, endpoint_fields, db)
-                    return
-            raise HTTPException(status_code=400, detail='No one of recipient keys registered')
-    except:
-        raise HTTPException(status_code=400, detail='Expected forwarded message in request body')
+                    await post_to_device(msg, endpoint_fields, db, span=span)
+                else:
+                    raise HTTPException(status_code=400, detail='Unknown destination key')
+            else:
+                # Re-route to first known verkey
+                endpoints = await repo.load_endpoints_via_routing_keys(recip_verkeys)
+                span.event('Endpoint loaded')
+                for route_to_vk in recip_verkeys:
+                    endpoint_fields = endpoints.get(route_to_vk)
+                    if endpoint_fields:
+                        await post_to_device(jwe, endpoint_fields, db, span=span)
+                        return
+                raise HTTPException(status_code=400, detail='No one of recipient keys registered')
+        except:
+            raise HTTPException(status_code=400, detail='Expected forwarded message in request body')
 
 
 @router.websocket(f"/{WS_PATH_PREFIX}/events")
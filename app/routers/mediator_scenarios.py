@@ -3,7 +3,7 @@ import hashlib
 import json
 import logging
 from urllib.parse import urljoin
-from typing import Optional, Dict
+from typing import Optional, Dict, Union
 
 import sirius_sdk
 from sirius_sdk.agent.listener import Event
@@ -21,7 +21,9 @@ from app.core.global_config import GlobalConfig
 from app.core.redis import RedisPull, AsyncRedisChannel, AsyncRedisGroup
 from app.core.rfc import extract_key as rfc_extract_key, ensure_is_key as rfc_ensure_is_key
 from app.core.websocket_listener import WebsocketListener
-from app.core.bus import Bus
+from app.core.bus import Bus, BusOverflowError
+from app.core.singletons import GlobalPendingEntriesReclaimer
+from app.core.metrics import ActiveSessions
 from app.settings import KEYPAIR, DID
 from app.utils import build_endpoint_url, make_group_id_mangled
 from rfc.bus import *
@@ -33,6 +35,7 @@ from .utils import build_did_doc_extra, post_create_pairwise, build_consistent_e
 
 URI_QUEUE_TRANSPORT = 'didcomm:transport/queue'
 DEFAULT_QUEUE_GROUP_ID = 'default_group_id_for_inbound_queue'
+REDIS_READ_BATCH_SIZE = 100
 
 
 class BasicMessageProblemReport(AriesProblemReport, metaclass=RegisterMessage):
@@ -45,27 +48,32 @@ async def protocol_listener(
 ):
     bus = Bus()
     logging.debug(f'Start protocol_listener topic: {topic} thread_id: {thread_id}')
+
+    async def send(event: Union[BusEvent, BusProblemReport]):
+        if pickup:
+            await pickup.put(event, msg_id=event.id)
+        elif p2p:
+            packed = await sirius_sdk.Crypto.pack_message(
+                message=json.dumps(event),
+                recipient_verkeys=[p2p.their.verkey],
+                sender_verkey=p2p.me.verkey
+            )
+            await ws.send_bytes(packed)
+        else:
+            await ws.send_bytes(json.dumps(event).encode())
+
     try:
         async for payload in bus.listen(topic, on=on):
             event = BusEvent(payload=payload, thread_id=thread_id)
             if parent_thread_id:
                 set_parent_thread_id(event, parent_thread_id)
-            if p2p:
-                packed = await sirius_sdk.Crypto.pack_message(
-                    message=json.dumps(event),
-                    recipient_verkeys=[p2p.their.verkey],
-                    sender_verkey=p2p.me.verkey
-                )
-                if pickup:
-                    await pickup.put(event, msg_id=event.id)
-                else:
-                    await ws.send_bytes(packed)
-            else:
-                if pickup:
-                    await pickup.put(event, msg_id=event.id)
-                else:
-                    payload = json.dumps(event).encode()
-                    await ws.send_bytes(payload)
+            await send(event)
+    except BusOverflowError:
+        # Subscription is closed, client should subscribe again
+        await send(BusProblemReport(
+            problem_code='overflow', explain='Events were not read in time and some were lost',
+            thread_id=thread_id
+        ))
     finally:
         logging.debug(f'Stop protocol_listener topic: {topic} thread_id: {thread_id}')
 
@@ -87,6 +95,7 @@ async def onboard(websocket: WebSocket, repo: Repo, cfg: GlobalConfig):
     listener = WebsocketListener(ws=websocket, my_keys=KEYPAIR)
     protocols_listeners: Dict[str, asyncio.Task] = {}
     pickup = PickUpStateMachine(max_queue_size=1)
+    ActiveSessions.pickups.add(pickup)
     use_queue_transport = False
     p2p_session: Optional[sirius_sdk.Pairwise] = None
     try:
@@ -354,6 +363,7 @@ async def onboard(websocket: WebSocket, repo: Repo, cfg: GlobalConfig):
                             payload = op.payload
                             if payload:
                                 if isinstance(payload, bytes):
+                                    # Subscribed workers are counted, not listening sessions (see BusPublishResponse)
                                     recipients_num = 0
                                     for topic in topics:
                                         num = await protocols_bus.publish(topic, payload)
@@ -409,51 +419,74 @@ async def endpoint_processor(
 
     async def redis_listener(redis_pub_sub: str):
         # Read from redis channel in infinite loop
-        pulls = RedisPull()
+        pulls = RedisPull(reclaimer=GlobalPendingEntriesReclaimer.get())
         mangled_group_id = make_group_id_mangled(group_id, endpoint_uid)
-        listener = pulls.listen(address=redis_pub_sub, group_id=mangled_group_id, read_count=1)
+        listener = pulls.listen(address=redis_pub_sub, group_id=mangled_group_id, read_count=REDIS_READ_BATCH_SIZE)
         try:
             logging.debug(f'++++++++++++ listen: {redis_pub_sub}')
-            async for not_closed, request in listener:
-                logging.debug(f'++++++++++++ not_closed: {not_closed}')
+            while True:
+                not_closed, requests = await listener.get_batch(max_count=REDIS_READ_BATCH_SIZE)
+                logging.debug(f'++++++++++++ not_closed: {not_closed} batch size: {len(requests)}')
                 if not_closed:
-                    req: RedisPull.Request = request
-                    ###############
-                    info_p2p_event(
-                        p2p, 'Websocket endpoint listener event',
-                        endpoint_uid=endpoint_uid,
-                        group_id=group_id,
-                        event={
-                            'message': req.message
-                        }
-                    )
-                    ###############
+                    for req in requests:
+                        ###############
+                        info_p2p_event(
+                            p2p, 'Websocket endpoint listener event',
+                            endpoint_uid=endpoint_uid,
+                            group_id=group_id,
+                            event={
+                                'message': req.message
+                            }
+                        )
+                        ###############
                     if pickup:
-                        logging.debug('++++++++++++ send message via pickup ')
-                        await pickup.put(request.message)
+                        logging.debug('++++++++++++ send messages via pickup ')
+                        # Put waits while pickup queue is full, every message is acked as soon as it is queued,
+                        # so only messages of queue size limit are acked but not collected by pickup client
+                        for req in requests:
+                            await pickup.put(req.message)
+                            await listener.ack_batch([req])
                         ###############
                         info_p2p_event(
                             p2p, 'Websocket endpoint listener event -> sent via pickup protocol',
-                            endpoint_uid=endpoint_uid, group_id=group_id
+                            endpoint_uid=endpoint_uid, group_id=group_id, count=len(requests)
                         )
                         ###############
                     else:
-                        logging.debug('++++++++++++ send message via websocket ')
-                        await websocket.send_json(request.message)
+                        logging.debug('++++++++++++ send messages via websocket ')
+                        for req in requests:
+                            await websocket.send_json(req.message)
                         ###############
                         info_p2p_event(
                             p2p, 'Websocket endpoint listener event -> sent via websocket',
-                            endpoint_uid=endpoint_uid, group_id=group_id
+                            endpoint_uid=endpoint_uid, group_id=group_id, count=len(requests)
                         )
                         ###############
-                    logging.debug('+++++++++++ message was sent via websocket ')
-                    await req.ack()
-                    logging.debug('++++++++++ message acked ')
+                        logging.debug('+++++++++++ messages were sent via websocket ')
+                        await listener.ack_batch(requests)
+                    logging.debug('++++++++++ messages acked ')
                 else:
                     break
         finally:
             await listener.close()
 
+    async def stream_follower(redis_pub_sub: str):
+        while True:
+            await redis_listener(redis_pub_sub)
+            # Listener is closed on stream errors, for example old stream was deleted
+            # when StreamsRebalancer migrated endpoint to other redis server
+            endpoint = await repo.load_endpoint(endpoint_uid)
+            new_redis_pub_sub = endpoint.get('redis_pub_sub') if endpoint else None
+            if not new_redis_pub_sub or new_redis_pub_sub == redis_pub_sub:
+                return
+            ###############
+            info_p2p_event(
+                p2p, 'Websocket endpoint listener follows migrated stream',
+                endpoint_uid=endpoint_uid, group_id=group_id, old=redis_pub_sub, new=new_redis_pub_sub
+            )
+            ###############
+            redis_pub_sub = new_redis_pub_sub
+
     logging.debug('')
     logging.debug('++++++++++++++++++++++++++++++++++++++++++++++++++')
     logging.debug(f'+++ Redis listener for endpoint_uid: {endpoint_uid} group_id: {group_id}')
@@ -473,7 +506,7 @@ async def endpoint_processor(
         )
         ###############
     if data and data.get('redis_pub_sub'):
-        coro = redis_listener(data['redis_pub_sub'])
+        coro = stream_follower(data['redis_pub_sub'])
         if exit_on_disconnect:
             fut = asyncio.ensure_future(coro)
             try:
@@ -507,7 +540,7 @@ async def endpoint_long_polling(request: Request, endpoint_uid: str, repo: Repo,
     logging.debug('long-polling endpoint data: ' + repr(data))
     if data and data.get('redis_pub_sub'):
         # Read from redis channel in infinite loop
-        pulls = RedisPull()
+        pulls = RedisPull(reclaimer=GlobalPendingEntriesReclaimer.get())
         listener = pulls.listen(address=data['redis_pub_sub'], group_id=group_id)
 
         async def wait_for_close_conn():
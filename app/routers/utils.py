@@ -1,6 +1,8 @@
+import asyncio
 import hashlib
 import json
 import logging
+from typing import Optional, AsyncIterable, Callable, Any
 from urllib.parse import urljoin
 
 import sirius_sdk
@@ -8,10 +10,16 @@ from sirius_sdk.encryption import pack_message
 from sirius_sdk import Pairwise
 from sirius_sdk.agent.aries_rfc.feature_0160_connection_protocol.messages import ConnProtocolMessage
 
+import app.db.crud
 from app.settings import KEYPAIR, DID, MEDIATOR_SERVICE_TYPE, FCM_SERVICE_TYPE
 from app.core.repo import Repo
+from app.core.pairwise import MediatorPairwiseList
 from app.utils import async_build_ws_endpoint_addr, async_build_long_polling_addr
-from app.core.redis import choice_server_address as choice_redis_server_address
+from app.core.redis import choice_endpoint_server_address
+
+
+IMPORT_CHUNK_SIZE = 500
+IMPORT_MAX_REPORTED_ERRORS = 100
 
 
 def build_consistent_endpoint_uid(did: str) -> str:
@@ -23,32 +31,9 @@ async def build_did_doc_extra(repo: Repo, their_did: str, their_verkey: str, gro
     :return: endpoint addr, endpoint-uid, extra did_doc
     """
     ws_endpoint = await async_build_ws_endpoint_addr(repo.db)
+    long_polling_endpoint = await async_build_long_polling_addr(repo.db)
     endpoint_uid = build_consistent_endpoint_uid(their_did)
-    # Declare MediatorService endpoint via DIDDoc
-    did_doc = ConnProtocolMessage.build_did_doc(did=DID, verkey=KEYPAIR[0], endpoint=ws_endpoint)
-    did_doc_extra = {'service': did_doc['service']}
-    mediator_service_endpoint = await async_build_ws_endpoint_addr(repo.db)
-    mediator_service_endpoint = urljoin(mediator_service_endpoint, f'?endpoint={endpoint_uid}')
-    if group_id is not None:
-        mediator_service_endpoint += f'&group_id={group_id}'
-    did_doc_extra['service'].append({
-        "id": 'did:peer:' + DID + ";indy",
-        "type": MEDIATOR_SERVICE_TYPE,
-        "priority": 1,
-        "recipientKeys": [],
-        "serviceEndpoint": mediator_service_endpoint,
-    })
-    long_polling_mediator_service_endpoint = await async_build_long_polling_addr(repo.db)
-    long_polling_mediator_service_endpoint = urljoin(long_polling_mediator_service_endpoint, f'?endpoint={endpoint_uid}')
-    if group_id is not None:
-        long_polling_mediator_service_endpoint += f'&group_id={group_id}'
-    did_doc_extra['service'].append({
-        "id": 'did:peer:' + DID + ";indy",
-        "type": MEDIATOR_SERVICE_TYPE,
-        "priority": 2,
-        "recipientKeys": [],
-        "serviceEndpoint": long_polling_mediator_service_endpoint,
-    })
+    did_doc_extra = build_mediator_services(ws_endpoint, long_polling_endpoint, endpoint_uid, group_id)
 
     # configure redis pubsub infrastructure for endpoint
     data = await repo.load_endpoint(endpoint_uid)
@@ -65,7 +50,7 @@ async def build_did_doc_extra(repo: Repo, their_did: str, their_verkey: str, gro
 
     if need_to_update:
         if redis_pub_sub_to_store is None:
-            redis_server = await choice_redis_server_address()
+            redis_server = await choice_endpoint_server_address(endpoint_uid)
             redis_pub_sub = f'{redis_server}/{endpoint_uid}'
         else:
             # don't update
@@ -78,6 +63,34 @@ async def build_did_doc_extra(repo: Repo, their_did: str, their_verkey: str, gro
     return ws_endpoint, endpoint_uid, did_doc_extra
 
 
+def build_mediator_services(ws_endpoint: str, long_polling_endpoint: str, endpoint_uid: str, group_id: str = None) -> dict:
+    """Extra did_doc declaring MediatorService endpoints for endpoint-uid"""
+    # Declare MediatorService endpoint via DIDDoc
+    did_doc = ConnProtocolMessage.build_did_doc(did=DID, verkey=KEYPAIR[0], endpoint=ws_endpoint)
+    did_doc_extra = {'service': did_doc['service']}
+    mediator_service_endpoint = urljoin(ws_endpoint, f'?endpoint={endpoint_uid}')
+    if group_id is not None:
+        mediator_service_endpoint += f'&group_id={group_id}'
+    did_doc_extra['service'].append({
+        "id": 'did:peer:' + DID + ";indy",
+        "type": MEDIATOR_SERVICE_TYPE,
+        "priority": 1,
+        "recipientKeys": [],
+        "serviceEndpoint": mediator_service_endpoint,
+    })
+    long_polling_mediator_service_endpoint = urljoin(long_polling_endpoint, f'?endpoint={endpoint_uid}')
+    if group_id is not None:
+        long_polling_mediator_service_endpoint += f'&group_id={group_id}'
+    did_doc_extra['service'].append({
+        "id": 'did:peer:' + DID + ";indy",
+        "type": MEDIATOR_SERVICE_TYPE,
+        "priority": 2,
+        "recipientKeys": [],
+        "serviceEndpoint": long_polling_mediator_service_endpoint,
+    })
+    return did_doc_extra
+
+
 async def post_create_pairwise(repo: Repo, p2p: Pairwise, endpoint_uid: str):
     """
     :return: endpoint addr, endpoint-uid, extra did_doc
@@ -126,9 +139,7 @@ def validate_verkey(verkey: str) -> bool:
         pack_message('test', to_verkeys=[verkey])
         return True
     except Exception as e:
-        print('===================================')
-        print(repr(e))
-        print('===================================')
+        logging.debug(f'Invalid verkey "{verkey}": {e!r}')
         return False
 
 
@@ -138,6 +149,16 @@ async def create_static_connection(repo: Repo, label: str, their_did: str, their
         their_did=their_did,
         their_verkey=their_verkey
     )
+    p2p = build_static_pairwise(label, their_did, their_verkey, fcm_device_id, ws_endpoint, did_doc_extra)
+
+    await sirius_sdk.DID.store_their_did(their_did, their_verkey)
+    await sirius_sdk.PairwiseList.ensure_exists(p2p)
+    return p2p
+
+
+def build_static_pairwise(
+        label: str, their_did: str, their_verkey: str, fcm_device_id: Optional[str], ws_endpoint: str, did_doc_extra: dict
+) -> Pairwise:
     their_endpoint = 'ws://'
     their_did_doc = ConnProtocolMessage.build_did_doc(did=their_did, verkey=their_verkey, endpoint=their_endpoint)
     if fcm_device_id:
@@ -151,8 +172,6 @@ async def create_static_connection(repo: Repo, label: str, their_did: str, their
     my_did_doc = ConnProtocolMessage.build_did_doc(did=DID, verkey=KEYPAIR[0], endpoint=ws_endpoint)
     my_did_doc['service'] = did_doc_extra['service']
 
-    await sirius_sdk.DID.store_their_did(their_did, their_verkey)
-
     me = Pairwise.Me(
         did=DID,
         verkey=KEYPAIR[0],
@@ -183,9 +202,101 @@ async def create_static_connection(repo: Repo, label: str, their_did: str, their
             'did_doc': their_did_doc
         }
     }
-    p2p = Pairwise(me=me, their=their, metadata=metadata)
-    await sirius_sdk.PairwiseList.ensure_exists(p2p)
-    return p2p
+    return Pairwise(me=me, their=their, metadata=metadata)
+
+
+async def import_static_connections(
+        repo: Repo, chunks: AsyncIterable[bytes], chunk_size: int = IMPORT_CHUNK_SIZE,
+        on_progress: Callable[[dict], Any] = None
+) -> dict:
+    """Bulk import of static connections from NDJSON records: {"did", "verkey", "label", "fcm_device_id"}
+
+    Records are written by chunks: agents, endpoints and pairwises are upserted with multi-row statements
+    in transaction per chunk, then cache is warmed with written agents and endpoints and cached pairwises
+    are invalidated.
+
+    :param chunks: NDJSON stream, split to lines here
+    :return: counters: lines, imported, errors and invalid - first IMPORT_MAX_REPORTED_ERRORS of {"line", "error"}
+    """
+    ws_endpoint = await async_build_ws_endpoint_addr(repo.db)
+    long_polling_endpoint = await async_build_long_polling_addr(repo.db)
+    counters = {'lines': 0, 'imported': 0, 'errors': 0, 'invalid': []}
+    batch = {}
+    verkeys = {}
+    pairwise_list = MediatorPairwiseList(repo.db)
+
+    async def flush():
+        agents_values, endpoints_values, pairwises_values = [], [], []
+        for record in batch.values():
+            agents_values.append(record['agent'])
+            endpoints_values.append(record['endpoint'])
+            pairwises_values.append(record['pairwise'])
+        agents, endpoints = await app.db.crud.bulk_upsert_static_connections(
+            repo.db, agents_values, endpoints_values, pairwises_values
+        )
+        await repo.warm_cache(agents=agents, endpoints=endpoints)
+        await asyncio.gather(*[pairwise_list.invalidate(did) for did in batch.keys()])
+        counters['imported'] += len(batch)
+        batch.clear()
+        verkeys.clear()
+        if on_progress:
+            on_progress({key: value for key, value in counters.items() if key != 'invalid'})
+
+    async for line in iter_lines(chunks):
+        counters['lines'] += 1
+        try:
+            record = json.loads(line)
+            did, verkey, label = record['did'], record['verkey'], record['label']
+            fcm_device_id = record.get('fcm_device_id') or None
+            if not did or not label or not verkey:
+                raise ValueError('Empty did, verkey or label')
+            if not validate_verkey(verkey):
+                raise ValueError(f'Invalid verkey "{verkey}"')
+        except (ValueError, KeyError, TypeError) as e:
+            counters['errors'] += 1
+            if len(counters['invalid']) < IMPORT_MAX_REPORTED_ERRORS:
+                error = f'Missing field {e}' if isinstance(e, KeyError) else str(e)
+                counters['invalid'].append({'line': counters['lines'], 'error': error})
+            continue
+        endpoint_uid = build_consistent_endpoint_uid(did)
+        redis_server = await choice_endpoint_server_address(endpoint_uid)
+        did_doc_extra = build_mediator_services(ws_endpoint, long_polling_endpoint, endpoint_uid)
+        p2p = build_static_pairwise(label, did, verkey, fcm_device_id, ws_endpoint, did_doc_extra)
+        # Same did or verkey in one multi-row upsert is not allowed: last record wins
+        previous = batch.pop(did, None)
+        if previous:
+            verkeys.pop(previous['agent']['verkey'], None)
+        batch.pop(verkeys.pop(verkey, None), None)
+        verkeys[verkey] = did
+        batch[did] = {
+            'agent': {'did': did, 'verkey': verkey, 'fcm_device_id': fcm_device_id},
+            'endpoint': {
+                'uid': endpoint_uid, 'redis_pub_sub': f'{redis_server}/{endpoint_uid}',
+                'verkey': verkey, 'fcm_device_id': fcm_device_id
+            },
+            'pairwise': {
+                'their_did': did, 'their_verkey': verkey, 'my_did': p2p.me.did, 'my_verkey': p2p.me.verkey,
+                'metadata': p2p.metadata, 'their_label': label
+            }
+        }
+        if len(batch) >= chunk_size:
+            await flush()
+    if batch:
+        await flush()
+    return counters
+
+
+async def iter_lines(chunks: AsyncIterable[bytes]) -> AsyncIterable[bytes]:
+    """Split stream of bytes chunks to non-empty lines"""
+    tail = b''
+    async for chunk in chunks:
+        lines = (tail + chunk).split(b'\n')
+        tail = lines.pop()
+        for line in lines:
+            if line.strip():
+                yield line
+    if tail.strip():
+        yield tail
 
 
 def build_protocol_topic(their_did: str, binding_id: str) -> str:
@@ -13,3 +13,5 @@ pytest tests/test_repo.py
 pytest tests/test_bus.py
 pytest tests/test_pickup.py
 pytest tests/test_storage.py
+pytest tests/test_tracing.py
+pytest tests/test_elk.py
@@ -19,13 +19,14 @@ if log_level:
 
 
 if os.getenv('ELK', None) == 'on':
-    from app.elk import ElkJsonFormatter
+    from app.elk import ElkJsonFormatter, AsyncLogHandler
     logger = logging.getLogger()
     logHandler = logging.StreamHandler()
     formatter = ElkJsonFormatter()
     logHandler.setFormatter(formatter)
     logger.handlers.clear()
-    logger.addHandler(logHandler)
+    # Records are serialized and written by background thread, max count of queued records is limited
+    logger.addHandler(AsyncLogHandler(logHandler, queue_size=int(os.getenv('LOG_QUEUE_SIZE', 10000))))
 
 
 templates = Jinja2Templates(directory="templates")
@@ -59,11 +60,53 @@ for item in MSG_DELIVERY_SERVICES.split(','):
         address = item
         REDIS.append(address)
 
+# Consistent hashing of endpoints streams and bus topics over redis servers:
+# weights are comma-separated list of "address=weight", for example: "192.168.1.10=2,192.168.1.11=1"
+REDIS_WEIGHTS = {}
+for item in (os.environ.get('MSG_DELIVERY_WEIGHTS') or '').split(','):
+    if item.strip():
+        address, _, weight = item.strip().replace('redis://', '').rpartition('=')
+        REDIS_WEIGHTS[address] = int(weight)
+REDIS_VNODES = int(os.getenv('MSG_DELIVERY_VNODES', 40))
+
 
 WEBROOT = os.environ.get('WEBROOT')
 
 DEVICE_ACK_TIMEOUT = 15
 
+# Delivery modes for inbound messages:
+#   - ack: HTTP handler waits for device ACK via reverse channel
+#   - durable: HTTP handler returns as soon as message is enqueued to stream,
+#              ACK is processed asynchronously by in-flight tracker
+DELIVERY_MODE_ACK = 'ack'
+DELIVERY_MODE_DURABLE = 'durable'
+DELIVERY_MODE = os.getenv('DELIVERY_MODE', DELIVERY_MODE_ACK)
+assert DELIVERY_MODE in [DELIVERY_MODE_ACK, DELIVERY_MODE_DURABLE], \
+    f'DELIVERY_MODE env variable must be one of: "{DELIVERY_MODE_ACK}", "{DELIVERY_MODE_DURABLE}"'
+
+# Retention of endpoint streams: approximate max entries count and max age (sec) of entries, 0 - unlimited
+STREAM_MAX_LEN = int(os.getenv('STREAM_MAX_LEN', 10000))
+STREAM_MAX_AGE = int(os.getenv('STREAM_MAX_AGE', 60*60*24*7))
+STREAMS_SWEEP_INTERVAL = int(os.getenv('STREAMS_SWEEP_INTERVAL', 60*60))
+
+# Redis connections pools per server: shared pool for commands and pool for blocking XREADGROUP/SUBSCRIBE
+REDIS_POOL_MAX_SIZE = int(os.getenv('REDIS_POOL_MAX_SIZE', 100))
+REDIS_BLOCKING_POOL_MAX_SIZE = int(os.getenv('REDIS_BLOCKING_POOL_MAX_SIZE', 1000))
+
+# Max size (bytes) of envelope posted to endpoints, 0 - unlimited
+MAX_ENVELOPE_SIZE = int(os.getenv('MAX_ENVELOPE_SIZE', 10*1024*1024))
+
+# Tracing of message delivery stages: sink of spans (log | none) and share of sampled spans,
+# failed deliveries are traced regardless of sampling
+TRACE_SINK = os.getenv('TRACE_SINK', 'log')
+TRACE_SAMPLE_RATE = float(os.getenv('TRACE_SAMPLE_RATE', 0.01))
+
+# Directory where workers of instance share metrics snapshots for /maintenance/metrics, empty - worker's own only
+METRICS_DIR = os.getenv('METRICS_DIR', '/tmp/mediator_metrics')
+
+# Serializer of Repo cached values: json | msgpack (requires msgpack package)
+REPO_CACHE_CODEC = os.getenv('REPO_CACHE_CODEC', 'json')
+
 # Postgres
 DATABASE_HOST = os.getenv('DATABASE_HOST')
 assert DATABASE_HOST is not None, 'You must set DATABASE_HOST env variable'
@@ -11,7 +11,8 @@ from sirius_sdk.messaging import restore_message_instance
 from app.main import app
 from app.dependencies import get_db
 from app.settings import REDIS as REDIS_SERVERS, WS_PATH_PREFIX
-from core.bus import Bus
+from core.bus import Bus, BusSubscriber, BusOverflowError
+from app.core.redis import build_hash_ring
 from app.utils import build_invitation
 from app.routers.mediator_scenarios import URI_QUEUE_TRANSPORT, build_protocol_topic
 from rfc.bus import *
@@ -36,6 +37,23 @@ async def test_conn_pool_persist():
     assert len(pools) == len(REDIS_SERVERS)
 
 
+def test_topic_url():
+    topics = [f'topic-' + uuid.uuid4().hex for n in range(100)]
+    for topic in topics:
+        assert Bus.get_topic_url(topic) == f'redis://{build_hash_ring().get_node(topic)}'
+    # Cached topics are placed on rebuilt ring when servers list was changed
+    ring = build_hash_ring(REDIS_SERVERS + ['redis3'])
+    assert any(ring.get_node(topic) == 'redis3' for topic in topics)
+    REDIS_SERVERS.append('redis3')
+    try:
+        for topic in topics:
+            assert Bus.get_topic_url(topic) == f'redis://{ring.get_node(topic)}'
+    finally:
+        REDIS_SERVERS.remove('redis3')
+    for topic in topics:
+        assert Bus.get_topic_url(topic) == f'redis://{build_hash_ring().get_node(topic)}'
+
+
 @pytest.mark.asyncio
 async def test_pub_sub():
     bus = Bus()
@@ -62,6 +80,46 @@ async def test_pub_sub():
         fut.cancel()
 
 
+@pytest.mark.asyncio
+async def test_subscriptions_multiplexer():
+    bus = Bus()
+    subscriptions = bus.get_subscriptions()
+    topics = [f'topic-{n}-' + uuid.uuid4().hex for n in range(10)]
+    # Many listeners share one connection per redis server
+    subscribers = [await subscriptions.subscribe(*topics) for n in range(5)]
+    counters = subscriptions.counters
+    assert counters['topics'] == 10
+    assert counters['subscribers'] == 5
+    assert counters['connections'] == len(set(bus.get_topic_url(topic) for topic in topics))
+    for topic in topics:
+        count = await bus.publish(topic, topic.encode())
+        assert count == 1
+    for subscriber in subscribers:
+        rcv = [await asyncio.wait_for(subscriber.get(), timeout=5) for n in range(len(topics))]
+        assert sorted(rcv) == sorted(topic.encode() for topic in topics)
+    # Topic is unsubscribed when last listener is gone
+    for subscriber in subscribers:
+        subscriptions.unsubscribe(subscriber)
+    await asyncio.sleep(0.5)
+    assert subscriptions.counters['topics'] == 0
+    for topic in topics:
+        count = await bus.publish(topic, b'')
+        assert count == 0
+
+
+@pytest.mark.asyncio
+async def test_slow_subscriber():
+    subscriber = BusSubscriber(topics=['topic'], maxsize=3)
+    for n in range(5):
+        subscriber.put_nowait(str(n).encode())
+    assert subscriber.dropped == 2
+    assert subscriber.overflowed is True
+    # Queued messages are returned, then listener is notified of lost messages
+    assert [await subscriber.get() for n in range(3)] == [b'0', b'1', b'2']
+    with pytest.raises(BusOverflowError):
+        await subscriber.get()
+
+
 @pytest.mark.asyncio
 async def test_pub_sub_multiple_topics():
     topics = []
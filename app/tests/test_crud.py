@@ -1,4 +1,5 @@
 import uuid
+import asyncio
 import hashlib
 
 import pytest
@@ -142,6 +143,35 @@ async def test_routing_keys_ops(test_database: Database, random_endpoint_uid: st
     assert len(collection) == 1
 
 
+@pytest.mark.asyncio
+async def test_load_endpoints_via_routing_keys(test_database: Database, random_endpoint_uid: str, random_redis_pub_sub: str):
+    await ensure_endpoint_exists(test_database, uid=random_endpoint_uid, redis_pub_sub=random_redis_pub_sub, verkey='VERKEY')
+    key1, key2, unknown = uuid.uuid4().hex, uuid.uuid4().hex, uuid.uuid4().hex
+    await add_routing_key(test_database, random_endpoint_uid, key1)
+    await add_routing_key(test_database, random_endpoint_uid, key2)
+    endpoints = await load_endpoints_via_routing_keys(test_database, [key1, unknown, key2])
+    assert set(endpoints.keys()) == {key1, key2}
+    assert endpoints[key1] == endpoints[key2] == await load_endpoint(test_database, random_endpoint_uid)
+    assert await load_endpoints_via_routing_keys(test_database, []) == {}
+    # Single key resolving
+    assert await load_endpoint_for_routing_key(test_database, key1) == endpoints[key1]
+    assert await load_endpoint_for_routing_key(test_database, unknown) is None
+
+
+@pytest.mark.asyncio
+async def test_routing_keys_unique(test_database: Database, random_redis_pub_sub: str):
+    uid1, uid2, key = uuid.uuid4().hex, uuid.uuid4().hex, uuid.uuid4().hex
+    await ensure_endpoint_exists(test_database, uid=uid1, redis_pub_sub=random_redis_pub_sub)
+    await ensure_endpoint_exists(test_database, uid=uid2, redis_pub_sub=random_redis_pub_sub)
+    await add_routing_key(test_database, uid1, key)
+    # Key registered again is moved to other endpoint
+    added = await add_routing_key(test_database, uid2, key)
+    assert added['endpoint_uid'] == uid2
+    assert (await load_endpoint_for_routing_key(test_database, key))['uid'] == uid2
+    assert await list_routing_key(test_database, uid1) == []
+    assert len(await list_routing_key(test_database, uid2)) == 1
+
+
 @pytest.mark.asyncio
 async def test_agents_duplicates_for_verkey(test_database: Database, random_me: (str, str, str), random_their: (str, str, str)):
     """Check there no two ore more agents with same verkey
@@ -171,6 +201,87 @@ async def test_endpoints_duplicates_for_verkey(test_database: Database, random_m
     assert len(rows) == 1
 
 
+@pytest.mark.asyncio
+async def test_ensure_exists_concurrently(test_database: Database):
+    """Onboarding storm: agents connect and reconnect concurrently"""
+    items = [(uuid.uuid4().hex, 'redis://redis1/' + uuid.uuid4().hex, uuid.uuid4().hex) for n in range(100)]
+    for n in range(2):
+        await asyncio.gather(*[
+            ensure_endpoint_exists(test_database, uid=uid, redis_pub_sub=redis_pub_sub, verkey=verkey)
+            for uid, redis_pub_sub, verkey in items
+        ])
+    for uid, redis_pub_sub, verkey in items:
+        endpoint = await load_endpoint(test_database, uid)
+        assert endpoint['redis_pub_sub'] == redis_pub_sub
+        assert endpoint['verkey'] == verkey
+    # Omitted fields keep stored values
+    uid, redis_pub_sub, verkey = items[0]
+    await ensure_endpoint_exists(test_database, uid=uid, fcm_device_id='device-1')
+    endpoint = await load_endpoint(test_database, uid)
+    assert endpoint['redis_pub_sub'] == redis_pub_sub
+    assert endpoint['verkey'] == verkey
+    assert endpoint['fcm_device_id'] == 'device-1'
+    # Endpoint with the same verkey is replaced
+    new_uid = uuid.uuid4().hex
+    await ensure_endpoint_exists(test_database, uid=new_uid, redis_pub_sub=redis_pub_sub, verkey=verkey)
+    assert await load_endpoint(test_database, uid) is None
+    assert (await load_endpoint(test_database, new_uid))['verkey'] == verkey
+    # Agents
+    did, verkey = uuid.uuid4().hex, uuid.uuid4().hex
+    await ensure_agent_exists(test_database, did, verkey, metadata={'key': 'value'})
+    await asyncio.gather(*[ensure_agent_exists(test_database, did, verkey) for n in range(10)])
+    agent = await load_agent(test_database, did)
+    assert agent['verkey'] == verkey
+    assert agent['metadata'] == {'key': 'value'}
+    await ensure_agent_exists(test_database, 'other-' + did, verkey)
+    assert await load_agent(test_database, did) is None
+
+
+@pytest.mark.asyncio
+async def test_bulk_upsert_static_connections(test_database: Database, random_me: (str, str, str), random_their: (str, str, str)):
+    did1, verkey1, _ = random_me
+    did2, verkey2, _ = random_their
+    uid1, uid2 = uuid.uuid4().hex, uuid.uuid4().hex
+    # existing agent with verkey of imported one is removed
+    await ensure_agent_exists(test_database, 'old-did', verkey1)
+    agents_values = [
+        {'did': did1, 'verkey': verkey1, 'fcm_device_id': 'device-1'},
+        {'did': did2, 'verkey': verkey2, 'fcm_device_id': None},
+    ]
+    endpoints_values = [
+        {'uid': uid1, 'redis_pub_sub': 'redis://redis1/' + uid1, 'verkey': verkey1, 'fcm_device_id': 'device-1'},
+        {'uid': uid2, 'redis_pub_sub': 'redis://redis1/' + uid2, 'verkey': verkey2, 'fcm_device_id': None},
+    ]
+    pairwises_values = [
+        {
+            'their_did': did, 'their_verkey': verkey, 'my_did': 'my-did', 'my_verkey': 'my-verkey',
+            'metadata': {'their': {'did': did}}, 'their_label': f'Label {did}'
+        }
+        for did, verkey in [(did1, verkey1), (did2, verkey2)]
+    ]
+    stored_agents, stored_endpoints = await bulk_upsert_static_connections(
+        test_database, agents_values, endpoints_values, pairwises_values
+    )
+    assert len(stored_agents) == 2 and len(stored_endpoints) == 2
+    assert await load_agent(test_database, 'old-did') is None
+    agent = await load_agent(test_database, did1)
+    assert agent['verkey'] == verkey1 and agent['fcm_device_id'] == 'device-1'
+    assert agent in stored_agents
+    assert await load_endpoint(test_database, uid2) in stored_endpoints
+    assert await load_pairwises_count(test_database) == 2
+    # repeated import updates records, queues of endpoints are kept
+    endpoints_values[0]['redis_pub_sub'] = 'redis://redis2/' + uid1
+    endpoints_values[0]['fcm_device_id'] = None
+    pairwises_values[0]['their_label'] = 'Updated'
+    await bulk_upsert_static_connections(test_database, agents_values, endpoints_values, pairwises_values)
+    endpoint = await load_endpoint(test_database, uid1)
+    assert endpoint['redis_pub_sub'] == 'redis://redis1/' + uid1
+    assert endpoint['fcm_device_id'] == 'device-1'
+    assert await load_pairwises_count(test_database) == 2
+    collection = await load_pairwises(test_database, filters={'their_label': 'Updated'})
+    assert len(collection) == 1
+
+
 @pytest.mark.asyncio
 async def test_global_settings(test_database: Database):
     """Check Global settings for database operations pass expectations
@@ -331,3 +442,55 @@ async def test_load_pairwise_collection(test_database: Database, random_me: (str
     assert cnt == 2
     cnt = await load_pairwises_count(test_database, filters={'their_label': 'label1'})
     assert cnt == 11
+
+
+@pytest.mark.asyncio
+async def test_load_pairwises_page(test_database: Database, random_me: (str, str, str)):
+    pairwise_count = 25
+
+    for n in range(pairwise_count):
+        p2p = {
+            'their_did': f'their_did{n:02}',
+            'their_verkey': f'their_verkey{n}',
+            'my_did': f'my_did{n}',
+            'my_verkey': f'my_verkey{n}',
+            'metadata': {'their': {'label': f'Legacy{n}', 'did_doc': {'id': n}}},
+            'their_label': f'Label{n}' if n % 2 else None
+        }
+        sql = pairwises.insert()
+        await test_database.execute(query=sql, values=p2p)
+
+    # keyset pagination
+    loaded = []
+    after = None
+    while True:
+        page = await load_pairwises_page(test_database, after=after, limit=10)
+        loaded.extend(page)
+        if len(page) < 10:
+            break
+        after = page[-1]['their_did']
+    assert [p['their_did'] for p in loaded] == [f'their_did{n:02}' for n in range(pairwise_count)]
+    # projection: no did_docs, label of legacy records is restored from metadata
+    assert all('metadata' not in p for p in loaded)
+    assert loaded[0]['their_label'] == 'Legacy0'
+    assert loaded[1]['their_label'] == 'Label1'
+    # case-insensitive prefix filter
+    page = await load_pairwises_page(test_database, filters={'their_label': 'label1'}, limit=10)
+    assert [p['their_label'] for p in page] == ['Label1', 'Label11', 'Label13', 'Label15', 'Label17', 'Label19']
+    page = await load_pairwises_page(test_database, filters={'their_label': 'label1'}, after='their_did13', limit=10)
+    assert [p['their_label'] for p in page] == ['Label15', 'Label17', 'Label19']
+    # labels of legacy records are searchable too
+    page = await load_pairwises_page(test_database, filters={'their_label': 'legacy2'}, limit=10)
+    assert [p['their_label'] for p in page] == ['Legacy2', 'Legacy20', 'Legacy22', 'Legacy24']
+    # LIKE wildcards of search string are matched literally
+    assert await load_pairwises_page(test_database, filters={'their_label': '%1'}, limit=10) == []
+    assert await load_pairwises_page(test_database, filters={'their_label': 'label_'}, limit=10) == []
+    page = await load_pairwises_page(test_database, filters={'their_did': 'their_did2'}, limit=10)
+    assert [p['their_did'] for p in page] == ['their_did20', 'their_did21', 'their_did22', 'their_did23', 'their_did24']
+    # small collections are counted exactly
+    assert await load_pairwises_count(test_database, approximate=True) == pairwise_count
+    assert await load_pairwises_count(test_database, filters={'their_label': 'label1'}, approximate=True) == 6
+    # details
+    p = await load_pairwise(test_database, 'their_did03')
+    assert p['metadata']['their']['did_doc'] == {'id': 3}
+    assert await load_pairwise(test_database, 'unknown') is None
@@ -0,0 +1,64 @@
+import io
+import json
+import time
+import logging
+import threading
+
+from app.elk import ElkJsonFormatter, AsyncLogHandler
+
+
+def build_logger(name: str, handler: logging.Handler) -> logging.Logger:
+    logger = logging.getLogger(name)
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    logger.addHandler(handler)
+    return logger
+
+
+def test_async_log_handler():
+    stream = io.StringIO()
+    target = logging.StreamHandler(stream)
+    target.setFormatter(ElkJsonFormatter())
+    handler = AsyncLogHandler(target, batch_size=10)
+    logger = build_logger('test_async_log_handler', handler)
+    args = {'n': 0}
+    for n in range(100):
+        args['n'] = n
+        logger.info('Message %s', args['n'], extra={'stages': [{'stage': 'test', 'elapsed_ms': n}]})
+    handler.close()
+    logger.removeHandler(handler)
+
+    records = [json.loads(line) for line in stream.getvalue().splitlines()]
+    assert [r['message'] for r in records] == [f'Message {n}' for n in range(100)]
+    assert records[-1]['stages'] == [{'stage': 'test', 'elapsed_ms': 99}]
+    assert records[0]['level'] == 'INFO'
+    assert handler.metrics['written'] == 100
+    assert handler.metrics['batches'] >= 10
+    assert handler.metrics['dropped'] == 0
+
+
+def test_async_log_handler_backpressure():
+
+    class BlockedStream(io.StringIO):
+
+        def __init__(self):
+            super().__init__()
+            self.unblocked = threading.Event()
+
+        def write(self, s):
+            self.unblocked.wait()
+            return super().write(s)
+
+    stream = BlockedStream()
+    handler = AsyncLogHandler(logging.StreamHandler(stream), queue_size=10)
+    logger = build_logger('test_async_log_handler_backpressure', handler)
+    stamp = time.monotonic()
+    for n in range(1000):
+        logger.info(f'Message {n}')
+    # Caller is not blocked by stalled stream
+    assert time.monotonic() - stamp < 1
+    assert handler.metrics['dropped'] > 0
+    stream.unblocked.set()
+    handler.close()
+    logger.removeHandler(handler)
+    assert handler.metrics['written'] + handler.metrics['dropped'] == 1000
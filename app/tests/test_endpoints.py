@@ -23,6 +23,8 @@ from .helpers import override_get_db, override_sirius_sdk
 from .emulators import DIDCommRecipient as ClientEmulator
 from app.utils import build_invitation, make_group_id_mangled
 from core.redis import AsyncRedisGroup
+from app.core.tracing import Tracer, NullEventSink
+import app.routers.mediator as mediator
 
 
 client = TestClient(app)
@@ -516,3 +518,85 @@ def test_clean_redis_connection_on_endpoint_disconnect(test_database: Database,
         ch_infos = AsyncRedisGroup(redis_pub_sub, group_id=group_id_mangled)
         infos2 = asyncio.get_event_loop().run_until_complete(ch_infos.info_consumers())
         assert len(infos2) == 0
+
+
+def test_envelope_too_large(test_database: Database, random_me: (str, str, str), random_endpoint_uid: str):
+    """Check envelope larger than MAX_ENVELOPE_SIZE is rejected"""
+    content_type = 'application/ssi-agent-wire'
+
+    agent_did, agent_verkey, agent_secret = random_me
+    redis_pub_sub = 'redis://redis1/%s' % uuid.uuid4().hex
+
+    asyncio.get_event_loop().run_until_complete(ensure_endpoint_exists(
+        db=test_database, uid=random_endpoint_uid, redis_pub_sub=redis_pub_sub,
+        agent_id=agent_did, verkey=agent_verkey
+    ))
+    response = client.post(
+        build_endpoint_url(random_endpoint_uid),
+        headers={"Content-Type": content_type},
+        data=b'x' * (settings.MAX_ENVELOPE_SIZE + 1),
+    )
+    assert response.status_code == 413
+
+
+def test_forward_msg_delivered_unchanged(test_database: Database, random_me: (str, str, str), random_endpoint_uid: str, random_keys: (str, str)):
+    """Check forwarded msg is delivered as is whatever json value it is"""
+    content_type = 'application/didcomm-envelope-enc'
+
+    override_sirius_sdk()
+
+    agent_did, agent_verkey, agent_secret = random_me
+    redis_pub_sub = 'redis://redis1/%s' % uuid.uuid4().hex
+    routing_key, routing_secret = random_keys
+
+    asyncio.get_event_loop().run_until_complete(ensure_endpoint_exists(
+        db=test_database, uid=random_endpoint_uid, redis_pub_sub=redis_pub_sub,
+        agent_id=agent_did, verkey=agent_verkey
+    ))
+    asyncio.get_event_loop().run_until_complete(add_routing_key(
+        db=test_database, endpoint_uid=random_endpoint_uid, key=routing_key
+    ))
+    mediator_invitation = build_invitation()
+    mediator_vk = mediator_invitation['recipientKeys'][0]
+    wired = pack_message(json.dumps({'message': 'Hello!'}), to_verkeys=[routing_key])
+    expected_messages = [json.loads(wired), '{"message": "Hello!"}', 'Hello!']
+
+    with client.websocket_connect(f"/{WS_PATH_PREFIX}?endpoint={random_endpoint_uid}") as websocket:
+        sleep(3)  # give websocket timeout to accept connection
+        for expected_msg in expected_messages:
+            forwarded = {
+                '@id': uuid.uuid4().hex,
+                '@type': FORWARD,
+                'to': routing_key,
+                'msg': expected_msg
+            }
+            fwd = pack_message(json.dumps(forwarded), to_verkeys=[mediator_vk])
+            response = client.post(
+                settings.ROUTER_PATH,
+                headers={"Content-Type": content_type},
+                data=fwd,
+            )
+            assert response.status_code == 202
+            actual_msg = websocket.receive_json()
+            assert actual_msg == expected_msg
+
+
+def test_post_to_device_keeps_caller_span_open(monkeypatch):
+    """Check span passed to post_to_device is finished by caller only"""
+
+    async def deliver_to_device(message, endpoint_fields, db, span):
+        span.event('Sent via websocket', success=True)
+
+    monkeypatch.setattr(mediator, 'deliver_to_device', deliver_to_device)
+    tracer = Tracer(sink=NullEventSink(), sample_rate=0)
+
+    async def run():
+        with tracer.start_span('Post to device') as span:
+            await mediator.post_to_device({'message': 'Hello!'}, {'uid': 'uid1'}, db=None, span=span)
+            assert span.duration is None
+            raise RuntimeError('Error after delivery')
+
+    with pytest.raises(RuntimeError):
+        asyncio.get_event_loop().run_until_complete(run())
+    assert tracer.outcomes['Post to device'] == {'Exception': 1}
+    assert tracer.counters['failed'] == 1
@@ -1,6 +1,9 @@
+import os
+
 from fastapi.testclient import TestClient
 
 from app.main import app
+from app.core.metrics import MetricsWriter, WorkersMetrics
 
 
 client = TestClient(app)
@@ -14,3 +17,31 @@ def test_health_check():
     payload = response.json()
     assert payload['ok'] is True
     assert 'utc' in payload
+
+
+def test_metrics():
+    response = client.get(
+        url="/maintenance/metrics",
+    )
+    assert response.status_code == 200
+    assert response.headers['content-type'].startswith('text/plain')
+    assert '# TYPE mediator_request_bodies_requests_total counter' in response.text
+    assert '# TYPE mediator_pickup_queue_messages gauge' in response.text
+    assert f'mediator_pickup_queue_messages{{worker="{os.getpid()}"}}' in response.text
+
+
+def test_workers_metrics(tmp_path):
+    writer = MetricsWriter()
+    writer.counter('events_total', 'Events', 5, {'kind': 'a'})
+    other = WorkersMetrics(path=str(tmp_path))
+    other.dump(writer.families)
+    # Snapshot of other worker is labeled by its file name, snapshot of stopped worker is removed
+    os.rename(tmp_path / f'{os.getpid()}.json', tmp_path / '1.json')
+    metrics = WorkersMetrics(path=str(tmp_path))
+    text = metrics.collect()
+    assert text.count('# TYPE mediator_events_total counter') == 1
+    assert 'mediator_events_total{worker="1",kind="a"} 5' in text
+    assert f'mediator_pickup_queue_messages{{worker="{os.getpid()}"}}' in text
+    os.utime(tmp_path / '1.json', (0, 0))
+    assert metrics.load() == {}
+    assert not (tmp_path / '1.json').exists()
@@ -3,6 +3,8 @@ from databases import Database
 from sirius_sdk import Pairwise
 
 from app.core.pairwise import MediatorPairwiseList, MediatorDID
+from app.core.repo import RepoLocalCache
+from app.db.models import pairwises
 
 from rfc.bus import *
 
@@ -37,3 +39,50 @@ async def test_sane(test_database: Database, random_me: (str, str, str), random_
 
     loaded = await obj_under_test.load_for_verkey(their_verkey)
     assert loaded.metadata == p.metadata
+
+
+@pytest.mark.asyncio
+async def test_cache(test_database: Database, random_me: (str, str, str), random_their: (str, str, str)):
+    my_did, my_verkey, _ = random_me
+    their_did, their_verkey, _ = random_their
+    p = Pairwise(
+        me=Pairwise.Me(
+            did=my_did, verkey=my_verkey
+        ),
+        their=Pairwise.Their(
+            did=their_did, label='Test-Pairwise', endpoint='http://endpoint', verkey=their_verkey
+        ),
+        metadata=dict(test='test-value')
+    )
+    cache = RepoLocalCache(topic=MediatorPairwiseList.INVALIDATION_TOPIC)
+    obj_under_test = MediatorPairwiseList(test_database, cache=cache)
+    await obj_under_test.ensure_exists(p)
+
+    # Pairwise is served from cache without database queries
+    sql = pairwises.update().where(pairwises.c.their_did == their_did)
+    await test_database.execute(query=sql, values={'metadata': {'their': {'did': their_did, 'verkey': their_verkey}}})
+    loaded = await obj_under_test.load_for_verkey(their_verkey)
+    assert loaded.metadata == p.metadata
+    loaded.metadata['test'] = 'mutated'
+    loaded = await obj_under_test.load_for_did(their_did)
+    assert loaded.metadata['test'] == 'test-value'
+    assert await obj_under_test.is_exists(their_did) is True
+    assert cache.counters[MediatorPairwiseList.CACHE_NAMESPACE]['l1_hits'] == 3
+    # Unchanged pairwise is not written
+    await obj_under_test.update(p)
+    loaded = await MediatorPairwiseList(test_database, cache=RepoLocalCache()).load_for_did(their_did)
+    assert 'test' not in loaded.metadata
+
+    # Changes bypassing storage are visible after invalidation
+    await obj_under_test.invalidate(their_did)
+    loaded = await obj_under_test.load_for_verkey(their_verkey)
+    assert 'test' not in loaded.metadata
+
+    # Changed pairwise is written and cached
+    p.their.label = 'Updated-Pairwise'
+    await obj_under_test.ensure_exists(p)
+    loaded = await MediatorPairwiseList(test_database, cache=RepoLocalCache()).load_for_verkey(their_verkey)
+    assert loaded.their.label == 'Updated-Pairwise'
+    loaded = await obj_under_test.load_for_verkey(their_verkey)
+    assert loaded.their.label == 'Updated-Pairwise'
+    await cache.stop()
@@ -153,3 +153,4 @@ async def test_max_queue_size():
 
     rcv_msg = await state_machine.process(request=PickUpNoop(delay_timeout=1))
     assert isinstance(rcv_msg, PickUpProblemReport)
+
@@ -4,7 +4,7 @@ import asyncio
 import pytest
 
 from app.core.redis import *
-from app.db.crud import ensure_endpoint_exists
+from app.db.crud import ensure_endpoint_exists, load_endpoint
 
 
 DEF_TIMEOUT = 5
@@ -166,8 +166,10 @@ async def test_clean_redis_group_on_close():
 
     # Activate async-reader task
     asyncio.ensure_future(__write_delayed__(address, {'marker': uuid.uuid4().hex}))
-    ok, rcv = await ch_under_test.read(timeout=3)
+    ok, entry_id, rcv = await ch_under_test.read_entry(timeout=3)
     assert ok
+    # Consumer with not acknowledged entries stays in group until reclaimed
+    await ch_under_test.ack(entry_id)
 
     # Check meta-info
     ch_infos = AsyncRedisGroup(address, group_id=group_id)
@@ -196,8 +198,10 @@ async def test_clean_redis_group_infinite_timeout():
 
     # Activate async-reader task
     asyncio.ensure_future(__write_delayed__(address, {'marker': uuid.uuid4().hex}))
-    ok, rcv = await ch_under_test.read(timeout=None)
+    ok, entry_id, rcv = await ch_under_test.read_entry(timeout=None)
     assert ok
+    # Consumer with not acknowledged entries stays in group until reclaimed
+    await ch_under_test.ack(entry_id)
 
     # Check meta-info
     ch_infos = AsyncRedisGroup(address, group_id=group_id)
@@ -212,6 +216,104 @@ async def test_clean_redis_group_infinite_timeout():
     assert len(infos2) == 0
 
 
+@pytest.mark.asyncio
+async def test_connection_pools():
+    server = 'redis://redis1'
+    address = f'{server}/%s' % uuid.uuid4().hex
+    group_id = 'group_id_' + uuid.uuid4().hex
+    pool = await RedisPools.get_pool(server)
+    for n in range(10):
+        ch = AsyncRedisGroup(address, group_id=group_id)
+        with pytest.raises(ReadWriteTimeoutError):
+            await ch.read(timeout=0.1)
+        await ch.close()
+        await AsyncRedisChannel(address).write({'n': n})
+    # Shared pool persists, blocking connection is reused by readers
+    assert await RedisPools.get_pool(server) is pool
+    metrics = RedisPools.metrics()
+    assert metrics['pools'][server][RedisPools.KIND_BLOCKING]['size'] == 1
+    assert metrics['counters']['acquired'] == metrics['counters']['released'] == 10
+
+
+@pytest.mark.asyncio
+async def test_health_monitor():
+    monitor = RedisHealthMonitor(servers=['redis1', 'redisx'])
+    try:
+        for n in range(10):
+            assert await monitor.choice() == 'redis1'
+        statuses = monitor.statuses
+        assert statuses['redis1'].up is True
+        assert statuses['redis1'].latency > 0
+        assert statuses['redisx'].up is False
+        assert statuses['redisx'].last_error
+        # Unwanted server is returned only if there are no others
+        assert await monitor.choice(unwanted='redis1') == 'redis1'
+        # Reported error is cached until next check
+        monitor.report_error('redis://redis1/%s' % uuid.uuid4().hex, RedisConnectionError())
+        assert monitor.statuses['redis1'].up is False
+        await monitor.refresh()
+        assert monitor.statuses['redis1'].up is True
+    finally:
+        await monitor.stop()
+    address = await choice_server_address()
+    assert address.startswith('redis://')
+
+
+@pytest.mark.asyncio
+async def test_endpoint_placement():
+    ring = build_hash_ring(['redis1', 'redis2'])
+    for n in range(10):
+        endpoint_uid = uuid.uuid4().hex
+        owner = ring.get_node(endpoint_uid)
+        other = 'redis2' if owner == 'redis1' else 'redis1'
+        address = await choice_endpoint_server_address(endpoint_uid, ring=ring)
+        assert address == f'redis://{owner}'
+        address = await choice_endpoint_server_address(
+            endpoint_uid, unwanted=f'redis://{owner}/{endpoint_uid}', ring=ring
+        )
+        assert address == f'redis://{other}'
+
+
+@pytest.mark.asyncio
+async def test_streams_rebalancer(test_database: Database):
+    ring = build_hash_ring(['redis1', 'redis2'])
+    endpoint_uid = uuid.uuid4().hex
+    while ring.get_node(endpoint_uid) != 'redis2':
+        endpoint_uid = uuid.uuid4().hex
+    old_address = f'redis://redis1/{endpoint_uid}'
+    new_address = f'redis://redis2/{endpoint_uid}'
+    await ensure_endpoint_exists(test_database, uid=endpoint_uid, redis_pub_sub=old_address)
+    group_id = 'group_id_' + uuid.uuid4().hex
+    # Entry #0 is acknowledged, entries #1, #2 are not processed yet
+    reader = AsyncRedisGroup(old_address, group_id=group_id)
+    with pytest.raises(ReadWriteTimeoutError):
+        await reader.read(timeout=0.1)
+    writer = AsyncRedisGroup(old_address)
+    for n in range(3):
+        await writer.write({'n': n})
+    ok, entry_id, data = await reader.read_entry(timeout=1)
+    assert data == {'n': 0}
+    await reader.ack(entry_id)
+    await reader.close()
+
+    rebalancer = StreamsRebalancer(test_database, ring=ring)
+    await rebalancer.rebalance(dry_run=True)
+    assert rebalancer.migrated >= 1
+    assert (await load_endpoint(test_database, endpoint_uid))['redis_pub_sub'] == old_address
+    await rebalancer.migrate(endpoint_uid, old_address, 'redis2')
+    assert rebalancer.copied == 2
+    assert (await load_endpoint(test_database, endpoint_uid))['redis_pub_sub'] == new_address
+    # Not processed entries are delivered from new stream
+    reader = AsyncRedisGroup(new_address, group_id=group_id)
+    reads = []
+    for n in range(2):
+        ok, data = await reader.read(timeout=1)
+        reads.append(data)
+    assert reads == [{'n': 1}, {'n': 2}]
+    redis = await RedisPools.redis('redis://redis1')
+    assert await redis.exists(endpoint_uid) == 0
+
+
 @pytest.mark.asyncio
 async def test_push(test_database: Database, ):
 
@@ -246,3 +348,212 @@ async def test_push(test_database: Database, ):
     )
     fut.cancel()
     assert success is True
+
+
+@pytest.mark.asyncio
+async def test_push_durable(test_database: Database):
+
+    forward_channel_addr = 'redis://redis1/%s' % uuid.uuid4().hex
+    endpoint_id = uuid.uuid4().hex
+    await ensure_endpoint_exists(test_database, uid=endpoint_id, redis_pub_sub=forward_channel_addr)
+    expired = list()
+
+    async def on_expired():
+        expired.append(True)
+
+    tracker = InFlightTracker()
+    push = RedisPush(test_database, tracker=tracker)
+    # Check-1: push returns before any consumer connected and message expired without ack
+    success = await push.push(endpoint_id=endpoint_id, message={'test': 'Hello-1'}, ttl=1, on_expired=on_expired)
+    assert success is True
+    assert tracker.size == 1
+    await asyncio.sleep(3)
+    assert expired == [True]
+    assert tracker.size == 0
+
+    # Check-2: consumer acks message with XACK
+    pull = RedisPull()
+    listener = pull.listen(forward_channel_addr)
+    ok, request = await listener.get_one()
+    assert ok is True
+    assert request.message == {'test': 'Hello-1'}
+    acked = await request.ack()
+    assert acked is True
+    group = AsyncRedisGroup(forward_channel_addr)
+    assert await group.is_acked(request.entry_id) is True
+
+    # Check-3: acked message don't cause expiration callback
+    expired.clear()
+    success = await push.push(endpoint_id=endpoint_id, message={'test': 'Hello-2'}, ttl=2, on_expired=on_expired)
+    assert success is True
+    ok, request = await listener.get_one()
+    assert ok is True
+    await request.ack()
+    await asyncio.sleep(4)
+    assert expired == []
+    await listener.close()
+
+    # Check-4: group connected later receives new messages only, history is not replayed
+    group = AsyncRedisGroup(forward_channel_addr, group_id=uuid.uuid4().hex)
+    with pytest.raises(ReadWriteTimeoutError):
+        await group.read(timeout=1)
+    success = await push.push(endpoint_id=endpoint_id, message={'test': 'Hello-3'}, ttl=15)
+    assert success is True
+    ok, data = await group.read(timeout=3)
+    assert ok is True
+    assert data['message'] == {'test': 'Hello-3'}
+    await group.close()
+    await tracker.stop()
+
+
+@pytest.mark.asyncio
+async def test_push_concurrent_with_dispatcher(test_database: Database):
+
+    forward_channel_addr = 'redis://redis1/%s' % uuid.uuid4().hex
+    endpoint_id = uuid.uuid4().hex
+    await ensure_endpoint_exists(test_database, uid=endpoint_id, redis_pub_sub=forward_channel_addr)
+
+    async def reader(address: str):
+        pull = RedisPull()
+        async for ok, request in pull.listen(address):
+            await request.ack()
+
+    fut = asyncio.ensure_future(reader(forward_channel_addr))
+    await asyncio.sleep(3)
+
+    dispatcher = AckDispatcher()
+    push = RedisPush(test_database, dispatcher=dispatcher)
+    try:
+        results = await asyncio.gather(*[
+            push.push(endpoint_id=endpoint_id, message={'test': f'Hello-{n}'}, ttl=15) for n in range(10)
+        ])
+    finally:
+        fut.cancel()
+        await dispatcher.close()
+    assert results == [True] * 10
+    assert dispatcher.pending_count == 0
+    # Concurrent pushes share single subscription to reverse channel
+    assert dispatcher.subscriptions == 1
+    assert dispatcher.reverse_address(forward_channel_addr).startswith('redis://redis1/')
+
+
+@pytest.mark.asyncio
+async def test_pull_batch():
+    address = 'redis://redis1/%s' % uuid.uuid4().hex
+    pull = RedisPull()
+    listener = pull.listen(address, read_count=5)
+    # Check-1: empty stream with timeout
+    ok, requests = await listener.get_batch(max_count=5, max_wait=1)
+    assert ok is True
+    assert requests == []
+    # Check-2: read in batches
+    writer = AsyncRedisGroup(address)
+    for n in range(7):
+        await writer.write({
+            '@id': uuid.uuid4().hex,
+            '@type': PUSH_MSG_TYPE,
+            'reverse_channel': None,
+            'expire_at': 0,
+            'message': {'key': f'value{n}'}
+        })
+    ok, batch1 = await listener.get_batch(max_count=5)
+    assert ok is True
+    assert [req.message for req in batch1] == [{'key': f'value{n}'} for n in range(5)]
+    ok, batch2 = await listener.get_batch(max_count=5, max_wait=1)
+    assert ok is True
+    assert [req.message for req in batch2] == [{'key': f'value{n}'} for n in range(5, 7)]
+    # Check-3: ack all entries
+    success = await listener.ack_batch(batch1 + batch2)
+    assert success is True
+    for req in batch1 + batch2:
+        assert await writer.is_acked(req.entry_id) is True
+    await listener.close()
+
+
+@pytest.mark.asyncio
+async def test_reclaim_pending_entries():
+    address = 'redis://redis1/%s' % uuid.uuid4().hex
+    group_id = 'group_id_' + uuid.uuid4().hex
+    dead_consumer = AsyncRedisGroup(address, group_id=group_id)
+    live_consumer = AsyncRedisGroup(address, group_id=group_id)
+    writer = AsyncRedisGroup(address)
+    stamp = datetime.datetime.utcnow().timestamp()
+
+    # Bootstrap consumers
+    with pytest.raises(ReadWriteTimeoutError):
+        await dead_consumer.read(timeout=1)
+    with pytest.raises(ReadWriteTimeoutError):
+        await live_consumer.read(timeout=1)
+    await writer.write({'marker': 'actual', 'expire_at': stamp + 60})
+    await writer.write({'marker': 'expired', 'expire_at': stamp - 60})
+    entries = await dead_consumer.read_batch(count=2, timeout=3)
+    assert len(entries) == 2
+    # Consumer died without ack: entries stay in its pending list
+    await dead_consumer.close()
+    infos = await live_consumer.info_consumers()
+    assert dead_consumer.self_id.encode() in [info[b'name'] for info in infos]
+
+    await asyncio.sleep(1)
+    reclaimed, expired, deleted = await live_consumer.reclaim(min_idle_time=0.5, dead_consumer_idle=0.5, expire_grace=0)
+    assert (reclaimed, expired, deleted) == (1, 1, 1)
+    ok, entry_id, data = await live_consumer.read_entry(timeout=1)
+    assert ok is True
+    assert data['marker'] == 'actual'
+    infos = await live_consumer.info_consumers()
+    assert [info[b'name'] for info in infos] == [live_consumer.self_id.encode()]
+    await live_consumer.ack(entry_id)
+    await live_consumer.close()
+
+
+@pytest.mark.asyncio
+async def test_reclaim_drops_expired_entries_of_ack_mode():
+    address = 'redis://redis1/%s' % uuid.uuid4().hex
+    group_id = 'group_id_' + uuid.uuid4().hex
+    dead_consumer = AsyncRedisGroup(address, group_id=group_id)
+    live_consumer = AsyncRedisGroup(address, group_id=group_id)
+    writer = AsyncRedisGroup(address)
+    stamp = datetime.datetime.utcnow().timestamp()
+
+    with pytest.raises(ReadWriteTimeoutError):
+        await dead_consumer.read(timeout=1)
+    with pytest.raises(ReadWriteTimeoutError):
+        await live_consumer.read(timeout=1)
+    # Sender of ack mode stopped waiting and fell back to FCM, durable entry is kept for grace period
+    await writer.write({'marker': 'ack-mode', 'reverse_channel': 'redis://redis1/acks', 'expire_at': stamp - 30})
+    await writer.write({'marker': 'durable', 'reverse_channel': None, 'expire_at': stamp - 30})
+    entries = await dead_consumer.read_batch(count=2, timeout=3)
+    assert len(entries) == 2
+    await dead_consumer.close()
+
+    await asyncio.sleep(1)
+    reclaimed, expired, _ = await live_consumer.reclaim(min_idle_time=0.5, dead_consumer_idle=0.5, expire_grace=3600)
+    assert (reclaimed, expired) == (1, 1)
+    ok, entry_id, data = await live_consumer.read_entry(timeout=1)
+    assert ok is True
+    assert data['marker'] == 'durable'
+    await live_consumer.ack(entry_id)
+    await live_consumer.close()
+
+
+@pytest.mark.asyncio
+async def test_streams_sweeper():
+    name = uuid.uuid4().hex
+    address = f'redis://redis1/{name}'
+    writer = AsyncRedisGroup(address)
+    for n in range(5):
+        await writer.write({'key': f'value{n}'})
+    redis = await aioredis.create_redis('redis://redis1')
+    try:
+        # Check-1: trim by length
+        sweeper = StreamsSweeper(servers=['redis1'], retention=StreamRetention(max_len=2))
+        await sweeper.sweep_once()
+        assert await redis.xlen(name) == 2
+        assert sweeper.counters['trimmed'] >= 3
+        # Check-2: abandoned stream is removed
+        await asyncio.sleep(2)
+        sweeper = StreamsSweeper(servers=['redis1'], retention=StreamRetention(max_age=1))
+        await sweeper.sweep_once()
+        assert await redis.exists(name) == 0
+        assert sweeper.counters['deleted'] >= 1
+    finally:
+        redis.close()
@@ -1,9 +1,12 @@
 import uuid
+import asyncio
 
 import pytest
+import aiomemcached
 from databases import Database
 
-from app.core.repo import Repo
+from app.settings import MEMCACHED
+from app.core.repo import Repo, RepoLocalCache, JsonCacheCodec, MsgpackCacheCodec, msgpack, get_cache_codec
 
 
 @pytest.mark.asyncio
@@ -148,3 +151,185 @@ async def test_global_settings(test_database: Database):
 
     value = await repo_under_test.get_global_setting(param1)
     assert value == 'value-ver-2'
+
+
+@pytest.mark.asyncio
+async def test_local_cache(test_database: Database, random_redis_pub_sub: str):
+    uid = uuid.uuid4().hex
+    # Emulate two workers with own in-process caches
+    repo1 = Repo(db=test_database, local_cache=RepoLocalCache())
+    repo2 = Repo(db=test_database, local_cache=RepoLocalCache())
+    await repo1.ensure_endpoint_exists(uid, random_redis_pub_sub, verkey='VERKEY1')
+    for n in range(3):
+        endpoint = await repo2.load_endpoint(uid)
+        assert endpoint['verkey'] == 'VERKEY1'
+    counters = repo2.local_cache.counters[Repo.NAMESPACE_ENDPOINTS]
+    assert counters['l1_hits'] == 2
+    assert counters['memcached_hits'] + counters['misses'] == 1
+    # Cached values are not shared with callers
+    endpoint['verkey'] = 'MODIFIED'
+    assert (await repo2.load_endpoint(uid))['verkey'] == 'VERKEY1'
+    # Mutation in one worker invalidates cache of other one
+    await asyncio.sleep(0.5)  # wait for invalidations listener is subscribed
+    await repo1.ensure_endpoint_exists(uid, verkey='VERKEY2')
+    await asyncio.sleep(1)
+    endpoint = await repo2.load_endpoint(uid)
+    assert endpoint['verkey'] == 'VERKEY2'
+    await repo1.local_cache.stop()
+    await repo2.local_cache.stop()
+
+
+@pytest.mark.asyncio
+async def test_negative_cache(test_database: Database, random_redis_pub_sub: str):
+    uid = uuid.uuid4().hex
+    routing_key = uuid.uuid4().hex
+    repo_under_test = Repo(db=test_database, local_cache=RepoLocalCache())
+    # Check-1: unknown endpoint is cached as missing
+    for n in range(3):
+        assert await repo_under_test.load_endpoint(uid) is None
+    assert repo_under_test.local_cache.counters[Repo.NAMESPACE_ENDPOINTS]['negative_hits'] == 2
+    # Check-2: unknown routing key is cached as missing
+    for n in range(3):
+        assert await repo_under_test.load_endpoint_via_routing_key(routing_key) is None
+    assert repo_under_test.local_cache.counters[Repo.NAMESPACE_ROUTING_KEYS]['negative_hits'] == 2
+    # Check-3: markers are invalidated on create
+    await repo_under_test.ensure_endpoint_exists(uid, random_redis_pub_sub, verkey='VERKEY')
+    endpoint = await repo_under_test.load_endpoint(uid)
+    assert endpoint['uid'] == uid
+    await repo_under_test.add_routing_key(uid, routing_key)
+    endpoint = await repo_under_test.load_endpoint_via_routing_key(routing_key)
+    assert endpoint['uid'] == uid
+    await repo_under_test.local_cache.stop()
+
+
+@pytest.mark.asyncio
+async def test_load_endpoints_via_routing_keys(test_database: Database, random_redis_pub_sub: str):
+    uid = uuid.uuid4().hex
+    key1, key2, unknown = uuid.uuid4().hex, uuid.uuid4().hex, uuid.uuid4().hex
+    repo_under_test = Repo(db=test_database, local_cache=RepoLocalCache())
+    await repo_under_test.ensure_endpoint_exists(uid, random_redis_pub_sub, verkey='VERKEY')
+    await repo_under_test.add_routing_key(uid, key1)
+    await repo_under_test.add_routing_key(uid, key2)
+    # Check-1: misses are resolved with database
+    endpoints = await repo_under_test.load_endpoints_via_routing_keys([key1, unknown, key2])
+    assert set(endpoints.keys()) == {key1, key2}
+    assert endpoints[key1]['uid'] == endpoints[key2]['uid'] == uid
+    # Check-2: resolved and unknown keys are cached
+    endpoints = await repo_under_test.load_endpoints_via_routing_keys([key1, unknown, key2])
+    assert set(endpoints.keys()) == {key1, key2}
+    counters = repo_under_test.local_cache.counters
+    assert counters[Repo.NAMESPACE_ENDPOINTS]['l1_hits'] == 2
+    assert counters[Repo.NAMESPACE_ROUTING_KEYS]['negative_hits'] == 1
+    # Check-3: consistent with single key resolving
+    assert await repo_under_test.load_endpoint_via_routing_key(key1) == endpoints[key1]
+    await repo_under_test.local_cache.stop()
+
+
+@pytest.mark.asyncio
+async def test_single_flight():
+    local_cache = RepoLocalCache()
+    calls = []
+
+    async def loader():
+        calls.append(1)
+        await asyncio.sleep(0.1)
+        return 'value'
+
+    async def caller():
+        return await asyncio.shield(local_cache.flight('key', loader, 'namespace'))
+
+    # Check-1: concurrent callers share single loading
+    results = await asyncio.gather(*[caller() for n in range(10)])
+    assert results == ['value'] * 10
+    assert len(calls) == 1
+    assert local_cache.counters['namespace']['coalesced'] == 9
+    # Check-2: cancelled caller don't break loading for others
+    first = asyncio.ensure_future(caller())
+    second = asyncio.ensure_future(caller())
+    await asyncio.sleep(0.01)
+    first.cancel()
+    assert await second == 'value'
+    assert len(calls) == 2
+
+
+@pytest.mark.asyncio
+async def test_early_refresh(test_database: Database, random_redis_pub_sub: str):
+    uid = uuid.uuid4().hex
+    repo_under_test = Repo(db=test_database, local_cache=RepoLocalCache())
+    await repo_under_test.ensure_endpoint_exists(uid, random_redis_pub_sub, verkey='VERKEY1')
+    endpoint = await repo_under_test.load_endpoint(uid)
+    assert endpoint['verkey'] == 'VERKEY1'
+    # Force refresh on every hit: cached value is returned while it is reloaded in background
+    repo_under_test.EARLY_REFRESH_BETA = 1e9
+    endpoint = await repo_under_test.load_endpoint(uid)
+    assert endpoint['verkey'] == 'VERKEY1'
+    await asyncio.sleep(0.5)
+    assert repo_under_test.local_cache.counters[Repo.NAMESPACE_ENDPOINTS]['early_refreshes'] == 1
+    await repo_under_test.local_cache.stop()
+
+
+@pytest.mark.asyncio
+async def test_miss_during_early_refresh(test_database: Database):
+    key = uuid.uuid4().hex
+    repo_under_test = Repo(db=test_database, local_cache=RepoLocalCache())
+
+    async def fetch():
+        await asyncio.sleep(0.2)
+        return {'value': key}
+
+    assert await repo_under_test._load_cached(key, Repo.NAMESPACE_GLOBAL_SETTINGS, fetch) == {'value': key}
+    repo_under_test.EARLY_REFRESH_BETA = 1e9
+    assert await repo_under_test._load_cached(key, Repo.NAMESPACE_GLOBAL_SETTINGS, fetch) == {'value': key}
+    # Miss while refresh is running loads value by itself
+    await repo_under_test._delete_cache(key, namespace=Repo.NAMESPACE_GLOBAL_SETTINGS)
+    assert await repo_under_test._load_cached(key, Repo.NAMESPACE_GLOBAL_SETTINGS, fetch) == {'value': key}
+    counters = repo_under_test.local_cache.counters[Repo.NAMESPACE_GLOBAL_SETTINGS]
+    assert counters['early_refreshes'] == 1
+    assert counters['coalesced'] == 0
+    await repo_under_test.local_cache.stop()
+
+
+@pytest.mark.asyncio
+async def test_delete_cache_of_all_formats(test_database: Database):
+    uid = uuid.uuid4().hex
+    memcached = aiomemcached.Client(host=MEMCACHED)
+    repo_under_test = Repo(db=test_database, memcached=memcached, local_cache=RepoLocalCache())
+    # Values cached by workers of other versions are dropped on mutation
+    keys = [
+        repo_under_test._cache_key(uid, Repo.NAMESPACE_ENDPOINTS, version=Repo.LEGACY_CACHE_VERSION),
+        repo_under_test._cache_key(uid, Repo.NAMESPACE_ENDPOINTS, codec=JsonCacheCodec())
+    ]
+    for key in keys:
+        await memcached.set(key.encode(), b'stale')
+    await repo_under_test._delete_cache(uid, namespace=Repo.NAMESPACE_ENDPOINTS)
+    for key in keys:
+        value, _ = await memcached.get(key.encode())
+        assert value is None
+    await repo_under_test.local_cache.stop()
+
+
+def test_cache_codecs():
+    samples = [
+        {
+            'uid': uuid.uuid4().hex, 'verkey': 'FYmoFw55GeQH7SRFa37dkx1d2dZ3zUF8ckg7wmL7ofN4',
+            'agent_id': 'Th7MpTaRZVRYnPiabds81Y', 'redis_pub_sub': 'redis://redis1/' + uuid.uuid4().hex,
+            'fcm_device_id': None, 'metadata': {'key1': 'value1', 'key2': 111, 'key3': 1.5, 'key4': True}
+        },
+        [{'id': n, 'key': f'did:key:z6Mk{uuid.uuid4().hex}'} for n in range(3)],
+        'FYmoFw55GeQH7SRFa37dkx1d2dZ3zUF8ckg7wmL7ofN4',
+        # strings are not confused with json values
+        '{"key": "value"}', '"quoted"', 'j', 's', '', 'Юникод'
+    ]
+    codecs = [JsonCacheCodec()] + ([MsgpackCacheCodec()] if msgpack else [])
+    for codec in codecs:
+        for value in samples:
+            encoded = codec.encode(value)
+            assert isinstance(encoded, bytes)
+            decoded = codec.decode(encoded)
+            assert decoded == value
+            assert type(decoded) is type(value)
+    with pytest.raises(ValueError):
+        JsonCacheCodec().decode(b'x{}')
+    assert isinstance(get_cache_codec('json'), JsonCacheCodec)
+    with pytest.raises(RuntimeError):
+        get_cache_codec('unknown')
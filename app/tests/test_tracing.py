@@ -0,0 +1,64 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+from app.core.tracing import Tracer, EventSink, Span
+
+
+class CollectingSink(EventSink):
+
+    def __init__(self):
+        self.spans = []
+        self.p2p = []
+
+    async def emit(self, span: Span):
+        self.p2p.append(await span.load_p2p())
+        self.spans.append(span)
+
+
+@pytest.mark.asyncio
+async def test_sampling():
+    sink = CollectingSink()
+    tracer = Tracer(sink=sink, sample_rate=0)
+    loads = []
+
+    async def p2p_loader():
+        loads.append(1)
+        return 'p2p'
+
+    with tracer.start_span('Post to device', p2p_loader=p2p_loader, endpoint_uid='uid1') as span:
+        span.event('Try to send via websocket')
+        span.event('Sent via websocket', success=True)
+    with pytest.raises(HTTPException):
+        with tracer.start_span('Post to device', p2p_loader=p2p_loader, endpoint_uid='uid2') as span:
+            span.event('Try to send via websocket')
+            raise HTTPException(status_code=410)
+    await asyncio.sleep(0.1)
+
+    # Not sampled successful span is not emitted, pairwise is resolved for emitted spans only
+    assert len(sink.spans) == 1
+    assert sink.spans[0].status == 'HTTP 410'
+    assert sink.spans[0].context == {'endpoint_uid': 'uid2'}
+    assert [stage for stage, _, _ in sink.spans[0].stages] == ['Try to send via websocket']
+    assert sink.p2p == ['p2p']
+    assert len(loads) == 1
+    assert tracer.counters['spans'] == 2
+    assert tracer.counters['failed'] == 1
+    assert tracer.counters['emitted'] == 1
+
+    # Histograms are collected for all spans
+    histograms = tracer.histograms['Post to device']
+    assert histograms['total'].count == 2
+    assert histograms['Try to send via websocket'].count == 2
+    assert histograms['Sent via websocket'].count == 1
+    assert histograms['total'].cumulative[-1] == (float('inf'), 2)
+    assert tracer.outcomes['Post to device'] == {'OK': 1, 'HTTP 410': 1}
+
+    tracer.sample_rate = 1
+    with tracer.start_span('Post to device', endpoint_uid='uid3') as span:
+        span.outcome = 'websocket'
+    await asyncio.sleep(0.1)
+    assert len(sink.spans) == 2
+    assert sink.p2p[-1] is None
+    assert tracer.outcomes['Post to device']['websocket'] == 1
@@ -4,15 +4,16 @@ import hashlib
 import json
 import threading
 from urllib.parse import urljoin
-from typing import Optional, Callable, Any
+from typing import Optional, Callable, Any, Union
 
 import sirius_sdk
 from databases import Database
-from fastapi import Request
+from fastapi import Request, HTTPException
 
 from app.core.global_config import GlobalConfig
 from app.core.singletons import GlobalMemcachedClient
-from app.settings import WEBROOT, MEDIATOR_LABEL, KEYPAIR, ENDPOINTS_PATH_PREFIX, WS_PATH_PREFIX, LONG_POLLING_PATH_PREFIX
+from app.settings import WEBROOT, MEDIATOR_LABEL, KEYPAIR, ENDPOINTS_PATH_PREFIX, WS_PATH_PREFIX, LONG_POLLING_PATH_PREFIX, \
+    MAX_ENVELOPE_SIZE
 
 
 def extract_content_type(request: Request) -> Optional[str]:
@@ -22,6 +23,64 @@ def extract_content_type(request: Request) -> Optional[str]:
     return None
 
 
+class RequestBodyReader:
+    """Reader of request bodies limited by size.
+
+    Chunks are joined once when stream is over, single chunk body is returned without copying.
+    Body with declared Content-Length over the limit is rejected before reading.
+    """
+
+    __metrics = {
+        'requests': 0, 'rejected': 0, 'chunks': 0, 'bytes': 0, 'copies': 0, 'copied_bytes': 0,
+        'buffered_bytes': 0, 'max_body_size': 0
+    }
+
+    @classmethod
+    def metrics(cls) -> dict:
+        return dict(cls.__metrics)
+
+    @classmethod
+    async def read(cls, request: Request, max_size: int = None) -> bytes:
+        """
+        :param max_size: max body size in bytes, MAX_ENVELOPE_SIZE setting by default, 0 - unlimited
+        :raises HTTPException: 413 if body is too large
+        """
+        if max_size is None:
+            max_size = MAX_ENVELOPE_SIZE
+        metrics = cls.__metrics
+        metrics['requests'] += 1
+        content_length = request.headers.get('content-length')
+        if max_size and content_length and content_length.isdigit() and int(content_length) > max_size:
+            cls.__reject(max_size)
+        chunks = []
+        size = 0
+        try:
+            async for chunk in request.stream():
+                if not chunk:
+                    continue
+                size += len(chunk)
+                metrics['buffered_bytes'] += len(chunk)
+                if max_size and size > max_size:
+                    cls.__reject(max_size)
+                chunks.append(chunk)
+        finally:
+            metrics['buffered_bytes'] -= size
+        metrics['chunks'] += len(chunks)
+        metrics['bytes'] += size
+        metrics['max_body_size'] = max(metrics['max_body_size'], size)
+        if len(chunks) == 1:
+            return chunks[0]
+        if chunks:
+            metrics['copies'] += 1
+            metrics['copied_bytes'] += size
+        return b''.join(chunks)
+
+    @classmethod
+    def __reject(cls, max_size: int):
+        cls.__metrics['rejected'] += 1
+        raise HTTPException(status_code=413, detail=f'Request body exceeds {max_size} bytes')
+
+
 def build_ws_endpoint_addr() -> str:
     mediator_endpoint = WEBROOT
     if mediator_endpoint.startswith('https://'):
@@ -154,8 +213,12 @@ async def run_in_thread(func: Callable, *args, **kwargs) -> Any:
     return ret
 
 
-def extract_recipients(jwe: bytes) -> list:
-    jwe = json.loads(jwe.decode())
+def extract_recipients(jwe: Union[bytes, dict]) -> list:
+    """
+    :param jwe: raw or already parsed envelope
+    """
+    if not isinstance(jwe, dict):
+        jwe = json.loads(jwe)
     protected = jwe['protected']
     payload = json.loads(base64.b64decode(protected))
     recipients = payload.get('recipients', [])